@@ -0,0 +1,256 @@
+"""
+API HTTP dell'Assistente Sindacale Scuola
+Servizio asincrono senza stato: più worker condividono lo stesso backend Chroma
+
+Installa: pip install fastapi uvicorn
+Esegui:   CHROMA_HOST=localhost GROQ_API_KEY=... uvicorn api_sindacato:app --workers 4
+          SINDACATO_LLM_LOCALE=modelli/modello.gguf uvicorn api_sindacato:app   (senza Groq)
+Client:   SINDACATO_API_URL=http://localhost:8000 streamlit run app_sindacato.py
+
+Con SINDACATO_SHARD=1 ogni worker ha il proprio pool di shard, con una copia completa dei vettori:
+usare WEB_CONCURRENCY=4 al posto di --workers 4, così i processi degli shard si dividono tra i worker.
+"""
+
+import os
+import json
+import time
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+
+from app_sindacato import (
+    SchoolUnionAssistant, LLM_LOCALE, MODELLO_PREDEFINITO, MODALITA_AUTOMATICA, MODALITA_ESTRATTIVA,
+    PRIORITA_INTERATTIVA, PRIORITA_BATCH, RISULTATI_PER_PAGINA, SESSIONE_CORRENTE, get_admission_controller, get_audit_log,
+    get_search_cursors
+)
+
+# Fuori da `streamlit run` Streamlit segnala ogni uso del contesto di sessione
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+# Ogni worker ha i suoi indici in memoria: li riallinea al corpus condiviso periodicamente
+INTERVALLO_SYNC_INDICI = 5.0
+# Reverse proxy di cui ci si fida per X-Forwarded-For (altrimenti tutti gli utenti sono un solo indirizzo)
+PROXY_FIDATI = {host.strip() for host in os.environ.get("SINDACATO_PROXY_FIDATI", "").split(",") if host.strip()}
+
+_assistant: Optional[SchoolUnionAssistant] = None
+_last_sync = 0.0
+
+
+class AskRequest(BaseModel):
+    question: str
+    model: str = MODELLO_PREDEFINITO
+    mode: str = MODALITA_AUTOMATICA
+    stream: bool = False
+    session: Optional[str] = None
+    batch: bool = False
+    data_riferimento: Optional[int] = None
+
+
+class IngestRequest(BaseModel):
+    text: str
+    categoria: str
+    argomento: str
+    session: Optional[str] = None
+
+
+class ContractVersionRequest(BaseModel):
+    contratto: str
+    versione: str
+    valido_dal: int
+    articoli: Dict[str, str]
+    categoria: Optional[str] = None
+    session: Optional[str] = None
+
+
+def get_assistant() -> SchoolUnionAssistant:
+    """Un assistente per processo worker; lo stato condiviso vive nel backend Chroma"""
+    global _assistant
+    if _assistant is None:
+        api_key = os.environ.get("GROQ_API_KEY")
+        if not api_key and not LLM_LOCALE:
+            raise HTTPException(status_code=503, detail="GROQ_API_KEY non configurata")
+        _assistant = SchoolUnionAssistant(api_key)
+        if _assistant.count() == 0:
+            _assistant.preload_contracts()
+        sync_indexes(_assistant)
+    return _assistant
+
+
+def sync_indexes(assistant: SchoolUnionAssistant):
+    global _last_sync
+    if time.monotonic() - _last_sync >= INTERVALLO_SYNC_INDICI:
+        _last_sync = time.monotonic()
+        assistant.sync_indexes()
+
+
+def client_id(http_request: Request) -> str:
+    """Indirizzo del client: dietro un proxy fidato, il primo di X-Forwarded-For"""
+    host = http_request.client.host if http_request.client else "sconosciuto"
+    forwarded = http_request.headers.get("x-forwarded-for")
+    if forwarded and host in PROXY_FIDATI:
+        return forwarded.split(",")[0].strip() or host
+    return host
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(get_assistant)
+    yield
+
+
+app = FastAPI(title="Assistente Sindacale Scuola API", lifespan=lifespan)
+
+
+@app.get("/health")
+async def health():
+    return {"stato": "ok"}
+
+
+@app.get("/stats")
+async def stats():
+    assistant = get_assistant()
+    count = await run_in_threadpool(assistant.count)
+    corpus_version = await run_in_threadpool(assistant.corpus_version)
+    return {
+        "documenti": count,
+        "corpus_version": corpus_version,
+        "pid": os.getpid(),
+        "indice": {"modello": assistant.model_name, "collezione": assistant.collection.name},
+        "accorpamento": assistant.singleflight.stats,
+        "chiamate_evitate": assistant.singleflight.avoided(),
+        "espansione": assistant.query_expander.stats,
+        "valori": {"fatti": len(assistant.fact_index.facts), "risposte": assistant.fact_index.answered},
+        "ammissione": get_admission_controller().stats,
+        "shard": assistant.shard_index.shard_stats() if assistant.shard_index is not None else [],
+        "llm_locale": assistant.client.report() if LLM_LOCALE else None,
+        "audit": dict(get_audit_log().stats, in_attesa=get_audit_log().pending()),
+        "cursori": dict(get_search_cursors().stats, attivi=len(get_search_cursors()))
+    }
+
+
+@app.post("/ask")
+async def ask(request: AskRequest, http_request: Request):
+    assistant = get_assistant()
+    admission = get_admission_controller()
+    session_id = request.session or client_id(http_request)
+    SESSIONE_CORRENTE.set(session_id)
+    await run_in_threadpool(sync_indexes, assistant)
+    priority = PRIORITA_BATCH if request.batch else PRIORITA_INTERATTIVA
+
+    # Risposte dalla tabella dei valori: nessuna chiamata LLM, quindi fuori dall'ammissione
+    instant = await run_in_threadpool(assistant.has_instant_answer, request.question, request.mode,
+                                      request.data_riferimento)
+    if instant and not request.stream:
+        response, sources = await run_in_threadpool(
+            assistant.answer_question, request.question, request.model, request.mode, request.data_riferimento
+        )
+        return {"risposta": response, "fonti": sources}
+
+    if not request.stream:
+        def fallback():
+            return assistant.answer_question(request.question, request.model, MODALITA_ESTRATTIVA,
+                                             request.data_riferimento)
+
+        response, sources = await run_in_threadpool(
+            admission.run,
+            session_id,
+            lambda: assistant.answer_question(request.question, request.model, request.mode,
+                                              request.data_riferimento),
+            fallback,
+            priority
+        )
+        return {"risposta": response, "fonti": sources}
+
+    ticket = None if instant else await run_in_threadpool(admission.acquire, session_id, priority)
+    mode = request.mode if ticket is not None or instant else MODALITA_ESTRATTIVA
+    try:
+        tokens, sources = await run_in_threadpool(
+            assistant.answer_question_stream, request.question, request.model, mode, request.data_riferimento
+        )
+    except Exception:
+        if ticket is not None:
+            admission.release(ticket)
+        raise
+
+    async def events():
+        # Il biglietto si rilascia anche se il client si disconnette prima del primo evento
+        try:
+            yield sse("fonti", sources)
+            async for token in iterate_in_threadpool(tokens):
+                yield sse("token", token)
+        except Exception as e:
+            yield sse("errore", str(e))
+            return
+        finally:
+            if ticket is not None:
+                admission.release(ticket)
+        yield sse("fine", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/search")
+async def search(q: str, http_request: Request, n: int = 4, data: Optional[int] = None):
+    assistant = get_assistant()
+    SESSIONE_CORRENTE.set(client_id(http_request))
+    await run_in_threadpool(sync_indexes, assistant)
+    return await run_in_threadpool(assistant.search_content, q, n, True, data)
+
+
+@app.get("/search/pagina")
+async def search_page(q: str, http_request: Request, cursore: Optional[str] = None, n: int = RISULTATI_PER_PAGINA,
+                      data: Optional[int] = None):
+    """Pagina di estratti; il cursore vale su ogni worker (la classifica si ricostruisce se manca)"""
+    assistant = get_assistant()
+    SESSIONE_CORRENTE.set(client_id(http_request))
+    await run_in_threadpool(sync_indexes, assistant)
+    try:
+        return await run_in_threadpool(assistant.search_page, q, cursore, n, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/suggest")
+async def suggest(q: str, limit: int = 6, data: Optional[int] = None):
+    assistant = get_assistant()
+    await run_in_threadpool(sync_indexes, assistant)
+    return {
+        "suggerimenti": assistant.suggest(q, limit=limit, data_riferimento=data) if limit else [],
+        "completamento": assistant.complete_query(q)
+    }
+
+
+@app.get("/documenti")
+async def documents(ids: str):
+    assistant = get_assistant()
+    return await run_in_threadpool(assistant.get_documents, [doc_id for doc_id in ids.split(",") if doc_id])
+
+
+@app.post("/ingest")
+async def ingest(request: IngestRequest, http_request: Request):
+    assistant = get_assistant()
+    SESSIONE_CORRENTE.set(request.session or client_id(http_request))
+    # Solo embedding: l'ingestione non consuma la capacità LLM del controllo di ammissione
+    doc_id, duplicate = await run_in_threadpool(
+        assistant.add_custom_content, request.text, request.categoria, request.argomento
+    )
+    return {"id": doc_id, "duplicato": duplicate}
+
+
+@app.post("/ingest-contratto")
+async def ingest_contract(request: ContractVersionRequest, http_request: Request):
+    assistant = get_assistant()
+    SESSIONE_CORRENTE.set(request.session or client_id(http_request))
+    return await run_in_threadpool(
+        assistant.ingest_contract_version,
+        request.contratto, request.versione, request.valido_dal, request.articoli, request.categoria
+    )
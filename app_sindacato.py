@@ -3,6 +3,7 @@ Assistente Sindacale per il Personale della Scuola con Groq + RAG
 Sistema per docenti, ATA, dirigenti scolastici
 
 Installa: pip install groq chromadb sentence-transformers streamlit
+(opzionale, modello locale su CPU: pip install llama-cpp-python)
 Esegui: streamlit run app_scuola.py
 """
 
@@ -10,15 +11,41 @@ import streamlit as st
 from groq import Groq
 import chromadb
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict
-from datetime import datetime
+import numpy as np
+from typing import List, Dict, Optional, Tuple, Iterator
+from datetime import datetime, date, timedelta
+import os
+import json
+import hashlib
+import threading
+import sqlite3
+import uuid
+import zlib
+import time
+import math
+import re
+import logging
+import bisect
+import random
+import functools
+import inspect
+import contextvars
+import pickle
+import gzip
+import hmac
+import atexit
+import shutil
+import sys
+import tempfile
+import unicodedata
+import urllib.parse
+import urllib.request
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
-# Configurazione pagina
-st.set_page_config(
-    page_title="🎓 Assistente Sindacale Scuola",
-    page_icon="🎓",
-    layout="wide"
-)
+from shard_sindacato import ShardedVectorIndex
+from llm_sindacato import LocalLLMClient
 
 # Database normative scolastiche precaricate
 NORMATIVE_SCUOLA = {
@@ -162,149 +189,3961 @@ NORMATIVE_SCUOLA = {
     ]
 }
 
+# Cartella dei dati persistenti (cache, archivi locali)
+DATA_DIR = os.environ.get("SINDACATO_DATA_DIR", "dati")
+
+# Registro di audit (domande, fonti recuperate, risposte): scritto in background, "" per disattivarlo
+REGISTRO_AUDIT = os.environ.get("SINDACATO_AUDIT", os.path.join(DATA_DIR, "audit"))
+CAPACITA_BUFFER_AUDIT = 10_000
+LOTTO_AUDIT = 500
+INTERVALLO_FLUSH_AUDIT = 1.0
+MAX_BYTE_FILE_AUDIT = 50 * 1024 * 1024
+MAX_FILE_AUDIT = 30  # per processo, contando anche i file dei processi terminati
+
+# Ricerca paginata in Esplora: la classifica dei candidati resta sul server sotto un cursore,
+# le pagine portano solo estratti e il testo completo si legge all'apertura del risultato
+MAX_CANDIDATI_RICERCA = 120
+RISULTATI_PER_PAGINA = 10
+CARATTERI_ESTRATTO = 240
+DURATA_CURSORE = 900
+MAX_CURSORI = 512
+
+# Memoria delle sessioni: oltre l'inattività o il budget complessivo lo stato pesante va su disco
+BUDGET_MEMORIA_SESSIONI = int(float(os.environ.get("SINDACATO_BUDGET_SESSIONI_MB", "256")) * 1024 * 1024)
+INATTIVITA_SESSIONE = float(os.environ.get("SINDACATO_SESSIONE_INATTIVA", "900"))
+SCADENZA_SESSIONI_SU_DISCO = 7 * 24 * 3600
+
+# Pannelli di amministrazione (shard, migrazione, memoria sessioni): nascosti senza questa chiave
+CHIAVE_AMMINISTRAZIONE = os.environ.get("SINDACATO_CHIAVE_ADMIN", "")
+
+# Versioni dei contratti precaricati: categoria -> (contratto, versione, in vigore dal)
+VERSIONI_CONTRATTI = {
+    "CCNL Scuola 2016-2018": ("CCNL Scuola", "2016-2018", 20180419),
+}
+# Validità dei documenti come interi AAAAMMGG (filtrabili da Chroma)
+SEMPRE_VALIDO_DAL = 0
+SEMPRE_VALIDO_AL = 99991231
+
+# Modello di embedding iniziale; quello attivo è nel registro (vedi migrazione del modello)
+MODELLO_EMBEDDING = 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
+
+# Migrazione del modello di embedding: indice ombra costruito in background,
+# confronto sul traffico reale e scambio atomico del puntatore nel registro
+COLLEZIONE_REGISTRO = "school_indice"
+# Per quanto una corpus_version letta resta buona per le chiavi di accorpamento e dei cursori
+VALIDITA_VERSIONE_CORPUS = 1.0
+DOCUMENTI_AL_SECONDO_MIGRAZIONE = float(os.environ.get("SINDACATO_VELOCITA_MIGRAZIONE", "20"))
+QUOTA_TRAFFICO_OMBRA = 0.2
+
+# Snapshot dell'indice da caricare all'avvio al posto del ricalcolo degli embedding
+SNAPSHOT_DIR = os.environ.get("SINDACATO_SNAPSHOT", "")
+FORMATO_SNAPSHOT = 2
+
+# Indice compatto per la ricerca: proiezione a dimensione ridotta e codici int8 in memoria,
+# con rescoring dei migliori candidati su una copia float16 mappata da disco.
+# Con l'indice attivo le ricerche non leggono i vettori né l'HNSW di Chroma, che restano su disco
+# (i vettori float32 si rileggono solo, a lotti, per costruire l'indice)
+INDICE_COMPATTO = os.environ.get("SINDACATO_INDICE_COMPATTO", "").lower() in ("1", "true", "si")
+DIMENSIONE_RIDOTTA = int(os.environ.get("SINDACATO_DIMENSIONE_RIDOTTA", "256"))
+FATTORE_RESCORING = 4
+# Modelli addestrati per essere troncati (Matryoshka): solo per questi il troncamento è lecito
+MODELLI_MATRYOSHKA = {
+    "nomic-ai/nomic-embed-text-v1.5",
+    "mixedbread-ai/mxbai-embed-large-v1",
+    "Alibaba-NLP/gte-multilingual-base",
+}
+
+# Indice partizionato per categoria (per hash se la categoria è grande), servito da un pool di processi
+INDICE_SHARD = os.environ.get("SINDACATO_SHARD", "").lower() in ("1", "true", "si")
+# Ogni worker web (uvicorn --workers, WEB_CONCURRENCY) avvia il proprio pool con una copia completa
+# dei vettori: la memoria cresce con worker web × dimensione del corpus, i processi si dividono tra i worker
+WORKER_WEB = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+PROCESSI_SHARD = int(os.environ.get("SINDACATO_PROCESSI_SHARD", str(max(1, (os.cpu_count() or 2) // 2 // WORKER_WEB))))
+MAX_DOCUMENTI_PER_SHARD = int(os.environ.get("SINDACATO_MAX_DOCUMENTI_SHARD", "20000"))
+
+# Modalità di risposta: LLM con fallback automatico, solo LLM, solo estrattiva
+MODALITA_AUTOMATICA = "auto"
+MODALITA_LLM = "llm"
+MODALITA_ESTRATTIVA = "estrattiva"
+TIMEOUT_LLM = 30.0
+
+# Controllo di ammissione per la capacità LLM condivisa (priorità: più basso = prima).
+# L'ingestione calcola solo embedding e non passa di qui
+PRIORITA_INTERATTIVA = 0
+PRIORITA_BATCH = 1
+CHIAMATE_LLM_CONTEMPORANEE = 4
+DOMANDE_AL_MINUTO_PER_SESSIONE = 6
+RAFFICA_PER_SESSIONE = 4
+ATTESA_MASSIMA_CODA = 30.0
+# Ogni tanti secondi di attesa una richiesta sale di un livello di priorità (niente batch affamati)
+INVECCHIAMENTO_CODA = 10.0
+
+# Registrazione anonimizzata del traffico reale (file JSONL) per i test di carico a replay
+REGISTRO_TRAFFICO = os.environ.get("SINDACATO_REGISTRO_TRAFFICO", "")
+# Sessione che sta eseguendo la richiesta (impostata da interfaccia e API)
+SESSIONE_CORRENTE = contextvars.ContextVar("sessione_corrente", default="")
+_IN_REGISTRAZIONE = contextvars.ContextVar("in_registrazione", default=False)
+
+# Servizio HTTP condiviso: se impostato, l'interfaccia Streamlit fa solo da client
+API_URL = os.environ.get("SINDACATO_API_URL", "")
+
+MODELLO_PREDEFINITO = "llama-3.3-70b-versatile"
+MODELLO_VELOCE = "llama-3.1-8b-instant"
+MODELLO_AUTOMATICO = "🔀 Automatico"
+
+# Backend locale su CPU (llama.cpp, modello GGUF) al posto di Groq: nessuna chiave né rete
+LLM_LOCALE = os.environ.get("SINDACATO_LLM_LOCALE", "")
+SLOT_LLM_LOCALE = int(os.environ.get("SINDACATO_LLM_SLOT", "2"))
+CONTESTO_LLM_LOCALE = int(os.environ.get("SINDACATO_LLM_CONTESTO", "8192"))
+FORMATO_LLM_LOCALE = os.environ.get("SINDACATO_LLM_FORMATO", "llama-3")
+
+# Prefisso statico del prompt del backend locale, identico in ogni richiesta (messaggio di sistema e istruzioni);
+# con Groq il prompt resta quello originale, con le istruzioni dopo contesto e domanda
+PROMPT_SISTEMA = "Sei un esperto consulente sindacale del comparto scuola, specializzato in CCNL, graduatorie, concorsi, diritti e doveri del personale scolastico."
+ISTRUZIONI_PROMPT = """Sei un esperto consulente sindacale specializzato nel personale della scuola italiana (docenti, ATA, dirigenti). Conosci perfettamente CCNL Scuola, normative, contratti, graduatorie, concorsi.
+
+ISTRUZIONI:
+- Rispondi in modo chiaro, pratico e professionale alla DOMANDA che segue
+- Cita SEMPRE le fonti quando usi informazioni dal CONTESTO (es. "Secondo il CCNL Scuola...")
+- Se il contesto non è sufficiente, usa la tua conoscenza delle normative scolastiche italiane
+- Fornisci informazioni operative e pratiche (scadenze, procedure, modulistica)
+- Usa un tono professionale ma accessibile
+- Se la questione è complessa, suggerisci di rivolgersi al sindacato scolastico territoriale
+- Distingui chiaramente tra docenti e ATA quando necessario
+- Indica riferimenti normativi specifici quando possibile
+
+"""
+
+# Prezzi indicativi Groq in $ per milione di token (input, output)
+PREZZI_MODELLI = {
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "mixtral-8x7b-32768": (0.24, 0.24),
+}
+
+# Domande frequenti dei pulsanti rapidi (sovrascrivibili con dati/faq.json)
+FAQ_RAPIDE = [
+    {"id": "ferie", "etichetta": "📅 Ferie e permessi", "domanda": "Quanti giorni di ferie ho come docente?"},
+    {"id": "stipendio", "etichetta": "💰 Stipendio e scatti", "domanda": "Come funzionano gli scatti di anzianità?"},
+    {"id": "supplenze", "etichetta": "📋 Supplenze", "domanda": "Differenza tra supplenza al 31/08 e 30/06?"},
+    {"id": "mobilita", "etichetta": "🔄 Mobilità", "domanda": "Come funziona la mobilità dei docenti?"},
+]
+
+
+# Limiti della cronologia chat salvata per ogni conversazione
+MAX_MESSAGGI_CONVERSAZIONE = 200
+MAX_CARATTERI_CONVERSAZIONE = 200_000
+MESSAGGI_PER_PAGINA = 10
+# Cookie con l'identificativo della conversazione (chi lo conosce legge la cronologia: non va nell'URL)
+COOKIE_CONVERSAZIONE = "sindacato_conv"
+DURATA_COOKIE_CONVERSAZIONE = 180 * 24 * 3600
+
+
+# Deduplicazione all'ingestione e diversificazione dei risultati
+SOGLIA_HAMMING_DUPLICATI = 10
+SOGLIA_SIMILARITA_DUPLICATI = 0.97
+MMR_LAMBDA = 0.7
+
+# Indice gerarchico dei documenti lunghi: si cercano finestre di frasi, il contesto viene dal
+# loro articolo (o gruppo di commi), salvato nella collection dei padri senza embedding
+COLLEZIONE_PADRI = "school_docs_parents"
+SOGLIA_DOCUMENTO_LUNGO = 1500
+MAX_CARATTERI_PADRE = 2500
+FRASI_PER_FINESTRA = 3
+PASSO_FINESTRA = 2
+FRASI_DI_MARGINE = 1
+QUOTA_PADRE_INTERO = 0.6
+# Grafo degli articoli correlati (k vicini), calcolato all'ingestione e salvato nei metadati
+CORRELATI_PER_ARTICOLO = 5
+
+ABBREVIAZIONI = {"art", "artt", "n", "nn", "lett", "lgs", "dpr", "ecc", "cfr", "pag", "es", "prof", "dott", "sig"}
+
+# Espansione delle query: sigle e sinonimi del settore scuola (integrati con le sigle
+# definite nel corpus, es. "Graduatorie a Esaurimento (GAE)")
+ACRONIMI_SCUOLA = {
+    "ATA": "personale amministrativo tecnico e ausiliario",
+    "GPS": "graduatorie provinciali per le supplenze",
+    "GI": "graduatorie di istituto",
+    "GAE": "graduatorie a esaurimento",
+    "MAD": "messa a disposizione",
+    "NASpI": "indennità di disoccupazione",
+    "RSU": "rappresentanze sindacali unitarie",
+    "CCNL": "contratto collettivo nazionale di lavoro",
+    "DSGA": "direttore dei servizi generali e amministrativi",
+    "FIS": "fondo dell'istituzione scolastica",
+    "PTOF": "piano triennale dell'offerta formativa",
+    "TFR": "trattamento di fine rapporto",
+    "TFS": "trattamento di fine servizio",
+    "USR": "ufficio scolastico regionale",
+    "MIUR": "ministero dell'istruzione",
+    "CFU": "crediti formativi universitari",
+    "104": "legge 104 permessi per assistenza a familiari con disabilità",
+}
+SINONIMI_SCUOLA = {
+    "maternità": "congedo parentale",
+    "stipendio": "retribuzione",
+    "trasferimento": "mobilità",
+    "precario": "supplente",
+    "licenziamento": "sanzioni disciplinari",
+}
+MAX_RISCRITTURE = 3
+# Latenza massima aggiunta dall'espansione: le riscritture più lente vengono ignorate
+LATENZA_MASSIMA_ESPANSIONE = 0.15
+# Riscritture in coda o in esecuzione al massimo (oltre si cerca solo con la query originale)
+CODA_MASSIMA_ESPANSIONE = 4 * MAX_RISCRITTURE
+RRF_K = 60
+
+# Tabella dei valori contrattuali estratti dal testo (ore, giorni, mesi, quote).
+# "chiavi": gruppi di radici che devono comparire tutti nella domanda;
+# "contesto": altre radici ammesse nella domanda (ogni parola deve essere coperta dalla regola);
+# "ruolo": None = dedotto dall'argomento dell'articolo
+REGOLE_FATTI = [
+    {"diritto": "Orario di insegnamento", "chiavi": [("ore", "orario", "insegn")], "contesto": ("settiman", "lezion", "cattedr"),
+     "regex": r"(\d+) ore (?:settimanali )?nella (scuola secondaria|primaria|scuola dell'infanzia)",
+     "valore": "{0}", "unita": "ore settimanali", "ruolo": "docenti {1}"},
+    {"diritto": "Ferie", "chiavi": [("ferie", "feria")],
+     "regex": r"(\d+) giorni(?: lavorativi)? di ferie", "valore": "{0}", "unita": "giorni", "ruolo": None},
+    {"diritto": "Permessi per motivi personali o familiari", "chiavi": [("permess",), ("personal", "familiar", "retribu")], "contesto": ("motiv",),
+     "regex": r"(\d+) giorni di permesso retribuito", "valore": "{0}", "unita": "giorni per anno scolastico", "ruolo": None},
+    {"diritto": "Permessi per lutto", "chiavi": [("lutto", "decess", "morte")], "contesto": ("permess", "congedo"),
+     "regex": r"lutto[^.]*? sono (\d+) giorni", "valore": "{0}", "unita": "giorni per evento", "ruolo": None},
+    {"diritto": "Permesso per matrimonio", "chiavi": [("matrimon", "nozze", "sposa", "sposo")], "contesto": ("permess", "congedo"),
+     "regex": r"matrimonio: (\d+) giorni", "valore": "{0}", "unita": "giorni consecutivi", "ruolo": None},
+    {"diritto": "Trattenuta per sciopero", "chiavi": [("sciop",), ("tratten", "perd", "stipend", "toglie", "decurt")], "contesto": ("giornat",),
+     "regex": r"Trattenuta stipendio: (\d+/\d+)", "valore": "{0}", "unita": "della retribuzione mensile per giorno", "ruolo": None},
+    {"diritto": "Preavviso di sciopero", "chiavi": [("sciop",), ("preavv",)],
+     "regex": r"Preavviso: (\d+) giorni", "valore": "{0}", "unita": "giorni", "ruolo": None},
+    {"diritto": "Periodo di comporto per malattia", "chiavi": [("comport", "malatt")], "contesto": ("period", "conserv", "posto"),
+     "regex": r"comporto: (\d+) mesi", "valore": "{0}", "unita": "mesi", "ruolo": None},
+    {"diritto": "Orario di lavoro", "chiavi": [("ore", "orario")], "contesto": ("lavor", "settiman"),
+     "regex": r"(\d+) ore settimanali distribuite", "valore": "{0}", "unita": "ore settimanali", "ruolo": None},
+    {"diritto": "Limite di lavoro straordinario", "chiavi": [("straord",), ("ore", "limit", "massim")],
+     "regex": r"Limite massimo: (\d+) ore annuali", "valore": "{0}", "unita": "ore annuali", "ruolo": None},
+    {"diritto": "Permessi legge 104", "chiavi": [("104",), ("permess", "giorn", "ore", "quant")], "contesto": ("mensil", "legge"),
+     "regex": r"(\d+) giorni mensili retribuiti o (\d+) ore giornaliere", "valore": "{0} giorni mensili o {1}",
+     "unita": "ore giornaliere", "ruolo": None},
+    {"diritto": "Congedo parentale", "chiavi": [("parental",)], "contesto": ("congedo", "astension"),
+     "regex": r"(\d+) mesi complessivi", "valore": "{0}", "unita": "mesi complessivi tra i genitori", "ruolo": None},
+    {"diritto": "Congedo di maternità", "chiavi": [("maternit", "gravid", "parto")], "contesto": ("congedo", "astension"),
+     "regex": r"(\d+) mesi: (\d+) mesi prima del parto \+ (\d+) dopo", "valore": "{0}",
+     "unita": "mesi ({1} prima del parto + {2} dopo)", "ruolo": None},
+    {"diritto": "Aspettativa per motivi personali", "chiavi": [("aspettat",)], "contesto": ("motiv", "personal", "famil"),
+     "regex": r"fino a (\d+) mesi continuativi", "valore": "{0}", "unita": "mesi continuativi o frazionati", "ruolo": None},
+    {"diritto": "Durata dell'anno di prova", "chiavi": [("prova",)], "contesto": ("period",),
+     "regex": r"Durata: (\d+) giorni di servizio di cui (\d+)", "valore": "{0}",
+     "unita": "giorni di servizio, di cui {1} di attività didattica", "ruolo": None},
+    {"diritto": "Scatti di anzianità", "chiavi": [("scatt",)], "contesto": ("anzian",),
+     "regex": r"Scatti: ogni (\d+) anni", "valore": "ogni {0}", "unita": "anni", "ruolo": None},
+]
+# Radici dei ruoli, per scegliere il valore giusto quando la domanda indica a chi si riferisce
+RUOLI_FATTI = {
+    "docenti": ("docent", "insegnant", "prof", "maestr"),
+    "ATA": ("ata", "collabor", "bidell", "amminist", "tecnic", "dsga"),
+    "secondaria": ("second", "medie", "superior", "liceo"),
+    "primaria": ("primar", "element"),
+    "infanzia": ("infanz", "asilo"),
+}
+
+
+def carica_faq() -> List[Dict]:
+    """Restituisce il registro delle FAQ (file di configurazione o predefinite)"""
+    path = os.path.join(DATA_DIR, "faq.json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return FAQ_RAPIDE
+
+def normalizza_testo(text: str) -> str:
+    """Minuscolo e senza accenti, per confronti lessicali"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenizza(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", normalizza_testo(text))
+
+
+def simhash(text: str, bits: int = 64) -> int:
+    """SimHash sui trigrammi di parole: testi quasi identici differiscono di pochi bit"""
+    tokens = tokenizza(text)
+    shingles = [" ".join(tokens[i:i + 3]) for i in range(max(len(tokens) - 2, 1))]
+    counts = [0] * bits
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(bits):
+            counts[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(bits) if counts[bit] > 0)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def mmr_select(query_embedding: np.ndarray, embeddings: np.ndarray, k: int,
+               lambda_: float = MMR_LAMBDA) -> List[int]:
+    """Maximal Marginal Relevance: indici dei candidati pertinenti ma non ridondanti"""
+    def normalize(x):
+        return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+    
+    candidates = normalize(embeddings)
+    relevance = candidates @ normalize(query_embedding)
+    similarity = candidates @ candidates.T
+    
+    selected = [int(np.argmax(relevance))]
+    remaining = set(range(len(candidates))) - set(selected)
+    while remaining and len(selected) < k:
+        best = max(
+            remaining,
+            key=lambda i: lambda_ * relevance[i] - (1 - lambda_) * max(similarity[i, j] for j in selected)
+        )
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+
+def rrf_fuse(result_lists: List[Dict], n_results: int, k: int = RRF_K) -> Dict:
+    """Reciprocal Rank Fusion di più risultati Chroma (stesso formato in uscita)"""
+    scores: Dict[str, float] = {}
+    rows: Dict[str, Dict] = {}
+    for results in result_lists:
+        for rank, doc_id in enumerate(results["ids"][0]):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+            row = {key: results[key][0][rank] for key in results if results[key] is not None and key in
+                   ("ids", "documents", "metadatas", "distances", "embeddings")}
+            if doc_id not in rows or row["distances"] < rows[doc_id]["distances"]:
+                rows[doc_id] = row
+    ranked = sorted(scores, key=scores.get, reverse=True)[:n_results]
+    keys = rows[ranked[0]].keys() if ranked else ("ids", "documents", "metadatas", "distances")
+    return {key: [[rows[doc_id][key] for doc_id in ranked]] for key in keys}
+
+
+def anonimizza(text: str) -> str:
+    """Rimuove dati personali dal testo di una domanda prima di registrarla"""
+    text = re.sub(r"[\w.+-]+@[\w-]+\.[\w.]+", "<EMAIL>", text)
+    text = re.sub(r"\b[A-Z]{6}\d{2}[A-Z]\d{2}[A-Z]\d{3}[A-Z]\b", "<CF>", text, flags=re.IGNORECASE)
+    text = re.sub(r"\bIT\d{2}[A-Z]\d{10}[0-9A-Z]{12}\b", "<IBAN>", text, flags=re.IGNORECASE)
+    text = re.sub(r"(?:\+39\s?)?\b\d[\d\s]{7,12}\d\b", "<TEL>", text)
+    text = re.sub(r"\b\d{5,}\b", "<NUM>", text)
+    # Nomi propri dopo le presentazioni più comuni
+    text = re.sub(r"\b((?i:mi chiamo|sono|il mio nome è))\s+[A-Z][a-zà-ù]+(?:\s+[A-Z][a-zà-ù]+)?", r"\1 <NOME>", text)
+    return text
+
+
+def registra_traffico(operation: str):
+    """Registra tempi e parametri (anonimizzati) delle chiamate dell'assistente, se attivo"""
+    def decorator(method):
+        signature = inspect.signature(method)
+        
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            recorder = get_traffic_recorder()
+            # Solo le chiamate degli utenti: no chiamate annidate né attività in background
+            if not recorder.enabled or _IN_REGISTRAZIONE.get() or not SESSIONE_CORRENTE.get():
+                return method(self, *args, **kwargs)
+            arguments = signature.bind(self, *args, **kwargs)
+            arguments.apply_defaults()
+            token = _IN_REGISTRAZIONE.set(True)
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                status = "errore"
+                raise
+            finally:
+                _IN_REGISTRAZIONE.reset(token)
+                params = {k: v for k, v in arguments.arguments.items() if k != "self"}
+                recorder.record(operation, params, time.perf_counter() - start, status)
+        
+        return wrapper
+    return decorator
+
+
+class WriteBehindLog:
+    """Coda write-behind: buffer limitato in memoria, lotti JSONL scritti da un thread (mai bloccante per chi registra)"""
+    
+    # Oltre questa quota del buffer si scartano gli eventi non critici per fare posto agli altri
+    SOGLIA_PRESSIONE = 0.8
+    
+    def __init__(self, enabled: bool, capacity: int = CAPACITA_BUFFER_AUDIT, batch: int = LOTTO_AUDIT,
+                 interval: float = INTERVALLO_FLUSH_AUDIT):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.batch = batch
+        self.interval = interval
+        self.stats = {"accodati": 0, "scritti": 0, "lotti": 0, "scartati": 0, "scartati_non_critici": 0,
+                      "errori_scrittura": 0}
+        self._buffer: deque = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._file = None
+    
+    def _start(self, name: str):
+        threading.Thread(target=self._run, daemon=True, name=name).start()
+        atexit.register(self.close)
+    
+    def _enqueue(self, entry: Dict, critical: bool = True) -> bool:
+        """Mai bloccante: a buffer pieno l'evento viene scartato e contato"""
+        with self._lock:
+            size = len(self._buffer)
+            if size >= self.capacity or (not critical and size >= self.SOGLIA_PRESSIONE * self.capacity):
+                self.stats["scartati" if critical else "scartati_non_critici"] += 1
+                self._wake.set()
+                return False
+            self._buffer.append(entry)
+            self.stats["accodati"] += 1
+        if size + 1 >= self.batch:
+            self._wake.set()
+        return True
+    
+    def _write(self, lines: str):
+        """Scrive un lotto di righe JSONL (nel thread di scrittura)"""
+        raise NotImplementedError
+    
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+    
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._buffer.popleft() for _ in range(min(self.batch, len(self._buffer)))]
+                if not batch:
+                    return
+                lines = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n" for entry in batch)
+                try:
+                    self._write(lines)
+                except OSError:
+                    logging.getLogger("sindacato.registro").exception("Scrittura di %s non riuscita", type(self).__name__)
+                    with self._lock:
+                        self.stats["errori_scrittura"] += 1
+                        self.stats["scartati"] += len(batch)
+                    self._file = None
+                    return
+                with self._lock:
+                    self.stats["scritti"] += len(batch)
+                    self.stats["lotti"] += 1
+    
+    def pending(self) -> int:
+        return len(self._buffer)
+    
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TrafficRecorder(WriteBehindLog):
+    """Registro JSONL delle richieste: sessioni pseudonime, testi anonimizzati, documenti solo come lunghezza"""
+    
+    def __init__(self, path: str, **kwargs):
+        super().__init__(bool(path), **kwargs)
+        self.path = path
+        self._salt = uuid.uuid4().hex
+        if self.enabled:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._start("traffico")
+    
+    def _pseudonym(self, session: str) -> str:
+        return hashlib.sha256((self._salt + session).encode("utf-8")).hexdigest()[:12]
+    
+    def record(self, operation: str, params: Dict, duration: float, status: str = "ok"):
+        """Accoda la richiesta: la scrittura su disco avviene nel thread del registro"""
+        if not self.enabled:
+            return
+        entry = {"t": round(time.time(), 3), "op": operation, "sessione": self._pseudonym(SESSIONE_CORRENTE.get())}
+        for key, value in params.items():
+            if key in ("query", "question"):
+                entry["testo"] = anonimizza(value)
+            elif key == "text":
+                entry["caratteri"] = len(value)
+            elif value is not None:
+                entry[key] = anonimizza(value) if isinstance(value, str) else value
+        entry.update(durata_ms=round(duration * 1000, 1), esito=status)
+        self._enqueue(entry)
+    
+    def _write(self, lines: str):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(lines)
+        self._file.flush()
+
+
+class AuditLog(WriteBehindLog):
+    """Registro di audit write-behind: buffer circolare limitato, lotti JSONL compressi scritti da un thread"""
+    
+    def __init__(self, path: str, capacity: int = CAPACITA_BUFFER_AUDIT, batch: int = LOTTO_AUDIT,
+                 interval: float = INTERVALLO_FLUSH_AUDIT, max_bytes: int = MAX_BYTE_FILE_AUDIT,
+                 max_files: int = MAX_FILE_AUDIT):
+        super().__init__(bool(path), capacity, batch, interval)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.stats["file"] = 0
+        self._file_path = None
+        self._file_day = None
+        if self.enabled:
+            os.makedirs(path, exist_ok=True)
+            self._start("audit")
+    
+    def log(self, event: str, data: Dict, critical: bool = True) -> bool:
+        """Mai bloccante: sotto pressione si scartano prima gli eventi non critici (ricerche)"""
+        if not self.enabled:
+            return False
+        return self._enqueue({"evento": event, "t": round(time.time(), 3), "pid": os.getpid(), **data}, critical)
+    
+    def answer(self, question: str, model: str, mode: str, data_riferimento: Optional[int], trace: Dict,
+               response: Optional[str], sources: List[Dict], elapsed: float, error: Optional[str] = None):
+        """Evento di una risposta data: quale consiglio, su quali fonti, con quali tempi"""
+        self.log("risposta", {
+            "sessione": hashlib.sha256(SESSIONE_CORRENTE.get().encode("utf-8")).hexdigest()[:12],
+            "domanda_hash": hash_testo(" ".join(tokenizza(question))),
+            "modello": trace.get("modello", model),
+            "modalita": mode,
+            "data_riferimento": data_riferimento,
+            "esito": "errore" if error else trace.get("esito", "accorpata"),
+            # Risposta condivisa con una richiesta identica in corso: traccia della richiesta che l'ha calcolata
+            "accorpata": trace.get("accorpata", False),
+            "errore": error,
+            "recuperati": trace.get("recuperati", []),
+            "fonti": [{key: source.get(key) for key in ("categoria", "argomento", "articolo", "versioni") if source.get(key)}
+                      for source in sources],
+            "token_prompt": trace.get("token_prompt"),
+            "token_risposta": trace.get("token_risposta"),
+            "latenze_ms": {
+                "recupero": trace.get("recupero_ms"),
+                "llm": trace.get("llm_ms"),
+                "totale": round(elapsed * 1000, 1),
+            },
+            "risposta_hash": hash_testo(response) if response else None,
+            "risposta_caratteri": len(response) if response else 0,
+        })
+    
+    def _writer(self):
+        """File corrente, ruotato per dimensione e per giorno (un file per processo)"""
+        today = date.today()
+        if self._file is not None and (self._file_day != today or self._file.tell() >= self.max_bytes):
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            name = f"audit-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz"
+            self._file_path = os.path.join(self.path, name)
+            self._file = open(self._file_path, "ab")
+            self._file_day = today
+            self.stats["file"] += 1
+            # I file di questo processo e quelli dei processi terminati; quelli degli altri worker sono ancora aperti
+            files = sorted(f for f in os.listdir(self.path) if f.startswith("audit-") and f.endswith(".jsonl.gz")
+                           and not processo_altrui_attivo(f[:-len(".jsonl.gz")].rsplit("-", 1)[-1]))
+            for old in files[:max(len(files) - self.max_files, 0)]:
+                try:
+                    os.remove(os.path.join(self.path, old))
+                except FileNotFoundError:
+                    pass  # già cancellato da un altro worker
+        return self._file
+    
+    def _write(self, lines: str):
+        # Ogni lotto è un membro gzip accodato al file
+        writer = self._writer()
+        writer.write(gzip.compress(lines.encode("utf-8")))
+        writer.flush()
+
+
+def processo_altrui_attivo(pid: str) -> bool:
+    """Un altro processo con questo pid è in esecuzione (nel dubbio sì: i suoi file non si toccano)"""
+    if not pid.isdigit():
+        return True
+    if int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def recuperati(results: Dict) -> List[Dict]:
+    """Id e similarità dei documenti recuperati (per il registro di audit)"""
+    distances = (results.get("distances") or [[]])[0] or [None] * len(results["ids"][0])
+    return [{"id": doc_id, "score": round(1.0 - distance, 4) if distance is not None else None}
+            for doc_id, distance in zip(results["ids"][0], distances)]
+
+
+def crea_chroma_client():
+    """Client Chroma: server condiviso (CHROMA_HOST), su disco (CHROMA_PATH) o in memoria"""
+    if os.environ.get("CHROMA_HOST"):
+        return chromadb.HttpClient(
+            host=os.environ["CHROMA_HOST"],
+            port=int(os.environ.get("CHROMA_PORT", "8000"))
+        )
+    if os.environ.get("CHROMA_PATH"):
+        return chromadb.PersistentClient(path=os.environ["CHROMA_PATH"])
+    return chromadb.Client()
+
+
+def data_int(giorno: date) -> int:
+    return giorno.year * 10000 + giorno.month * 100 + giorno.day
+
+
+def giorno_prima(data: int) -> int:
+    giorno = date(data // 10000, data // 100 % 100, data % 100)
+    return data_int(giorno - timedelta(days=1))
+
+
+def filtro_validita(data_riferimento: Optional[int] = None) -> Dict:
+    """Filtro Chroma sui documenti in vigore alla data (oggi se non indicata)"""
+    data = data_riferimento or data_int(date.today())
+    return {"$and": [{"valido_dal": {"$lte": data}}, {"valido_al": {"$gte": data}}]}
+
+
+def in_vigore(meta: Dict, data_riferimento: Optional[int] = None) -> bool:
+    data = data_riferimento or data_int(date.today())
+    return meta.get("valido_dal", SEMPRE_VALIDO_DAL) <= data <= meta.get("valido_al", SEMPRE_VALIDO_AL)
+
+
+def hash_testo(text: str) -> str:
+    return hashlib.sha1(" ".join(text.split()).encode("utf-8")).hexdigest()[:16]
+
+
+def id_versione(contratto: str, versione: str, argomento: str) -> str:
+    """Id deterministico di un articolo di una versione di contratto (ricaricarla non lo duplica)"""
+    return f"ver_{hash_testo(contratto + versione + argomento)}"
+
+
+def parse_articoli(text: str) -> Dict[str, str]:
+    """Articoli di un contratto incollato come blocchi '### Titolo' seguiti dal testo"""
+    articoli = {}
+    for block in re.split(r"^###\s*", text, flags=re.MULTILINE):
+        title, _, body = block.strip().partition("\n")
+        if title.strip() and body.strip():
+            articoli[title.strip()] = " ".join(body.split())
+    return articoli
+
+
+def dividi_frasi(text: str) -> List[Tuple[int, int]]:
+    """Intervalli (inizio, fine) delle frasi, senza spezzare su abbreviazioni come "Art." o "D.Lgs." """
+    spans, start = [], 0
+    for match in re.finditer(r"[.;!?]\s+(?=[A-ZÀ-Ý«\"(])|\n\s*\n|\n(?=[ \t]*\d+[.)]\s)", text):
+        if match.group(0)[0] == ".":
+            word = re.search(r"(\w+)\.$", text[:match.start() + 1])
+            if word and (len(word.group(1)) == 1 or word.group(1).lower() in ABBREVIAZIONI):
+                continue
+        end = match.start() + 1 if match.group(0)[0] in ".;!?" else match.start()
+        if text[start:end].strip():
+            spans.append((start, end))
+        start = match.end()
+    if text[start:].strip():
+        spans.append((start, len(text.rstrip())))
+    return spans
+
+
+def dividi_articoli(text: str, max_chars: int = MAX_CARATTERI_PADRE) -> List[Tuple[str, str]]:
+    """Padri di un documento lungo: articoli ("Art. 12 ..."), divisi per commi (o frasi) se troppo lunghi"""
+    parents = []
+    for part in re.split(r"(?m)^(?=[ \t]*(?:Art\.|Articolo)\s*\d+)", text):
+        part = part.strip()
+        if not part:
+            continue
+        title = part.splitlines()[0].strip()[:80]
+        units = []
+        for comma in re.split(r"\n(?=[ \t]*\d+[.)]\s)|\n\s*\n", part):
+            if len(comma) > max_chars:
+                units.extend(comma[a:b] for a, b in dividi_frasi(comma))
+            elif comma.strip():
+                units.append(comma)
+        chunk = ""
+        for unit in units:
+            if chunk and len(chunk) + len(unit) > max_chars:
+                parents.append((title, chunk.strip()))
+                chunk = ""
+            chunk += unit.strip() + "\n"
+        if chunk.strip():
+            parents.append((title, chunk.strip()))
+    return parents
+
+
+def finestre_di_frasi(text: str) -> List[Tuple[int, int]]:
+    """Finestre di FRASI_PER_FINESTRA frasi consecutive, sovrapposte (passo PASSO_FINESTRA)"""
+    sentences = dividi_frasi(text)
+    if not sentences:
+        return []
+    starts = list(range(0, max(len(sentences) - FRASI_PER_FINESTRA, 0) + 1, PASSO_FINESTRA))
+    if starts[-1] + FRASI_PER_FINESTRA < len(sentences):
+        starts.append(len(sentences) - FRASI_PER_FINESTRA)
+    return [(sentences[i][0], sentences[min(i + FRASI_PER_FINESTRA, len(sentences)) - 1][1]) for i in starts]
+
+
+def espandi_finestre(parent: str, windows: List[Tuple[int, int]]) -> str:
+    """Small-to-big: le finestre si allargano di FRASI_DI_MARGINE frasi nel padre e si uniscono se sovrapposte"""
+    sentences = dividi_frasi(parent)
+    if not sentences:
+        return parent
+    starts = [a for a, _ in sentences]
+    intervals = sorted(
+        (max(bisect.bisect_right(starts, start) - 1 - FRASI_DI_MARGINE, 0),
+         min(bisect.bisect_right(starts, end - 1) - 1 + FRASI_DI_MARGINE, len(sentences) - 1))
+        for start, end in windows
+    )
+    merged = [list(intervals[0])]
+    for first, last in intervals[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    spans = [parent[sentences[first][0]:sentences[last][1]] for first, last in merged]
+    # Se le finestre coprono già gran parte dell'articolo conviene darlo intero
+    if sum(len(span) for span in spans) >= QUOTA_PADRE_INTERO * len(parent):
+        return parent
+    return " […] ".join(spans)
+
+
+def estrai_testo(file) -> str:
+    """Testo di un file caricato (PDF, DOCX o testo semplice)"""
+    name = file.name.lower()
+    if name.endswith(".pdf"):
+        from PyPDF2 import PdfReader
+        return "\n\n".join(page.extract_text() or "" for page in PdfReader(file).pages)
+    if name.endswith(".docx"):
+        import docx
+        return "\n\n".join(paragraph.text for paragraph in docx.Document(file).paragraphs)
+    return file.getvalue().decode("utf-8", errors="ignore")
+
+
+def migra_validita(collection):
+    """Documenti indicizzati prima del versionamento: sempre validi (altrimenti il filtro li escluderebbe)"""
+    data = collection.get(include=["metadatas"])
+    missing = [(doc_id, meta) for doc_id, meta in zip(data["ids"], data["metadatas"]) if "valido_al" not in meta]
+    if missing:
+        collection.update(
+            ids=[doc_id for doc_id, _ in missing],
+            metadatas=[dict(meta, valido_dal=SEMPRE_VALIDO_DAL, valido_al=SEMPRE_VALIDO_AL) for _, meta in missing]
+        )
+
+
+def estratto(text: str, query: str, limit: int = CARATTERI_ESTRATTO) -> str:
+    """La frase del documento con più parole della query, accorciata per l'anteprima"""
+    terms = set(tokenizza(query))
+    spans = dividi_frasi(text) or [(0, len(text))]
+    start, end = max(spans, key=lambda span: len(terms & set(tokenizza(text[span[0]:span[1]]))))
+    snippet = " ".join(text[start:end].split())
+    if len(snippet) > limit:
+        snippet = snippet[:limit].rsplit(" ", 1)[0] + " …"
+    return ("… " if start > 0 else "") + snippet
+
+
+def arco_correlato(doc_id: str, meta: Dict, score: float) -> Dict:
+    arco = {"id": doc_id, "categoria": meta.get("categoria", ""), "argomento": meta.get("argomento", ""),
+            "score": round(float(score), 4)}
+    if meta.get("articolo"):
+        arco["articolo"] = meta["articolo"]
+    return arco
+
+
+# Gli archi inversi sono una lettura-modifica-scrittura: serializzata nel processo, verificata tra processi
+_LOCK_CORRELATI = threading.Lock()
+
+
+def collega_correlati(collection, ids: List[str], embeddings: List[List[float]], k: int = CORRELATI_PER_ARTICOLO):
+    """Aggiornamento incrementale del grafo: vicini dei nuovi documenti, e i nuovi tra i vicini di quelli esistenti"""
+    if not ids or collection.count() < 2:
+        return
+    with _LOCK_CORRELATI:
+        _collega_correlati(collection, ids, embeddings, k)
+
+
+def _collega_correlati(collection, ids: List[str], embeddings: List[List[float]], k: int, tentativi: int = 3):
+    own = collection.get(ids=ids, include=["metadatas"])
+    metas = dict(zip(own["ids"], own["metadatas"]))
+    # Margine per scartare le finestre dello stesso articolo
+    nearest = collection.query(query_embeddings=embeddings, n_results=min(3 * k + 1, collection.count()),
+                               include=["metadatas", "distances"])
+    updates, reverse = {}, {}
+    for doc_id, other_ids, other_metas, distances in zip(ids, nearest["ids"], nearest["metadatas"], nearest["distances"]):
+        meta = metas[doc_id]
+        edges = []
+        for other_id, other_meta, distance in zip(other_ids, other_metas, distances):
+            if other_id == doc_id or (meta.get("parent_id") and other_meta.get("parent_id") == meta.get("parent_id")):
+                continue
+            edges.append(arco_correlato(other_id, other_meta, 1.0 - distance))
+            if other_id not in metas:
+                reverse.setdefault(other_id, []).append(arco_correlato(doc_id, meta, 1.0 - distance))
+            if len(edges) == k:
+                break
+        updates[doc_id] = {"correlati": json.dumps(edges, ensure_ascii=False)}
+    # update() fonde i metadati: si scrive solo "correlati", senza sovrascrivere altri campi letti prima
+    collection.update(ids=list(updates), metadatas=list(updates.values()))
+    
+    # Un altro processo può aggiornare gli stessi vicini nel frattempo: si rilegge e si riprova
+    # finché gli archi verso i nuovi documenti non risultano salvati
+    for _ in range(tentativi):
+        if not reverse:
+            break
+        existing = collection.get(ids=list(reverse), include=["metadatas"])
+        updates = {}
+        for doc_id, meta in zip(existing["ids"], existing["metadatas"]):
+            edges = {edge["id"]: edge for edge in json.loads(meta.get("correlati", "[]")) + reverse[doc_id]}
+            best = sorted(edges.values(), key=lambda edge: -edge["score"])[:k]
+            if best != json.loads(meta.get("correlati", "[]")):
+                updates[doc_id] = {"correlati": json.dumps(best, ensure_ascii=False)}
+        if not updates:
+            break
+        collection.update(ids=list(updates), metadatas=list(updates.values()))
+        reverse = {doc_id: reverse[doc_id] for doc_id in updates}
+
+
+def migra_correlati(collection, batch: int = 500):
+    """Documenti indicizzati prima del grafo dei correlati: vicini calcolati una volta sola"""
+    data = collection.get(include=["metadatas"])
+    missing = [doc_id for doc_id, meta in zip(data["ids"], data["metadatas"]) if "correlati" not in meta]
+    for start in range(0, len(missing), batch):
+        vectors = collection.get(ids=missing[start:start + batch], include=["embeddings"])
+        collega_correlati(collection, vectors["ids"], [list(map(float, v)) for v in vectors["embeddings"]])
+
+
+def correlati_unici(metas: List[Dict], exclude_ids: Tuple = (), limit: int = CORRELATI_PER_ARTICOLO,
+                    vigenti: Optional[set] = None) -> List[Dict]:
+    """Correlati di più risultati, senza gli articoli già mostrati e senza ripetere lo stesso articolo.
+
+    Con `vigenti` restano solo gli archi verso quei documenti (la validità cambia dopo il calcolo del grafo).
+    """
+    shown = set(exclude_ids) | {(meta.get("categoria"), meta.get("argomento"), meta.get("articolo", "")) for meta in metas}
+    edges = sorted(
+        (edge for meta in metas for edge in (
+            json.loads(meta["correlati"]) if isinstance(meta.get("correlati"), str) else meta.get("correlati", [])
+        )),
+        key=lambda edge: -edge["score"]
+    )
+    related = []
+    for edge in edges:
+        key = (edge["categoria"], edge["argomento"], edge.get("articolo", ""))
+        if edge["id"] in shown or key in shown or (vigenti is not None and edge["id"] not in vigenti):
+            continue
+        shown.update((edge["id"], key))
+        related.append(edge)
+    return related[:limit]
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def nome_collezione(modello: str) -> str:
+    """Una collection per modello di embedding (il modello iniziale usa il nome storico)"""
+    if modello == MODELLO_EMBEDDING:
+        return "school_docs"
+    slug = re.sub(r"[^a-z0-9]+", "_", modello.split("/")[-1].lower()).strip("_")[:40]
+    return f"school_docs__{slug}_{hashlib.sha1(modello.encode('utf-8')).hexdigest()[:6]}"
+
+
+def apri_collezione(client, nome: str):
+    try:
+        return client.get_collection(nome)
+    except Exception:
+        return client.create_collection(name=nome, metadata={"hnsw:space": "cosine"})
+
+
+def leggi_indice_attivo(client) -> Dict:
+    """Modello e collection in uso (registro condiviso da tutti i processi tramite Chroma)"""
+    registry = client.get_or_create_collection(COLLEZIONE_REGISTRO)
+    data = registry.get(ids=["attivo"], include=["metadatas"])
+    if data["ids"]:
+        return data["metadatas"][0]
+    return {"modello": MODELLO_EMBEDDING, "collezione": nome_collezione(MODELLO_EMBEDDING)}
+
+
+def testo_embedding(doc: str, meta: Dict) -> str:
+    """Testo da cui nasce il vettore: le finestre dei documenti lunghi portano il titolo dell'articolo"""
+    return f"{meta['articolo']}: {doc}" if meta.get("tipo") == "finestra" else doc
+
+
+def scrivi_indice_attivo(client, modello: str, collezione: str, precedente: Optional[Dict] = None):
+    """Scambio atomico: un solo record del registro punta alla collection attiva"""
+    metadata = {"modello": modello, "collezione": collezione, "aggiornato": datetime.now().isoformat()}
+    if precedente:
+        metadata.update(precedente_modello=precedente["modello"], precedente_collezione=precedente["collezione"])
+    client.get_or_create_collection(COLLEZIONE_REGISTRO).upsert(
+        ids=["attivo"], embeddings=[[0.0]], documents=[collezione], metadatas=[metadata]
+    )
+
+
+def leggi_generazione_metadati(client, collezione: str) -> str:
+    """Generazione dei metadati della collection: cambia a ogni modifica che non aggiunge documenti"""
+    data = client.get_or_create_collection(COLLEZIONE_REGISTRO).get(ids=[f"metadati:{collezione}"], include=["metadatas"])
+    return data["metadatas"][0]["generazione"] if data["ids"] else ""
+
+
+def nuova_generazione_metadati(client, collezione: str) -> str:
+    """Segnala agli altri processi metadati cambiati (validità chiusa, fonti aggiunte)"""
+    # Valore casuale, non un contatore: due processi che scrivono insieme non producono la stessa generazione
+    generazione = uuid.uuid4().hex[:12]
+    client.get_or_create_collection(COLLEZIONE_REGISTRO).upsert(
+        ids=[f"metadati:{collezione}"], embeddings=[[0.0]], documents=[collezione],
+        metadatas=[{"generazione": generazione, "aggiornato": datetime.now().isoformat()}]
+    )
+    return generazione
+
+
+def pubblica_snapshot(path: str, version_dir: str, keep: int = 2):
+    """Scambio atomico: `path` è un link simbolico spostato con un solo rename sulla nuova versione"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        # Snapshot scritto come cartella reale dalle versioni precedenti: spostato una volta sola
+        os.replace(path, f"{path}.v-0-precedente")
+    link = f"{path}.link-{uuid.uuid4().hex[:8]}"
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, path)
+    # Si tiene anche la versione precedente, per chi la sta ancora leggendo
+    parent, prefix = os.path.dirname(os.path.abspath(path)), f"{os.path.basename(path)}.v-"
+    versions = sorted(name for name in os.listdir(parent) if name.startswith(prefix))
+    current = os.path.basename(os.path.realpath(path))
+    for name in versions[:versions.index(current) + 1][:-keep]:
+        shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def load_snapshot(path: str, verify: bool = True, model: str = MODELLO_EMBEDDING):
+    """Legge uno snapshot: vettori (e scale int8) mappati in memoria, non copiati"""
+    # Tutti i file dalla stessa versione, anche se nel frattempo il link passa a una nuova
+    path = os.path.realpath(path)
+    with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["formato"] not in (1, FORMATO_SNAPSHOT):
+        raise ValueError(f"Formato snapshot non supportato: {manifest['formato']}")
+    if manifest["modello"] != model:
+        raise ValueError(f"Snapshot creato con un altro modello di embedding: {manifest['modello']}")
+    if verify:
+        for name, checksum in manifest["checksum"].items():
+            if file_sha256(os.path.join(path, name)) != checksum:
+                raise ValueError(f"Checksum non valido per {name}: snapshot corrotto")
+    
+    vectors = np.load(os.path.join(path, "vettori.npy"), mmap_mode="r")
+    # int8: la scala si applica a lotti durante l'importazione, senza materializzare tutti i vettori
+    scales = np.load(os.path.join(path, "scale.npy"), mmap_mode="r") if manifest["dtype"] == "int8" else None
+    with open(os.path.join(path, "documenti.json"), encoding="utf-8") as f:
+        documents = json.load(f)
+    with open(os.path.join(path, "lessicale.json"), encoding="utf-8") as f:
+        lexical = json.load(f)
+    if manifest["formato"] == 1:
+        # Snapshot precedente al versionamento dei contratti: tutto sempre valido, come migra_validita
+        validity = {"valido_dal": SEMPRE_VALIDO_DAL, "valido_al": SEMPRE_VALIDO_AL}
+        documents["metadatas"] = [dict(validity, **meta) for meta in documents["metadatas"]]
+        for doc in lexical.get("docs", {}).values():
+            for key, value in validity.items():
+                doc.setdefault(key, value)
+    return manifest, vectors, scales, documents, lexical
+
+
 class SchoolUnionAssistant:
     def __init__(self, groq_api_key: str):
         """Inizializza l'assistente sindacale scuola"""
-        self.client = Groq(api_key=groq_api_key)
+        self.client = get_local_llm() if LLM_LOCALE else Groq(api_key=groq_api_key)
         
-        if 'embedding_model' not in st.session_state:
-            with st.spinner('⚙️ Inizializzazione sistema...'):
-                st.session_state.embedding_model = SentenceTransformer(
-                    'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
-                )
-        self.embedding_model = st.session_state.embedding_model
+        self.chroma_client = get_chroma_client()
+        self._use_index(leggi_indice_attivo(self.chroma_client))
+        # Testi dei padri (articoli) dell'indice gerarchico: letti per id, embedding fittizio
+        self.parents = self.chroma_client.get_or_create_collection(COLLEZIONE_PADRI)
+        self.router = get_model_router()
+        self.lexical_index = get_lexical_index()
+        self.query_expander = get_query_expander()
+        self.fact_index = get_fact_index()
+        self.singleflight = get_singleflight()
+        self.compact_index = get_compact_index() if INDICE_COMPATTO else None
+        self.shard_index = get_shard_index() if INDICE_SHARD else None
+        self.breaker = get_circuit_breaker()
+        self.extractive = ExtractiveAnswerer()
+        self._version_memo = (0.0, None)
+    
+    def _use_index(self, active: Dict):
+        """Modello e collection attivi (letti dal registro a ogni esecuzione dello script)"""
+        self.model_name = active["modello"]
+        with st.spinner('⚙️ Inizializzazione sistema...'):
+            self.embedding_model = get_embedding_model(self.model_name)
+        collections = get_collection_cache()
+        if active["collezione"] not in collections:
+            collections[active["collezione"]] = apri_collezione(self.chroma_client, active["collezione"])
+            migra_validita(collections[active["collezione"]])
+            migra_correlati(collections[active["collezione"]])
+        self.collection = collections[active["collezione"]]
+    
+    def refresh_index(self) -> bool:
+        """Per i processi di lunga durata (API): segue lo scambio o il rollback dell'indice"""
+        active = leggi_indice_attivo(self.chroma_client)
+        if active["collezione"] == self.collection.name:
+            return False
+        self._use_index(active)
+        return True
+    
+    def preload_contracts(self):
+        """Precarica le normative scolastiche (da snapshot se disponibile)"""
+        if self.collection.count() > 0:
+            return False
+        
+        if SNAPSHOT_DIR and os.path.exists(os.path.join(SNAPSHOT_DIR, "manifest.json")):
+            self.import_snapshot(SNAPSHOT_DIR)
+            return True
+        
+        all_docs = []
+        all_metadata = []
+        
+        for categoria, contenuti in NORMATIVE_SCUOLA.items():
+            contratto, versione, valido_dal = VERSIONI_CONTRATTI.get(categoria, (categoria, "", SEMPRE_VALIDO_DAL))
+            for item in contenuti:
+                all_docs.append(f"{item['argomento']}: {item['contenuto']}")
+                all_metadata.append({
+                    "categoria": categoria,
+                    "argomento": item['argomento'],
+                    "contratto": contratto,
+                    "versione": versione,
+                    "versioni": versione,
+                    "valido_dal": valido_dal,
+                    "valido_al": SEMPRE_VALIDO_AL,
+                    "hash_testo": hash_testo(item['contenuto']),
+                    "simhash": format(simhash(all_docs[-1]), "016x"),
+                    "data_caricamento": datetime.now().isoformat()
+                })
+        
+        embeddings = self.embedding_model.encode(all_docs).tolist()
+        ids = [f"doc_{i}" for i in range(len(all_docs))]
+        
+        self.collection.add(
+            embeddings=embeddings,
+            documents=all_docs,
+            ids=ids,
+            metadatas=all_metadata
+        )
+        collega_correlati(self.collection, ids, embeddings)
+        
+        return True
+    
+    def export_snapshot(self, path: str, dtype: str = "float16") -> Dict:
+        """Esporta vettori, documenti, metadati e indice lessicale in uno snapshot versionato"""
+        data = self.collection.get(include=["embeddings", "documents", "metadatas"])
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        
+        # Ogni esportazione scrive una versione nuova in una cartella vuota, accanto a `path`
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=f"{os.path.basename(path)}.v-{datetime.now():%Y%m%d%H%M%S%f}-", dir=parent)
+        if dtype == "int8":
+            # Quantizzazione scalare simmetrica con una scala per vettore
+            scales = np.maximum(np.abs(vectors).max(axis=1, keepdims=True), 1e-12) / 127.0
+            np.save(os.path.join(tmp_path, "vettori.npy"), np.round(vectors / scales).astype(np.int8))
+            np.save(os.path.join(tmp_path, "scale.npy"), scales.astype(np.float32))
+        else:
+            np.save(os.path.join(tmp_path, "vettori.npy"), vectors.astype(np.float16))
+        with open(os.path.join(tmp_path, "documenti.json"), "w", encoding="utf-8") as f:
+            json.dump({"ids": data["ids"], "documents": data["documents"], "metadatas": data["metadatas"]},
+                      f, ensure_ascii=False, separators=(",", ":"))
+        parents = self.parents.get(include=["documents", "metadatas"])
+        if parents["ids"]:
+            with open(os.path.join(tmp_path, "padri.json"), "w", encoding="utf-8") as f:
+                json.dump({"ids": parents["ids"], "documents": parents["documents"], "metadatas": parents["metadatas"]},
+                          f, ensure_ascii=False, separators=(",", ":"))
+        self.sync_indexes()
+        with open(os.path.join(tmp_path, "lessicale.json"), "w", encoding="utf-8") as f:
+            json.dump(self.lexical_index.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+        
+        manifest = {
+            "formato": FORMATO_SNAPSHOT,
+            "creato": datetime.now().isoformat(),
+            "modello": self.model_name,
+            "documenti": len(data["ids"]),
+            "dimensione": int(vectors.shape[1]) if len(vectors) else 0,
+            "dtype": dtype,
+            "corpus_version": self.corpus_version(),
+            "checksum": {
+                name: file_sha256(os.path.join(tmp_path, name))
+                for name in sorted(os.listdir(tmp_path))
+            }
+        }
+        with open(os.path.join(tmp_path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        
+        pubblica_snapshot(path, tmp_path)
+        return manifest
+    
+    def import_snapshot(self, path: str, verify: bool = True) -> Dict:
+        """Carica uno snapshot nella collection senza calcolare embedding
+        
+        Si evita solo il modello di embedding: Chroma costruisce comunque l'indice HNSW
+        all'inserimento, con un tempo che cresce con il corpus.
+        """
+        start_time = time.perf_counter()
+        manifest, vectors, scales, documents, lexical = load_snapshot(path, verify=verify, model=self.model_name)
+        
+        batch_size = 5000
+        for start in range(0, len(documents["ids"]), batch_size):
+            end = start + batch_size
+            batch = np.asarray(vectors[start:end], dtype=np.float32)
+            if scales is not None:
+                batch *= scales[start:end]
+            self.collection.add(
+                embeddings=batch.tolist(),
+                documents=documents["documents"][start:end],
+                ids=documents["ids"][start:end],
+                metadatas=documents["metadatas"][start:end]
+            )
+        
+        # Articoli dei documenti lunghi (già verificati con il checksum del manifest)
+        if os.path.exists(os.path.join(path, "padri.json")):
+            with open(os.path.join(path, "padri.json"), encoding="utf-8") as f:
+                parents = json.load(f)
+            self.parents.upsert(ids=parents["ids"], documents=parents["documents"], metadatas=parents["metadatas"],
+                                embeddings=[[0.0]] * len(parents["ids"]))
+        
+        self.lexical_index.load(lexical, manifest["corpus_version"])
+        logging.getLogger("sindacato.snapshot").info(
+            "Snapshot %s importato: %d documenti in %.1fs", path, manifest["documenti"], time.perf_counter() - start_time
+        )
+        return manifest
+    
+    def corpus_version(self) -> str:
+        """Impronta del corpus indicizzato: cambia a ogni documento aggiunto, a ogni modifica dei metadati
+        (articoli chiusi o abrogati) e a ogni cambio di indice"""
+        ids = self.collection.get(include=[])["ids"]
+        generation = leggi_generazione_metadati(self.chroma_client, self.collection.name)
+        return hashlib.sha1("\n".join([self.collection.name, generation] + sorted(ids)).encode("utf-8")).hexdigest()[:12]
+    
+    def current_version(self) -> str:
+        """corpus_version riletta al massimo ogni VALIDITA_VERSIONE_CORPUS secondi"""
+        checked, version = self._version_memo
+        if version is None or time.monotonic() - checked >= VALIDITA_VERSIONE_CORPUS:
+            version = self.corpus_version()
+            self._version_memo = (time.monotonic(), version)
+        return version
+    
+    def _metadata_changed(self):
+        # Gli indici di questo processo sono già aggiornati: solo gli altri processi devono rileggere
+        self.lexical_index.metadata_generation = nuova_generazione_metadati(self.chroma_client, self.collection.name)
+        self._version_memo = (0.0, None)
+    
+    def find_duplicate(self, text: str, embedding: List[float]) -> Optional[Tuple[str, Dict]]:
+        """Chunk già presente quasi identico al testo (SimHash o similarità del vettore)"""
+        if self.collection.count() == 0:
+            return None
+        # Solo chunk mai chiusi: un caricamento collegato a un articolo abrogato sparirebbe con lui
+        nearest = self.collection.query(
+            query_embeddings=[embedding],
+            n_results=3,
+            where={"valido_al": SEMPRE_VALIDO_AL},
+            include=["metadatas", "distances"]
+        )
+        fingerprint = simhash(text)
+        for doc_id, meta, distance in zip(nearest['ids'][0], nearest['metadatas'][0], nearest['distances'][0]):
+            similar_text = "simhash" in meta and hamming(fingerprint, int(meta["simhash"], 16)) <= SOGLIA_HAMMING_DUPLICATI
+            if similar_text or 1.0 - distance >= SOGLIA_SIMILARITA_DUPLICATI:
+                return doc_id, meta
+        return None
+    
+    @registra_traffico("ingest")
+    def add_custom_content(self, text: str, categoria: str, argomento: str) -> Tuple[str, bool]:
+        """Aggiungi contenuto personalizzato (i quasi duplicati vengono collegati al chunk esistente)"""
+        # Scrive sempre nell'indice attivo, anche subito dopo uno scambio fatto da un altro processo
+        self.refresh_index()
+        if len(text) > SOGLIA_DOCUMENTO_LUNGO:
+            return self._add_long_document(text, categoria, argomento)
+        embeddings = self.embedding_model.encode([text]).tolist()
+        
+        duplicate = self.find_duplicate(text, embeddings[0])
+        if duplicate:
+            doc_id, meta = duplicate
+            fonti = json.loads(meta.get("fonti_duplicate", "[]"))
+            fonti.append({
+                "categoria": categoria,
+                "argomento": argomento,
+                "data_caricamento": datetime.now().isoformat()
+            })
+            self.collection.update(
+                ids=[doc_id],
+                metadatas=[dict(meta, fonti_duplicate=json.dumps(fonti, ensure_ascii=False), n_duplicati=len(fonti))]
+            )
+            self._metadata_changed()
+            return doc_id, True
+        
+        # Id univoco anche con più processi sulla stessa Chroma (add ignora in silenzio un id già presente)
+        doc_id = f"custom_{uuid.uuid4().hex}"
+        metadata = {
+            "categoria": categoria,
+            "argomento": argomento,
+            "tipo": "personalizzato",
+            "valido_dal": SEMPRE_VALIDO_DAL,
+            "valido_al": SEMPRE_VALIDO_AL,
+            "simhash": format(simhash(text), "016x"),
+            "data_caricamento": datetime.now().isoformat()
+        }
+        
+        self.collection.add(
+            embeddings=embeddings,
+            documents=[text],
+            ids=[doc_id],
+            metadatas=[metadata]
+        )
+        self._index_added([doc_id], [text], [metadata], embeddings)
+        return doc_id, False
+    
+    def _add_long_document(self, text: str, categoria: str, argomento: str) -> Tuple[str, bool]:
+        """Documento lungo (es. PDF): finestre di frasi indicizzate, articoli salvati come padri"""
+        document_hash = hash_testo(text)
+        existing = self.collection.get(where={"hash_documento": document_hash}, limit=1, include=["metadatas"])
+        if existing["ids"]:
+            return existing["metadatas"][0]["documento"], True
+        
+        base_id = f"custom_{uuid.uuid4().hex}"
+        parent_ids, parent_docs, parent_metas = [], [], []
+        ids, docs, metadatas = [], [], []
+        for i, (titolo, parent) in enumerate(dividi_articoli(text)):
+            parent_id = f"{base_id}_p{i}"
+            parent_ids.append(parent_id)
+            parent_docs.append(parent)
+            parent_metas.append({"documento": base_id, "categoria": categoria, "argomento": argomento, "articolo": titolo})
+            for j, (start, end) in enumerate(finestre_di_frasi(parent)):
+                ids.append(f"{parent_id}_f{j}")
+                docs.append(parent[start:end])
+                metadatas.append({
+                    "categoria": categoria,
+                    "argomento": argomento,
+                    "articolo": titolo,
+                    "tipo": "finestra",
+                    "documento": base_id,
+                    "hash_documento": document_hash,
+                    "parent_id": parent_id,
+                    "inizio": start,
+                    "fine": end,
+                    "valido_dal": SEMPRE_VALIDO_DAL,
+                    "valido_al": SEMPRE_VALIDO_AL,
+                    "simhash": format(simhash(docs[-1]), "016x"),
+                    "data_caricamento": datetime.now().isoformat()
+                })
+        if not ids:
+            raise ValueError("Nessuna frase trovata nel documento")
+        
+        self.parents.add(ids=parent_ids, documents=parent_docs, metadatas=parent_metas,
+                         embeddings=[[0.0]] * len(parent_ids))
+        # Il titolo dell'articolo dà contesto all'embedding della finestra
+        embeddings = self.embedding_model.encode(
+            [testo_embedding(doc, meta) for doc, meta in zip(docs, metadatas)]
+        ).tolist()
+        for start in range(0, len(ids), 5000):
+            end = start + 5000
+            self.collection.add(ids=ids[start:end], documents=docs[start:end],
+                                metadatas=metadatas[start:end], embeddings=embeddings[start:end])
+        self._index_added(ids, docs, metadatas, embeddings)
+        return base_id, False
+    
+    def _index_added(self, ids: List[str], docs: List[str], metadatas: List[Dict], embeddings: List[List[float]]):
+        """Collega i documenti appena aggiunti al grafo dei correlati e allinea gli indici in memoria"""
+        self._version_memo = (0.0, None)
+        collega_correlati(self.collection, ids, embeddings)
+        for doc_id, doc, meta in zip(ids, docs, metadatas):
+            self.lexical_index.add(doc_id, doc, meta)
+            self.fact_index.add(doc_id, doc, meta)
+        if self.compact_index is not None:
+            self.compact_index.add(ids, np.asarray(embeddings, dtype=np.float32), metadatas)
+        if self.shard_index is not None and self.shard_index.version is not None:
+            self.shard_index.add(ids, embeddings, metadatas)
+    
+    def ingest_contract_version(self, contratto: str, versione: str, valido_dal: int,
+                                articoli: Dict[str, str], categoria: Optional[str] = None) -> Dict[str, List[str]]:
+        """Nuova versione di un contratto: confronto articolo per articolo, embedding solo dei cambiati"""
+        self.refresh_index()
+        categoria = categoria or f"{contratto} {versione}"
+        current = self.collection.get(
+            where={"$and": [
+                {"contratto": contratto},
+                {"valido_dal": {"$lt": valido_dal}},
+                {"valido_al": {"$gte": valido_dal}}
+            ]},
+            include=["metadatas"]
+        )
+        in_force = {meta["argomento"]: (doc_id, meta) for doc_id, meta in zip(current["ids"], current["metadatas"])}
+        # Versione già caricata (stessi id deterministici): si ricaricano solo gli articoli cambiati
+        loaded = self.collection.get(ids=[id_versione(contratto, versione, argomento) for argomento in articoli],
+                                     include=["metadatas"])
+        loaded = {meta["argomento"]: meta for meta in loaded["metadatas"]}
+        
+        report = {"invariati": [], "modificati": [], "nuovi": [], "abrogati": []}
+        # Validità cambiata: articoli chiusi (modificati o abrogati) o riaperti
+        unchanged_ids, unchanged_metas, validity_ids, validity_metas = [], [], [], []
+        to_embed = []
+        
+        for argomento, contenuto in articoli.items():
+            old = in_force.get(argomento)
+            if argomento in loaded and loaded[argomento].get("hash_testo") == hash_testo(contenuto):
+                meta = loaded[argomento]
+                if meta.get("valido_al", SEMPRE_VALIDO_AL) < valido_dal:
+                    # Tolto da un caricamento precedente della stessa versione e ora di nuovo presente
+                    validity_ids.append(id_versione(contratto, versione, argomento))
+                    validity_metas.append(dict(meta, valido_al=SEMPRE_VALIDO_AL))
+                report["invariati"].append(argomento)
+                continue
+            if old and old[1].get("hash_testo") == hash_testo(contenuto):
+                # Stesso testo: il chunk esistente resta valido anche per la nuova versione
+                doc_id, meta = old
+                versioni = [v for v in meta.get("versioni", "").split(",") if v]
+                if versione not in versioni:
+                    unchanged_ids.append(doc_id)
+                    unchanged_metas.append(dict(meta, versioni=",".join(versioni + [versione])))
+                report["invariati"].append(argomento)
+                continue
+            if old:
+                validity_ids.append(old[0])
+                validity_metas.append(dict(old[1], valido_al=giorno_prima(valido_dal)))
+                report["modificati"].append(argomento)
+            elif argomento in loaded:
+                report["modificati"].append(argomento)
+            else:
+                report["nuovi"].append(argomento)
+            to_embed.append((argomento, contenuto))
+        
+        # Abrogati: articoli in vigore di una versione precedente e, ricaricando la stessa versione,
+        # articoli di questa versione che non sono più nel testo
+        same_version = self.collection.get(
+            where={"$and": [
+                {"contratto": contratto},
+                {"versione": versione},
+                {"valido_al": {"$gte": valido_dal}}
+            ]},
+            include=["metadatas"]
+        )
+        removed = list(in_force.values()) + list(zip(same_version["ids"], same_version["metadatas"]))
+        for doc_id, meta in removed:
+            if meta["argomento"] not in articoli:
+                validity_ids.append(doc_id)
+                validity_metas.append(dict(meta, valido_al=giorno_prima(valido_dal)))
+                report["abrogati"].append(meta["argomento"])
+        
+        if unchanged_ids or validity_ids:
+            self.collection.update(ids=unchanged_ids + validity_ids, metadatas=unchanged_metas + validity_metas)
+            self._metadata_changed()
+        for doc_id, meta in zip(validity_ids, validity_metas):
+            self.lexical_index.update_metadata(doc_id, meta)
+            self.fact_index.update_metadata(doc_id, meta)
+            if self.compact_index is not None:
+                self.compact_index.update_validity(doc_id, meta)
+            if self.shard_index is not None:
+                self.shard_index.update_validity(doc_id, meta)
+        
+        if to_embed:
+            docs = [f"{argomento}: {contenuto}" for argomento, contenuto in to_embed]
+            embeddings = self.embedding_model.encode(docs).tolist()
+            ids = [id_versione(contratto, versione, argomento) for argomento, _ in to_embed]
+            metadatas = [{
+                "categoria": categoria,
+                "argomento": argomento,
+                "contratto": contratto,
+                "versione": versione,
+                "versioni": versione,
+                "valido_dal": valido_dal,
+                "valido_al": SEMPRE_VALIDO_AL,
+                "hash_testo": hash_testo(contenuto),
+                "simhash": format(simhash(doc), "016x"),
+                "data_caricamento": datetime.now().isoformat()
+            } for (argomento, contenuto), doc in zip(to_embed, docs)]
+            self.collection.upsert(embeddings=embeddings, documents=docs, ids=ids, metadatas=metadatas)
+            self._index_added(ids, docs, metadatas, embeddings)
+        
+        return report
+    
+    def _flight_key(self, operation: str, text: str, *extra) -> tuple:
+        return (operation, " ".join(tokenizza(text)), self.current_version()) + extra
+    
+    @registra_traffico("search")
+    def search_content(self, query: str, n_results: int = 4, diversify: bool = True,
+                       data_riferimento: Optional[int] = None):
+        """Cerca contenuti rilevanti in vigore alla data (ricerche identiche in corso vengono accorpate)"""
+        return self.singleflight.do(
+            self._flight_key("search", query, n_results, diversify, data_riferimento),
+            lambda: self._search_content(query, n_results, diversify, data_riferimento)
+        )
+    
+    def _search_content(self, query: str, n_results: int, diversify: bool, data_riferimento: Optional[int]):
+        start = time.perf_counter()
+        results = self._retrieve(query, n_results, diversify, data_riferimento)
+        self._audit_retrieval(query, data_riferimento, results, start)
+        # Durante una migrazione del modello, parte delle ricerche viene ripetuta sull'indice ombra
+        get_index_migration().observe(self, query, n_results, data_riferimento)
+        return results
+    
+    @staticmethod
+    def _audit_retrieval(query: str, data_riferimento: Optional[int], results: Dict, start: float):
+        # Evento non critico: sotto pressione il registro lo scarta per primo
+        get_audit_log().log("recupero", {
+            "query_hash": hash_testo(" ".join(tokenizza(query))),
+            "data_riferimento": data_riferimento,
+            "recuperati": recuperati(results),
+            "ms": round((time.perf_counter() - start) * 1000, 1),
+        }, critical=False)
+    
+    @registra_traffico("search_page")
+    def search_page(self, query: str, cursor: Optional[str] = None, page_size: int = RISULTATI_PER_PAGINA,
+                    data_riferimento: Optional[int] = None) -> Dict:
+        """Una pagina di risultati (solo estratti) e il cursore della successiva; il testo completo con get_documents"""
+        cursors = get_search_cursors()
+        # Versione del corpus (come in _flight_key): cambia anche con la validità, non solo con il numero di documenti
+        key = SearchCursors.key(query, data_riferimento, self.current_version())
+        offset, restarted = 0, False
+        if cursor:
+            cursor_key, _, position = cursor.partition(".")
+            if not position.isdigit():
+                raise ValueError(f"Cursore non valido: {cursor}")
+            # Corpus cambiato dalla prima pagina: la classifica riparte dall'inizio
+            offset, restarted = (int(position), False) if cursor_key == key else (0, True)
+        
+        hits = cursors.get(key)
+        if hits is None:
+            hits = self.singleflight.do(("ranking", key), lambda: self._rank_candidates(query, data_riferimento))
+            cursors.put(key, hits)
+        end = offset + max(page_size, 1)
+        return {
+            "risultati": hits[offset:end],
+            "totale": len(hits),
+            "inizio": offset,
+            "cursore": f"{key}.{end}" if end < len(hits) else None,
+            "riavviata": restarted,
+        }
+    
+    def _rank_candidates(self, query: str, data_riferimento: Optional[int]) -> List[Dict]:
+        """Classifica leggera dei candidati: un risultato per articolo, metadati essenziali ed estratto"""
+        start = time.perf_counter()
+        results = self._retrieve(query, MAX_CANDIDATI_RICERCA, False, data_riferimento)
+        self._audit_retrieval(query, data_riferimento, results, start)
+        hits, seen = [], set()
+        for doc_id, doc, meta, distance in zip(results["ids"][0], results["documents"][0],
+                                               results["metadatas"][0], results["distances"][0]):
+            # Le finestre dello stesso articolo sono un solo risultato (la più vicina)
+            parent = meta.get("parent_id", doc_id)
+            if parent in seen:
+                continue
+            seen.add(parent)
+            hits.append({
+                "id": doc_id,
+                "categoria": meta.get("categoria", ""),
+                "argomento": meta.get("argomento", ""),
+                "articolo": meta.get("articolo"),
+                "tipo": meta.get("tipo", "precaricato"),
+                "score": round(1.0 - distance, 4),
+                "estratto": estratto(doc, query),
+            })
+        return hits
+    
+    def _retrieve(self, query: str, n_results: int, diversify: bool, data_riferimento: Optional[int]):
+        """Ricerca vettoriale con espansione della query (e selezione MMR per evitare passaggi ripetuti)"""
+        rewrites = self.query_expander.expand(query)
+        # Un solo batch di embedding per la query e le sue riscritture
+        embeddings = self.embedding_model.encode(rewrites).tolist()
+        query_embedding = embeddings[:1]
+        
+        if not diversify:
+            return self._multi_query(embeddings, n_results, False, data_riferimento)
+        
+        results = self._multi_query(embeddings, n_results * 3, True, data_riferimento)
+        if len(results['ids'][0]) <= 1:
+            results.pop('embeddings', None)
+            return results
+        
+        selected = mmr_select(np.asarray(query_embedding[0]), np.asarray(results['embeddings'][0]), n_results)
+        return {
+            key: [[results[key][0][i] for i in selected]]
+            for key in ("ids", "documents", "metadatas", "distances")
+        }
+    
+    def _multi_query(self, embeddings: List[List[float]], n_results: int, with_embeddings: bool,
+                     data_riferimento: Optional[int]):
+        """Query vettoriali in parallelo per ogni riscrittura, fuse con RRF entro il limite di latenza"""
+        if len(embeddings) == 1:
+            self.query_expander.record(False)
+            return self._vector_query(embeddings, n_results, with_embeddings, data_riferimento)
+        
+        submitted = [
+            self.query_expander.submit(self._vector_query, [embedding], n_results, with_embeddings, data_riferimento)
+            for embedding in embeddings[1:]
+        ]
+        futures = [future for future in submitted if future is not None]
+        original = self._vector_query(embeddings[:1], n_results, with_embeddings, data_riferimento)
+        ready = time.perf_counter()
+        done, pending = wait(futures, timeout=LATENZA_MASSIMA_ESPANSIONE)
+        # Le riscritture non ancora partite non servono più: non occupano il pool
+        for future in pending:
+            future.cancel()
+        rewritten = [future.result() for future in futures if future in done and future.exception() is None]
+        fused = rrf_fuse([original] + rewritten, n_results)
+        self.query_expander.record(True, len(submitted) - len(rewritten), time.perf_counter() - ready)
+        return fused
+    
+    def _vector_query(self, query_embedding: List[List[float]], n_results: int, with_embeddings: bool = False,
+                      data_riferimento: Optional[int] = None):
+        """Top-k vettoriale: Chroma, oppure indice compatto int8 con rescoring"""
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if with_embeddings else [])
+        
+        def chroma_query():
+            return self.collection.query(
+                query_embeddings=query_embedding,
+                n_results=n_results,
+                where=filtro_validita(data_riferimento),
+                include=include
+            )
+        
+        if self.shard_index is not None and self.shard_index.version is not None:
+            return self._shard_query(query_embedding, n_results, with_embeddings, data_riferimento) or chroma_query()
+        
+        if self.compact_index is None or self.compact_index.version is None:
+            return chroma_query()
+        
+        # Codici int8 e rescoring sui float16 dell'indice: da Chroma solo testi e metadati
+        hits = self.compact_index.search(np.asarray(query_embedding[0], dtype=np.float32), n_results, data_riferimento)
+        return self._results_from_hits(hits, with_embeddings, self.compact_index.vectors) if hits else chroma_query()
+    
+    def _shard_query(self, query_embedding: List[List[float]], n_results: int, with_embeddings: bool,
+                     data_riferimento: Optional[int]) -> Optional[Dict]:
+        """Top-k globale dagli shard; testi e metadati letti da Chroma"""
+        hits = self.shard_index.search(
+            np.asarray(query_embedding[0], dtype=np.float32), n_results, data_riferimento or data_int(date.today())
+        )
+        if not hits:
+            return None
+        return self._results_from_hits(hits, with_embeddings)
+    
+    def _results_from_hits(self, hits: List[Tuple[str, float]], with_embeddings: bool, vectors=None) -> Dict:
+        """Risultati nel formato di collection.query; i vettori da `vectors(ids)` o, se manca, da Chroma"""
+        include = ["documents", "metadatas"] + (["embeddings"] if with_embeddings and vectors is None else [])
+        data = self.collection.get(ids=[doc_id for doc_id, _ in hits], include=include)
+        rows = {doc_id: i for i, doc_id in enumerate(data["ids"])}
+        hits = [(doc_id, score) for doc_id, score in hits if doc_id in rows]
+        results = {
+            "ids": [[doc_id for doc_id, _ in hits]],
+            "documents": [[data["documents"][rows[doc_id]] for doc_id, _ in hits]],
+            "metadatas": [[data["metadatas"][rows[doc_id]] for doc_id, _ in hits]],
+            "distances": [[1.0 - score for _, score in hits]],
+        }
+        if with_embeddings:
+            results["embeddings"] = [list(vectors([doc_id for doc_id, _ in hits])) if vectors is not None else
+                                     [data["embeddings"][rows[doc_id]] for doc_id, _ in hits]]
+        return results
+    
+    def sync_indexes(self, corpus_version: Optional[str] = None):
+        """Allinea gli indici in memoria (lessicale, compatto, shard) alla collection"""
+        if self.refresh_index():
+            corpus_version = None
+        corpus_version = corpus_version or self.corpus_version()
+        self._sync_metadata()
+        self.lexical_index.sync(self.collection, corpus_version)
+        self.query_expander.sync(self.collection, corpus_version)
+        self.fact_index.sync(self.collection, corpus_version)
+        if self.compact_index is not None:
+            self.compact_index.sync(self.collection, corpus_version, self.model_name)
+        if self.shard_index is not None:
+            self.shard_index.sync(self.collection, corpus_version)
+    
+    def _sync_metadata(self):
+        """Validità cambiata da un altro processo (stessi documenti, nuova generazione dei metadati)"""
+        generation = leggi_generazione_metadati(self.chroma_client, self.collection.name)
+        if generation == self.lexical_index.metadata_generation:
+            return
+        if self.lexical_index.docs:
+            data = self.collection.get(include=["metadatas"])
+            for doc_id, meta in zip(data["ids"], data["metadatas"]):
+                known = self.lexical_index.docs.get(doc_id)
+                if known is None or (known["valido_dal"], known["valido_al"]) == (
+                        meta.get("valido_dal", SEMPRE_VALIDO_DAL), meta.get("valido_al", SEMPRE_VALIDO_AL)):
+                    continue
+                self.lexical_index.update_metadata(doc_id, meta)
+                self.fact_index.update_metadata(doc_id, meta)
+                if self.compact_index is not None:
+                    self.compact_index.update_validity(doc_id, meta)
+                if self.shard_index is not None and self.shard_index.version is not None:
+                    self.shard_index.update_validity(doc_id, meta)
+        self.lexical_index.metadata_generation = generation
+    
+    def count(self) -> int:
+        return self.collection.count()
+    
+    def get_documents(self, ids: List[str]) -> Dict:
+        """Documenti per id (lettura diretta, senza embedding né ricerca); per le finestre l'articolo intero"""
+        data = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        # Come expand_context: una finestra di documento lungo si mostra con il testo dell'articolo padre
+        parent_ids = list(dict.fromkeys(meta["parent_id"] for meta in data["metadatas"] if meta.get("parent_id")))
+        if parent_ids:
+            stored = self.parents.get(ids=parent_ids, include=["documents"])
+            parents = dict(zip(stored["ids"], stored["documents"]))
+            data["documents"] = [parents.get(meta.get("parent_id"), doc)
+                                 for doc, meta in zip(data["documents"], data["metadatas"])]
+        return data
+    
+    def suggest(self, query: str, limit: int = 6, data_riferimento: Optional[int] = None) -> List[Dict]:
+        """Suggerimenti lessicali istantanei"""
+        return self.lexical_index.search(query, limit=limit, data_riferimento=data_riferimento)
+    
+    def complete_query(self, query: str) -> str:
+        return self.lexical_index.complete(query)
+    
+    def expand_context(self, results: Dict) -> List[Tuple[str, Dict]]:
+        """Contesto small-to-big: le finestre dello stesso articolo diventano un solo estratto, nell'ordine di rilevanza"""
+        docs, metas = results['documents'][0], results['metadatas'][0]
+        parent_ids = list(dict.fromkeys(meta["parent_id"] for meta in metas if meta.get("parent_id")))
+        parents = {}
+        if parent_ids:
+            data = self.parents.get(ids=parent_ids, include=["documents"])
+            parents = dict(zip(data["ids"], data["documents"]))
+        
+        blocks, windows = [], {}
+        for doc, meta in zip(docs, metas):
+            parent_id = meta.get("parent_id")
+            if parent_id not in parents:
+                blocks.append((doc, meta, None))
+                continue
+            if parent_id not in windows:
+                windows[parent_id] = []
+                blocks.append((None, meta, parent_id))
+            windows[parent_id].append((meta["inizio"], meta["fine"]))
+        return [
+            (doc if parent_id is None else espandi_finestre(parents[parent_id], windows[parent_id]), meta)
+            for doc, meta, parent_id in blocks
+        ]
+    
+    def build_messages(self, question: str, data_riferimento: Optional[int] = None) -> Tuple[List[Dict], List[Dict], Dict]:
+        """Recupera il contesto e costruisce i messaggi per il modello"""
+        results = self.search_content(question, n_results=4, data_riferimento=data_riferimento)
+        
+        if not results['documents'][0]:
+            context = "Nessun documento rilevante trovato."
+            sources = []
+        else:
+            context_parts = []
+            sources = []
+            
+            for i, (doc, meta) in enumerate(self.expand_context(results)):
+                versione = f" (versione {meta['versioni']})" if meta.get('versioni') else ""
+                articolo = f", {meta['articolo']}" if meta.get('articolo') else ""
+                context_parts.append(f"[Fonte {i+1} - {meta['categoria']}, {meta['argomento']}{articolo}{versione}]\n{doc}")
+                sources.append({
+                    "categoria": meta['categoria'],
+                    "argomento": meta['argomento'],
+                    "articolo": meta.get('articolo', ''),
+                    "correlati": json.loads(meta.get('correlati', '[]')),
+                    "versioni": meta.get('versioni', ''),
+                    "duplicati": meta.get('n_duplicati', 0)
+                })
+            
+            context = "\n\n".join(context_parts)
+        
+        if isinstance(self.client, LocalLLMClient):
+            # Parte fissa in testa: il backend locale con cache del prefisso elabora solo contesto e domanda
+            prompt = f"""{ISTRUZIONI_PROMPT}CONTESTO (Estratti da CCNL e normative scolastiche):
+{context}
+
+DOMANDA: {question}
+
+RISPOSTA:"""
+        else:
+            prompt = f"""Sei un esperto consulente sindacale specializzato nel personale della scuola italiana (docenti, ATA, dirigenti). Conosci perfettamente CCNL Scuola, normative, contratti, graduatorie, concorsi.
+
+CONTESTO (Estratti da CCNL e normative scolastiche):
+{context}
+
+DOMANDA: {question}
+
+ISTRUZIONI:
+- Rispondi in modo chiaro, pratico e professionale
+- Cita SEMPRE le fonti quando usi informazioni dal contesto (es. "Secondo il CCNL Scuola...")
+- Se il contesto non è sufficiente, usa la tua conoscenza delle normative scolastiche italiane
+- Fornisci informazioni operative e pratiche (scadenze, procedure, modulistica)
+- Usa un tono professionale ma accessibile
+- Se la questione è complessa, suggerisci di rivolgersi al sindacato scolastico territoriale
+- Distingui chiaramente tra docenti e ATA quando necessario
+- Indica riferimenti normativi specifici quando possibile
+
+RISPOSTA:"""
+
+        messages = [
+            {
+                "role": "system",
+                "content": PROMPT_SISTEMA
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+        
+        return messages, sources, results
+    
+    @registra_traffico("answer")
+    def answer_question(self, question: str, model: str = MODELLO_PREDEFINITO, mode: str = MODALITA_AUTOMATICA,
+                        data_riferimento: Optional[int] = None):
+        """Risponde alla domanda con RAG (domande identiche in corso condividono la risposta)"""
+        trace = {}
+        start = time.perf_counter()
+        try:
+            # La traccia viaggia con il risultato: chi si accoda riceve quella di chi ha calcolato la risposta
+            (response, sources), leader_trace = self.singleflight.do(
+                self._flight_key("answer", question, model, mode, data_riferimento),
+                lambda: (self._answer_question(question, model, mode, data_riferimento, trace), trace)
+            )
+            if leader_trace is not trace:
+                trace = dict(leader_trace, accorpata=True)
+        except Exception as e:
+            get_audit_log().answer(question, model, mode, data_riferimento, trace, None, [],
+                                   time.perf_counter() - start, type(e).__name__)
+            raise
+        get_audit_log().answer(question, model, mode, data_riferimento, trace, response, sources,
+                               time.perf_counter() - start)
+        return response, sources
+    
+    def _use_extractive(self, mode: str) -> bool:
+        """Estrattiva se richiesta, o in automatico quando l'interruttore LLM è aperto"""
+        return mode == MODALITA_ESTRATTIVA or (mode == MODALITA_AUTOMATICA and not self.breaker.allow())
+    
+    def has_instant_answer(self, question: str, mode: str = MODALITA_AUTOMATICA,
+                           data_riferimento: Optional[int] = None) -> bool:
+        """La tabella dei valori risponde senza LLM: la domanda non deve consumare capacità né token"""
+        return mode != MODALITA_LLM and bool(self.fact_index.lookup(question, data_riferimento))
+    
+    def _answer_question(self, question: str, model: str, mode: str, data_riferimento: Optional[int],
+                         trace: Dict):
+        # Domande su un valore contrattuale: risposta immediata dalla tabella, con citazione
+        instant = self.fact_index.answer(question, data_riferimento) if mode != MODALITA_LLM else None
+        if instant:
+            trace["esito"] = "valori"
+            return instant
+        
+        messages, sources, results = self._retrieve_for_answer(question, data_riferimento, trace)
+        
+        if self._use_extractive(mode):
+            trace["esito"] = "estrattiva"
+            return self.extractive.answer(question, results), sources
+        
+        start = time.perf_counter()
+        try:
+            if model == MODELLO_AUTOMATICO:
+                distances = results['distances'][0] if results.get('distances') else []
+                response = self.router.complete(self.client, messages, question, distances, trace)
+            else:
+                chat_completion = self.client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    temperature=0.3,
+                    max_tokens=2048,
+                    timeout=TIMEOUT_LLM
+                )
+                response = chat_completion.choices[0].message.content
+                usage = getattr(chat_completion, "usage", None)
+                if usage is not None:
+                    trace.update(token_prompt=usage.prompt_tokens, token_risposta=usage.completion_tokens)
+        except Exception:
+            self.breaker.record(False, time.perf_counter() - start)
+            if mode == MODALITA_AUTOMATICA:
+                trace["esito"] = "estrattiva_ripiego"
+                return self.extractive.answer(question, results), sources
+            raise
+        
+        self.breaker.record(True, time.perf_counter() - start)
+        trace.update(esito="llm", llm_ms=round((time.perf_counter() - start) * 1000, 1))
+        return response, sources
+    
+    def _retrieve_for_answer(self, question: str, data_riferimento: Optional[int], trace: Dict):
+        start = time.perf_counter()
+        messages, sources, results = self.build_messages(question, data_riferimento)
+        trace.update(recupero_ms=round((time.perf_counter() - start) * 1000, 1), recuperati=recuperati(results))
+        return messages, sources, results
+    
+    def answer_question_stream(self, question: str, model: str = MODELLO_PREDEFINITO,
+                               mode: str = MODALITA_AUTOMATICA,
+                               data_riferimento: Optional[int] = None) -> Tuple[Iterator[str], List[Dict]]:
+        """Come answer_question, ma restituisce la risposta come flusso di token"""
+        trace = {}
+        start = time.perf_counter()
+        
+        def open_stream():
+            tokens, sources = self._answer_question_stream(question, model, mode, data_riferimento, trace)
+            return tokens, (sources, trace)
+        
+        try:
+            tokens, (sources, leader_trace) = self.singleflight.do_stream(
+                self._flight_key("stream", question, model, mode, data_riferimento), open_stream
+            )
+        except Exception as e:
+            get_audit_log().answer(question, model, mode, data_riferimento, trace, None, [],
+                                   time.perf_counter() - start, type(e).__name__)
+            raise
+        
+        def audited():
+            # L'evento si registra a flusso concluso (o interrotto), con la risposta completa
+            parts, error = [], "interrotta"
+            try:
+                for token in tokens:
+                    parts.append(token)
+                    yield token
+                error = None
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                # La traccia di chi ha aperto il flusso è completa solo a flusso concluso (primo token, llm_ms)
+                shared = trace if leader_trace is trace else dict(leader_trace, accorpata=True)
+                get_audit_log().answer(question, model, mode, data_riferimento, shared, "".join(parts), sources,
+                                       time.perf_counter() - start, error)
+        
+        return audited(), sources
+    
+    def _answer_question_stream(self, question: str, model: str, mode: str, data_riferimento: Optional[int],
+                                trace: Dict) -> Tuple[Iterator[str], List[Dict]]:
+        instant = self.fact_index.answer(question, data_riferimento) if mode != MODALITA_LLM else None
+        if instant:
+            trace["esito"] = "valori"
+            return iter([instant[0]]), instant[1]
+        
+        messages, sources, results = self._retrieve_for_answer(question, data_riferimento, trace)
+        
+        if self._use_extractive(mode):
+            trace["esito"] = "estrattiva"
+            return iter([self.extractive.answer(question, results)]), sources
+        
+        if model == MODELLO_AUTOMATICO:
+            distances = results['distances'][0] if results.get('distances') else []
+            model = self.router.choose(question, distances)
+        trace["modello"] = model
+        
+        start = time.perf_counter()
+        try:
+            stream = self.client.chat.completions.create(
+                messages=messages,
+                model=model,
+                temperature=0.3,
+                max_tokens=2048,
+                stream=True,
+                timeout=TIMEOUT_LLM
+            )
+        except Exception:
+            self.breaker.record(False, time.perf_counter() - start)
+            if mode == MODALITA_AUTOMATICA:
+                trace["esito"] = "estrattiva_ripiego"
+                return iter([self.extractive.answer(question, results)]), sources
+            raise
+        trace["esito"] = "llm"
+        
+        # L'esito va all'interruttore una sola volta, comunque finisca il flusso
+        settled = {"fatto": False}
+        
+        def settle(outcome):
+            if not settled["fatto"]:
+                settled["fatto"] = True
+                outcome()
+        
+        def tokens():
+            chunks, first = 0, None
+            try:
+                for chunk in stream:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        # La latenza che conta per l'interruttore è il tempo al primo token
+                        first = first or time.perf_counter() - start
+                        chunks += 1
+                        yield delta
+            except GeneratorExit:
+                # Lettore sparito: l'LLM ha risposto se è arrivato almeno un token
+                settle(self.breaker.release if first is None else lambda: self.breaker.record(True, first))
+                raise
+            except Exception:
+                settle(lambda: self.breaker.record(False, time.perf_counter() - start))
+                raise
+            finally:
+                settle(lambda: self.breaker.record(True, first if first is not None else time.perf_counter() - start))
+            # In streaming l'uso non viene restituito: i frammenti approssimano i token generati
+            trace.update(llm_ms=round((time.perf_counter() - start) * 1000, 1), token_risposta=chunks,
+                         primo_token_ms=round((first or 0) * 1000, 1))
+        
+        generator = tokens()
+        # Flusso mai iterato: il generatore non entra nel try, la prova si rilascia alla raccolta
+        weakref.finalize(generator, settle, self.breaker.release)
+        return generator, sources
+
+
+class RemoteAssistant:
+    """Client sottile del servizio HTTP (api_sindacato.py), con la stessa interfaccia dell'assistente"""
+    
+    def __init__(self, base_url: str, timeout: float = 60.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._version_memo = (0.0, None)
+    
+    def _request(self, path: str, payload: Optional[Dict] = None, **params):
+        url = f"{self.base_url}{path}"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+    
+    def preload_contracts(self):
+        # Il servizio precarica le normative all'avvio
+        return False
+    
+    def count(self) -> int:
+        return self._request("/stats")["documenti"]
+    
+    def corpus_version(self) -> str:
+        return self._request("/stats")["corpus_version"]
+    
+    def current_version(self) -> str:
+        """Come per l'assistente locale: /stats riletto al massimo ogni VALIDITA_VERSIONE_CORPUS secondi"""
+        checked, version = self._version_memo
+        if version is None or time.monotonic() - checked >= VALIDITA_VERSIONE_CORPUS:
+            version = self.corpus_version()
+            self._version_memo = (time.monotonic(), version)
+        return version
+    
+    def get_documents(self, ids: List[str]) -> Dict:
+        return self._request("/documenti", ids=",".join(ids))
+    
+    def suggest(self, query: str, limit: int = 6, data_riferimento: Optional[int] = None) -> List[Dict]:
+        params = {"data": data_riferimento} if data_riferimento else {}
+        return self._request("/suggest", q=query, limit=limit, **params)["suggerimenti"]
+    
+    def complete_query(self, query: str) -> str:
+        return self._request("/suggest", q=query, limit=0)["completamento"]
+    
+    def search_content(self, query: str, n_results: int = 4, data_riferimento: Optional[int] = None):
+        params = {"data": data_riferimento} if data_riferimento else {}
+        return self._request("/search", q=query, n=n_results, **params)
+    
+    def search_page(self, query: str, cursor: Optional[str] = None, page_size: int = RISULTATI_PER_PAGINA,
+                    data_riferimento: Optional[int] = None) -> Dict:
+        params = {"data": data_riferimento} if data_riferimento else {}
+        if cursor:
+            params["cursore"] = cursor
+        return self._request("/search/pagina", q=query, n=page_size, **params)
+    
+    def add_custom_content(self, text: str, categoria: str, argomento: str) -> Tuple[str, bool]:
+        result = self._request("/ingest", {"text": text, "categoria": categoria, "argomento": argomento})
+        return result["id"], result["duplicato"]
+    
+    def ingest_contract_version(self, contratto: str, versione: str, valido_dal: int,
+                                articoli: Dict[str, str], categoria: Optional[str] = None) -> Dict[str, List[str]]:
+        return self._request("/ingest-contratto", {
+            "contratto": contratto, "versione": versione, "valido_dal": valido_dal,
+            "articoli": articoli, "categoria": categoria
+        })
+    
+    def has_instant_answer(self, question: str, mode: str = MODALITA_AUTOMATICA,
+                           data_riferimento: Optional[int] = None) -> bool:
+        # La decide il servizio, che la serve prima del proprio controllo di ammissione
+        return False
+    
+    def answer_question(self, question: str, model: str = MODELLO_PREDEFINITO, mode: str = MODALITA_AUTOMATICA,
+                        data_riferimento: Optional[int] = None):
+        result = self._request("/ask", {"question": question, "model": model, "mode": mode,
+                                        "data_riferimento": data_riferimento})
+        return result["risposta"], result["fonti"]
+
+
+class ExtractiveAnswerer:
+    """Risposta senza LLM: le frasi dei chunk recuperati più vicine alla domanda"""
+    
+    PAROLE_VUOTE = {
+        "il", "lo", "la", "i", "gli", "le", "un", "una", "di", "da", "in", "con", "su", "per", "tra",
+        "fra", "a", "e", "o", "che", "chi", "mi", "ho", "ha", "come", "del", "della", "dei", "delle",
+        "al", "alla", "nel", "nella", "sono", "si", "non", "posso", "devo", "cosa", "quale", "quali"
+    }
+    
+    def __init__(self, max_sentences: int = 4):
+        self.max_sentences = max_sentences
+    
+    @staticmethod
+    def _stem(token: str) -> str:
+        # Radice grezza: basta a far coincidere ferie/feriale, docente/docenti
+        return token[:5]
+    
+    def answer(self, question: str, results: Dict) -> str:
+        docs = results['documents'][0] if results.get('documents') else []
+        metas = results['metadatas'][0] if results.get('metadatas') else []
+        if not docs:
+            return "⚡ *Risposta rapida*: nessun documento pertinente trovato. Riprova più tardi o rivolgiti al sindacato territoriale."
+        
+        terms = {self._stem(t) for t in tokenizza(question) if t not in self.PAROLE_VUOTE}
+        wants_number = any(t in tokenizza(question) for t in ("quanti", "quante", "quanto", "quando"))
+        
+        candidates = []
+        for rank, (doc, meta) in enumerate(zip(docs, metas)):
+            for position, sentence in enumerate(re.split(r"(?<=[.;])\s+", doc)):
+                stems = {self._stem(t) for t in tokenizza(sentence)}
+                overlap = len(terms & stems) / (len(terms) or 1)
+                score = overlap + 0.3 / (1 + rank) + 0.1 / (1 + position)
+                if wants_number and re.search(r"\d", sentence):
+                    score += 0.2
+                candidates.append((score, rank, position, sentence.strip(), meta))
+        
+        best = sorted(candidates, key=lambda c: c[0], reverse=True)[:self.max_sentences]
+        best = [c for c in best if c[0] >= best[0][0] / 2]
+        # Ordine di lettura: per fonte e posizione nel testo
+        best.sort(key=lambda c: (c[1], c[2]))
+        lines = [
+            f"- {sentence} _(Fonte: {meta['categoria']}, {meta['argomento']})_"
+            for _, _, _, sentence, meta in best if sentence
+        ]
+        return "⚡ *Risposta rapida estratta dalle normative:*\n\n" + "\n".join(lines)
+
+
+class CircuitBreaker:
+    """Interruttore sull'LLM: si apre con troppi errori o risposte lente e si richiude da solo"""
+    
+    def __init__(self, window: int = 20, min_calls: int = 5, max_failure_rate: float = 0.5,
+                 max_latency: float = 15.0, cooldown: float = 30.0, trial_timeout: float = 120.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.max_failure_rate = max_failure_rate
+        self.max_latency = max_latency
+        self.cooldown = cooldown
+        self.trial_timeout = trial_timeout
+        self.state = "chiuso"
+        self._outcomes: List[bool] = []
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger("sindacato.breaker")
+    
+    def allow(self) -> bool:
+        """True se la chiamata all'LLM può partire"""
+        with self._lock:
+            if self.state == "chiuso":
+                return True
+            if self.state == "aperto" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = "semiaperto"
+            if self.state == "semiaperto" and self._trial_running \
+                    and time.monotonic() - self._trial_started >= self.trial_timeout:
+                # Prova mai conclusa (chiamante sparito senza esito): se ne concede un'altra
+                self._trial_running = False
+            if self.state == "semiaperto" and not self._trial_running:
+                # Una sola chiamata di prova alla volta
+                self._trial_running = True
+                self._trial_started = time.monotonic()
+                return True
+            return False
+    
+    def release(self):
+        """Chiamata abbandonata senza esito (flusso mai letto o interrotto prima del primo token)"""
+        with self._lock:
+            if self.state == "semiaperto":
+                self._trial_running = False
+    
+    def record(self, success: bool, latency: float):
+        """Registra l'esito: una risposta troppo lenta conta come fallimento"""
+        ok = success and latency <= self.max_latency
+        with self._lock:
+            if self.state == "semiaperto":
+                self._trial_running = False
+                if ok:
+                    self.state, self._outcomes = "chiuso", []
+                    self.logger.info("LLM di nuovo disponibile: interruttore chiuso")
+                else:
+                    self._open()
+                return
+            self._outcomes = (self._outcomes + [ok])[-self.window:]
+            failures = self._outcomes.count(False)
+            if (self.state == "chiuso" and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.max_failure_rate):
+                self._open()
+    
+    def _open(self):
+        self.state = "aperto"
+        self._opened_at = time.monotonic()
+        self.logger.warning("LLM lento o non disponibile: interruttore aperto per %.0fs", self.cooldown)
+
+
+@st.cache_resource
+def get_circuit_breaker() -> CircuitBreaker:
+    """Interruttore condiviso: lo stato dell'LLM è lo stesso per tutte le sessioni"""
+    return CircuitBreaker()
+
+
+class ModelRouter:
+    """Sceglie per ogni domanda il modello veloce o quello grande"""
+    
+    # Indizi di domande che richiedono ragionamento o confronto (parole intere; l'ultima, se di
+    # almeno 4 lettere, vale anche come radice: "confront" -> confronto, confrontare)
+    INDIZI_COMPLESSI = (
+        "perché", "come posso", "cosa succede", "differenza", "confront", "conviene",
+        "nel caso", "se", "ricorso", "contestare", "calcol", "spiega", "rischio", "oppure"
+    )
+    # Indizi di semplici richieste di un dato
+    INDIZI_SEMPLICI = ("quanti", "quante", "quanto", "quando", "qual è", "quali sono", "cos'è", "che cos")
+    
+    # Pesi del classificatore logistico (positivo = modello grande)
+    PESI = {
+        "bias": -0.4,
+        "lunghezza": 1.6,
+        "complessi": 1.1,
+        "semplici": -0.9,
+        "domande_multiple": 0.7,
+        "margine": -6.0,
+        "confidenza": -2.0,
+    }
+    
+    def __init__(self, fast_model: str = MODELLO_VELOCE, large_model: str = MODELLO_PREDEFINITO,
+                 timeout: float = 20.0):
+        self.fast_model = fast_model
+        self.large_model = large_model
+        self.timeout = timeout
+        self.logger = logging.getLogger("sindacato.router")
+        self._lock = threading.Lock()
+        self.stats = {
+            "richieste": 0,
+            "veloce": 0,
+            "grande": 0,
+            "fallback": 0,
+            "latenza_totale": 0.0,
+            "costo": 0.0,
+            "costo_solo_grande": 0.0,
+        }
+    
+    @staticmethod
+    def _has_cue(tokens: List[str], cue: str) -> bool:
+        words = tokenizza(cue)
+        for i in range(len(tokens) - len(words) + 1):
+            window = tokens[i:i + len(words)]
+            last, cue_last = window[-1], words[-1]
+            if window[:-1] == words[:-1] and (last == cue_last or (len(cue_last) >= 4 and last.startswith(cue_last))):
+                return True
+        return False
+    
+    def score(self, question: str, distances: List[float]) -> float:
+        """Probabilità che la domanda richieda il modello grande"""
+        q = question.lower()
+        tokens = tokenizza(question)
+        words = len(q.split())
+        # Distanza coseno di Chroma -> similarità
+        sims = [1.0 - d for d in distances]
+        top = sims[0] if sims else 0.0
+        margin = sims[0] - sims[1] if len(sims) > 1 else 0.0
+        
+        z = (
+            self.PESI["bias"]
+            + self.PESI["lunghezza"] * min(words, 40) / 20
+            + self.PESI["complessi"] * sum(self._has_cue(tokens, cue) for cue in self.INDIZI_COMPLESSI)
+            + self.PESI["semplici"] * any(self._has_cue(tokens, cue) for cue in self.INDIZI_SEMPLICI)
+            + self.PESI["domande_multiple"] * max(q.count("?") - 1, 0)
+            + self.PESI["margine"] * margin
+            + self.PESI["confidenza"] * (top - 0.5)
+        )
+        return 1.0 / (1.0 + math.exp(-z))
+    
+    def choose(self, question: str, distances: List[float]) -> str:
+        return self.large_model if self.score(question, distances) >= 0.5 else self.fast_model
+    
+    @staticmethod
+    def cost(model: str, usage) -> float:
+        price_in, price_out = PREZZI_MODELLI.get(model, (0.0, 0.0))
+        if usage is None:
+            return 0.0
+        return (usage.prompt_tokens * price_in + usage.completion_tokens * price_out) / 1_000_000
+    
+    def complete(self, client, messages: List[Dict], question: str, distances: List[float],
+                 trace: Optional[Dict] = None) -> str:
+        """Chiama il modello scelto, ripiegando sull'altro in caso di errore o timeout"""
+        chosen = self.choose(question, distances)
+        fallback = self.large_model if chosen == self.fast_model else self.fast_model
+        
+        start = time.perf_counter()
+        last_error = None
+        for attempt, model in enumerate((chosen, fallback)):
+            try:
+                chat_completion = client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    temperature=0.3,
+                    max_tokens=2048,
+                    timeout=self.timeout
+                )
+            except Exception as e:
+                last_error = e
+                self.logger.warning("Modello %s non disponibile (%s), fallback", model, e)
+                continue
+            
+            latency = time.perf_counter() - start
+            usage = getattr(chat_completion, "usage", None)
+            cost = self.cost(model, usage)
+            cost_large = self.cost(self.large_model, usage)
+            with self._lock:
+                self.stats["richieste"] += 1
+                self.stats["veloce" if model == self.fast_model else "grande"] += 1
+                self.stats["fallback"] += attempt
+                self.stats["latenza_totale"] += latency
+                self.stats["costo"] += cost
+                self.stats["costo_solo_grande"] += cost_large
+            self.logger.info(
+                "router modello=%s latenza=%.2fs costo=$%.6f risparmio=$%.6f",
+                model, latency, cost, cost_large - cost
+            )
+            if trace is not None:
+                trace["modello"] = model
+                if usage is not None:
+                    trace.update(token_prompt=usage.prompt_tokens, token_risposta=usage.completion_tokens)
+            return chat_completion.choices[0].message.content
+        
+        raise last_error
+
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """Router condiviso, così le statistiche coprono tutte le sessioni"""
+    return ModelRouter()
+
+
+class LexicalIndex:
+    """Indice lessicale in memoria con ricerca per prefisso su argomento e testo"""
+    
+    PESO_ARGOMENTO = 3.0
+    # Un termine completato da un prefisso vale meno di una corrispondenza esatta
+    PESO_PREFISSO = 0.7
+    MAX_ESPANSIONI = 30
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.vocabulary: List[str] = []
+        self.docs: Dict[str, Dict] = {}
+        # Generazione dei metadati già applicata (articoli chiusi o abrogati da altri processi)
+        self.metadata_generation = None
+    
+    def add(self, doc_id: str, document: str, metadata: Dict):
+        """Indicizza un documento (chiamato a ogni inserimento nella collection)"""
+        weights: Dict[str, float] = {}
+        for token in tokenizza(document):
+            weights[token] = weights.get(token, 0.0) + 1.0
+        for token in tokenizza(metadata.get("argomento", "")):
+            weights[token] = weights.get(token, 0.0) + self.PESO_ARGOMENTO
+        norm = math.sqrt(sum(weights.values())) or 1.0
+        
+        with self._lock:
+            self.docs[doc_id] = {
+                "id": doc_id,
+                "categoria": metadata.get("categoria", ""),
+                "argomento": metadata.get("argomento", ""),
+                "valido_dal": metadata.get("valido_dal", SEMPRE_VALIDO_DAL),
+                "valido_al": metadata.get("valido_al", SEMPRE_VALIDO_AL),
+                "snippet": document[:200]
+            }
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    self.postings[token] = {}
+                    bisect.insort(self.vocabulary, token)
+                self.postings[token][doc_id] = weight / norm
+    
+    def update_metadata(self, doc_id: str, metadata: Dict):
+        """Aggiorna la validità di un documento già indicizzato"""
+        with self._lock:
+            if doc_id in self.docs:
+                self.docs[doc_id]["valido_dal"] = metadata.get("valido_dal", SEMPRE_VALIDO_DAL)
+                self.docs[doc_id]["valido_al"] = metadata.get("valido_al", SEMPRE_VALIDO_AL)
+    
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {"postings": self.postings, "docs": self.docs}
+    
+    def load(self, data: Dict, corpus_version: str):
+        """Carica un indice serializzato (snapshot) senza ritokenizzare i documenti"""
+        with self._lock:
+            self.postings = data["postings"]
+            self.docs = data["docs"]
+            self.vocabulary = sorted(self.postings)
+            self.version = corpus_version
+    
+    def sync(self, collection, corpus_version: str):
+        """Allinea l'indice alla collection, aggiungendo solo i documenti mancanti"""
+        if self.version == corpus_version:
+            return
+        ids = collection.get(include=[])["ids"]
+        if set(self.docs) - set(ids):
+            with self._lock:
+                self.postings, self.vocabulary, self.docs = {}, [], {}
+        missing = [doc_id for doc_id in ids if doc_id not in self.docs]
+        if missing:
+            data = collection.get(ids=missing, include=["documents", "metadatas"])
+            for doc_id, doc, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+                self.add(doc_id, doc, meta)
+        self.version = corpus_version
+    
+    def _expand(self, token: str) -> List[str]:
+        """Termini del vocabolario che iniziano con `token`"""
+        start = bisect.bisect_left(self.vocabulary, token)
+        terms = []
+        for term in self.vocabulary[start:start + self.MAX_ESPANSIONI]:
+            if not term.startswith(token):
+                break
+            terms.append(term)
+        return terms
+    
+    def search(self, query: str, limit: int = 8, data_riferimento: Optional[int] = None) -> List[Dict]:
+        """Ricerca istantanea: ogni parola della query vale anche come prefisso"""
+        tokens = tokenizza(query)
+        if not tokens:
+            return []
+        n_docs = len(self.docs) or 1
+        scores: Dict[str, float] = {}
+        with self._lock:
+            for token in tokens:
+                best: Dict[str, float] = {}
+                for term in self._expand(token):
+                    postings = self.postings[term]
+                    idf = math.log(1 + n_docs / len(postings))
+                    factor = 1.0 if term == token else self.PESO_PREFISSO
+                    for doc_id, weight in postings.items():
+                        best[doc_id] = max(best.get(doc_id, 0.0), weight * idf * factor)
+                for doc_id, score in best.items():
+                    scores[doc_id] = scores.get(doc_id, 0.0) + score
+            ranked = sorted(
+                ((doc_id, score) for doc_id, score in scores.items() if in_vigore(self.docs[doc_id], data_riferimento)),
+                key=lambda item: item[1], reverse=True
+            )[:limit]
+            return [dict(self.docs[doc_id], score=score) for doc_id, score in ranked]
+    
+    def complete(self, query: str) -> str:
+        """Completa l'ultima parola con il termine più diffuso che ha quel prefisso"""
+        tokens = tokenizza(query)
+        if not tokens:
+            return query
+        with self._lock:
+            terms = self._expand(tokens[-1])
+            if not terms:
+                return query
+            best = max(terms, key=lambda term: len(self.postings[term]))
+        return " ".join(tokens[:-1] + [best])
+
+
+class FactIndex:
+    """Tabella dei valori contrattuali (diritto, ruolo, valore, unità, fonte) per risposte immediate"""
+    
+    # Domande che chiedono un ragionamento, non un valore: vanno all'LLM
+    RAGIONAMENTO = ("perch", "convien", "differenz", "calcol", "spieg", "succed", "funzion",
+                    "devo", "obblig", "rifiut", "oppure", "confront", "posso", "cumul")
+    # Parole che non cambiano il valore richiesto: articoli, preposizioni, forme della domanda, unità
+    PAROLE_VUOTE = {
+        "a", "ad", "al", "allo", "alla", "ai", "agli", "alle", "da", "dal", "dalla", "dai", "di", "del", "dello",
+        "della", "dei", "degli", "delle", "in", "nel", "nella", "per", "con", "su", "sul", "tra", "fra",
+        "il", "lo", "la", "l", "i", "gli", "le", "un", "uno", "una", "e", "ed", "mi", "ci", "si", "ne", "c",
+        "che", "chi", "cosa", "come", "qual", "quale", "quali", "quanto", "quanta", "quanti", "quante", "ogni",
+        "ha", "hanno", "ho", "abbiamo", "sono", "spetta", "spettano", "previsto", "prevista", "previsti", "previste",
+        "dura", "durata", "giorno", "giorni", "ora", "ore", "mese", "mesi", "anno", "anni",
+        "settimanali", "mensili", "annuali", "personale",
+    }
+    # Qualificatori che cambiano il diritto (supplenze brevi, congedi facoltativi, trattamento economico,
+    # preavvisi): senza una regola che li preveda tra le chiavi la domanda va al recupero e all'LLM
+    QUALIFICATORI = ("facoltativ", "dottorat", "supplen", "breve", "brevi", "decurt", "preavv", "pagat",
+                     "retribuzion", "ridott", "part", "frazion")
+    
+    def __init__(self):
+        self.version = None
+        self.facts: List[Dict] = []
+        self.seen: set = set()
+        self._lock = threading.Lock()
+        self.answered = 0
+    
+    @staticmethod
+    def _role(argomento: str) -> str:
+        tokens = tokenizza(argomento)
+        if any(t.startswith(("docent",)) for t in tokens):
+            return "docenti"
+        if "ata" in tokens:
+            return "ATA"
+        return "tutto il personale"
+    
+    def add(self, doc_id: str, document: str, metadata: Dict):
+        """Estrae i valori dal testo con le REGOLE_FATTI"""
+        sentences = re.split(r"(?<=[.;])\s+", document)
+        facts = []
+        for rule in REGOLE_FATTI:
+            for match in re.finditer(rule["regex"], document):
+                groups = match.groups()
+                facts.append({
+                    "doc_id": doc_id,
+                    "diritto": rule["diritto"],
+                    "chiavi": rule["chiavi"],
+                    "contesto": rule.get("contesto", ()),
+                    "ruolo": rule["ruolo"].format(*groups) if rule["ruolo"] else self._role(metadata.get("argomento", "")),
+                    "valore": rule["valore"].format(*groups),
+                    "unita": rule["unita"].format(*groups),
+                    "frase": next((s for s in sentences if match.group(0) in s), match.group(0)).strip(),
+                    "categoria": metadata.get("categoria", ""),
+                    "argomento": metadata.get("argomento", ""),
+                    "versioni": metadata.get("versioni", ""),
+                    "valido_dal": metadata.get("valido_dal", SEMPRE_VALIDO_DAL),
+                    "valido_al": metadata.get("valido_al", SEMPRE_VALIDO_AL),
+                })
+        with self._lock:
+            self.facts.extend(facts)
+            self.seen.add(doc_id)
+    
+    def update_metadata(self, doc_id: str, metadata: Dict):
+        with self._lock:
+            for fact in self.facts:
+                if fact["doc_id"] == doc_id:
+                    fact["valido_dal"] = metadata.get("valido_dal", SEMPRE_VALIDO_DAL)
+                    fact["valido_al"] = metadata.get("valido_al", SEMPRE_VALIDO_AL)
+    
+    def sync(self, collection, corpus_version: str):
+        """Allinea la tabella alla collection, estraendo solo i documenti nuovi"""
+        if self.version == corpus_version:
+            return
+        ids = collection.get(include=[])["ids"]
+        if self.seen - set(ids):
+            with self._lock:
+                self.facts, self.seen = [], set()
+        missing = [doc_id for doc_id in ids if doc_id not in self.seen]
+        if missing:
+            data = collection.get(ids=missing, include=["documents", "metadatas"])
+            for doc_id, doc, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+                self.add(doc_id, doc, meta)
+        self.version = corpus_version
+    
+    def lookup(self, question: str, data_riferimento: Optional[int] = None) -> List[Dict]:
+        """Valori che rispondono alla domanda (vuoto se serve un ragionamento o è ambigua)"""
+        tokens = tokenizza(question)
+        if not tokens or len(tokens) > 20 or any(t.startswith(self.RAGIONAMENTO) for t in tokens) or "se" in tokens:
+            return []
+        
+        def matches(stems) -> bool:
+            return any(t.startswith(stems) for t in tokens)
+        
+        role_stems = tuple(stem for stems in RUOLI_FATTI.values() for stem in stems)
+        content = [t for t in tokens if t not in self.PAROLE_VUOTE]
+        
+        def covers(fact) -> bool:
+            # Ogni parola della domanda è una chiave della regola, oppure contesto o ruolo non qualificante
+            keys = tuple(stem for group in fact["chiavi"] for stem in group)
+            return all(
+                t.startswith(keys) or (not t.startswith(self.QUALIFICATORI) and t.startswith(fact["contesto"] + role_stems))
+                for t in content
+            )
+        
+        with self._lock:
+            candidates = [
+                fact for fact in self.facts
+                if in_vigore(fact, data_riferimento) and all(matches(group) for group in fact["chiavi"]) and covers(fact)
+            ]
+        if not candidates:
+            return []
+        # Le regole più specifiche (più gruppi di chiavi) prevalgono
+        specificity = max(len(fact["chiavi"]) for fact in candidates)
+        candidates = [fact for fact in candidates if len(fact["chiavi"]) == specificity]
+        
+        roles = [role for role, stems in RUOLI_FATTI.items() if matches(stems)]
+        if roles:
+            # Vince il valore che corrisponde a più ruoli citati (es. "maestra della primaria")
+            overlap = {id(fact): sum(role in fact["ruolo"] for role in roles) for fact in candidates}
+            best = max(overlap.values())
+            if best:
+                candidates = [fact for fact in candidates if overlap[id(fact)] == best]
+        if len({fact["diritto"] for fact in candidates}) > 1:
+            return []
+        return candidates
+    
+    def answer(self, question: str, data_riferimento: Optional[int] = None) -> Optional[Tuple[str, List[Dict]]]:
+        facts = self.lookup(question, data_riferimento)
+        if not facts:
+            return None
+        with self._lock:
+            self.answered += 1
+        
+        lines = [f"- **{fact['ruolo']}**: **{fact['valore']} {fact['unita']}**" for fact in facts]
+        quotes = list(dict.fromkeys(f"> {fact['frase']}\n>\n> _(Fonte: {fact['categoria']}, {fact['argomento']})_" for fact in facts))
+        response = (
+            f"📌 *Risposta immediata dalla tabella dei valori contrattuali* — **{facts[0]['diritto']}**\n\n"
+            + "\n".join(lines) + "\n\n" + "\n\n".join(quotes)
+        )
+        sources = list({
+            (fact["categoria"], fact["argomento"]): {
+                "categoria": fact["categoria"],
+                "argomento": fact["argomento"],
+                "versioni": fact["versioni"],
+                "duplicati": 0
+            }
+            for fact in facts
+        }.values())
+        return response, sources
+
+
+class QueryExpander:
+    """Riscritture della query con sigle e sinonimi (dizionario di base + sigle trovate nel corpus)"""
+    
+    STOPWORD = {"a", "al", "alla", "da", "dei", "del", "della", "delle", "di", "e", "ed", "il", "la", "le", "per"}
+    
+    def __init__(self):
+        self.version = None
+        self.seen: set = set()
+        self.terms: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=MAX_RISCRITTURE, thread_name_prefix="espansione")
+        self._slots = threading.BoundedSemaphore(CODA_MASSIMA_ESPANSIONE)
+        self.stats = {"ricerche": 0, "espanse": 0, "riscritture_scartate": 0, "latenza_aggiunta": 0.0}
+        for acronym, long_form in ACRONIMI_SCUOLA.items():
+            self._add(acronym, long_form)
+        for term, synonym in SINONIMI_SCUOLA.items():
+            self._add(term, synonym)
+    
+    def _add(self, term: str, equivalent: str):
+        # Le equivalenze valgono in entrambe le direzioni
+        term, equivalent = " ".join(tokenizza(term)), " ".join(tokenizza(equivalent))
+        if term and equivalent and term != equivalent:
+            self.terms.setdefault(term, equivalent)
+            self.terms.setdefault(equivalent, term)
+    
+    def learn(self, text: str):
+        """Sigle definite nel testo: 'Forma Estesa (SIGLA)'"""
+        for match in re.finditer(r"\(([A-Z][A-Za-z]{1,7})\)", text):
+            acronym = match.group(1)
+            words = re.findall(r"[\w']+", text[:match.start()])[-(len(acronym) + 4):]
+            for size in range(1, len(words) + 1):
+                span = words[-size:]
+                initials = "".join(word[0] for word in span).lower()
+                content = "".join(word[0] for word in span if word.lower() not in self.STOPWORD).lower()
+                if acronym.lower() in (initials, content) and span[0][0].lower() == acronym[0].lower():
+                    with self._lock:
+                        self._add(acronym, " ".join(span))
+                    break
+    
+    def submit(self, fn, *args) -> Optional[Future]:
+        """Riscrittura nel pool condiviso; None se la coda è piena"""
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        # Anche le riscritture annullate liberano il posto
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+    
+    def sync(self, collection, corpus_version: str):
+        if self.version == corpus_version:
+            return
+        missing = [doc_id for doc_id in collection.get(include=[])["ids"] if doc_id not in self.seen]
+        if missing:
+            for doc in collection.get(ids=missing, include=["documents"])["documents"]:
+                self.learn(doc)
+            self.seen.update(missing)
+        self.version = corpus_version
+    
+    def expand(self, query: str) -> List[str]:
+        """Query originale più al massimo MAX_RISCRITTURE - 1 varianti"""
+        normalized = " ".join(tokenizza(query))
+        padded = f" {normalized} "
+        with self._lock:
+            matches = [(term, equivalent) for term, equivalent in self.terms.items() if f" {term} " in padded]
+        if not matches:
+            return [query]
+        
+        # Sostituzione in un solo passaggio, preferendo i termini più lunghi
+        equivalents = dict(matches)
+        pattern = r"\b(" + "|".join(re.escape(term) for term in sorted(equivalents, key=len, reverse=True)) + r")\b"
+        appended = []
+        
+        def substitute(match):
+            appended.append(equivalents[match.group(1)])
+            return appended[-1]
+        
+        substituted = re.sub(pattern, substitute, normalized)
+        rewrites = [query, substituted, f"{normalized} {' '.join(appended)}"]
+        unique = list(dict.fromkeys(r for r in rewrites if r))
+        return unique[:MAX_RISCRITTURE]
+    
+    def record(self, expanded: bool, dropped: int = 0, added_latency: float = 0.0):
+        with self._lock:
+            self.stats["ricerche"] += 1
+            self.stats["espanse"] += int(expanded)
+            self.stats["riscritture_scartate"] += dropped
+            self.stats["latenza_aggiunta"] += added_latency
+
+
+class SpeculativeSearcher:
+    """Prima pagina della ricerca in background, con debounce e cache dei risultati parziali"""
+    
+    def __init__(self, debounce: float = 0.3, cache_size: int = 256):
+        self.debounce = debounce
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ricerca")
+        self._cache: "OrderedDict[tuple, Dict]" = OrderedDict()
+        # Ultima richiesta di ogni sessione ancora in attesa del debounce o in corso
+        self._latest: Dict[str, object] = {}
+    
+    @staticmethod
+    def _key(query: str, corpus_version: str, n_results: int) -> tuple:
+        return (corpus_version, " ".join(tokenizza(query)), n_results)
+    
+    def cached(self, query: str, corpus_version: str, n_results: int) -> Optional[Dict]:
+        with self._lock:
+            key = self._key(query, corpus_version, n_results)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        return None
+    
+    def partial(self, query: str, corpus_version: str, n_results: int) -> Optional[Dict]:
+        """Risultati della query più lunga già in cache di cui `query` è un'estensione"""
+        version, normalized, n = self._key(query, corpus_version, n_results)
+        best = None
+        with self._lock:
+            for (v, cached_query, cached_n), results in self._cache.items():
+                if (v, cached_n) == (version, n) and cached_query and normalized.startswith(cached_query):
+                    if best is None or len(cached_query) > len(best[0]):
+                        best = (cached_query, results)
+        return best[1] if best else None
+    
+    def submit(self, assistant: "SchoolUnionAssistant", session_key: str, query: str,
+               corpus_version: str, n_results: int) -> Future:
+        """Pianifica la ricerca: parte solo se la query non cambia entro il debounce"""
+        request = object()
+        with self._lock:
+            self._latest[session_key] = request
+        
+        def run():
+            time.sleep(self.debounce)
+            with self._lock:
+                if self._latest.get(session_key) is not request:
+                    return None
+            try:
+                results = self.cached(query, corpus_version, n_results)
+                if results is None:
+                    results = assistant.search_page(query, page_size=n_results)
+                    with self._lock:
+                        self._cache[self._key(query, corpus_version, n_results)] = results
+                        while len(self._cache) > self.cache_size:
+                            self._cache.popitem(last=False)
+                return results
+            finally:
+                # Ricerca conclusa: la sessione si dimentica, salvo una richiesta più recente
+                with self._lock:
+                    if self._latest.get(session_key) is request:
+                        del self._latest[session_key]
+        
+        return self._executor.submit(contextvars.copy_context().run, run)
+    
+    def prefetch(self, assistant: "SchoolUnionAssistant", query: str, corpus_version: str, n_results: int):
+        """Ricerca speculativa senza debounce (es. completamento suggerito)"""
+        if self.cached(query, corpus_version, n_results) is not None:
+            return
+        
+        def run():
+            results = assistant.search_page(query, page_size=n_results)
+            with self._lock:
+                self._cache[self._key(query, corpus_version, n_results)] = results
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        
+        self._executor.submit(contextvars.copy_context().run, run)
+
+
+class SearchCursors:
+    """Classifiche dei candidati delle ricerche paginate: le pagine successive non ripetono la ricerca"""
+    
+    def __init__(self, capacity: int = MAX_CURSORI, ttl: float = DURATA_CURSORE):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.stats = {"classifiche": 0, "pagine": 0, "scadute": 0}
+        self._rankings: "OrderedDict[str, Tuple[float, List[Dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(query: str, data_riferimento: Optional[int], corpus: str) -> str:
+        # Deterministica: ogni processo (o worker dell'API) ricostruisce la stessa classifica
+        return hash_testo(json.dumps([" ".join(tokenizza(query)), data_riferimento, corpus]))
+    
+    def get(self, key: str) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._rankings.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._rankings[key]
+                self.stats["scadute"] += 1
+                return None
+            self._rankings[key] = (time.monotonic(), entry[1])
+            self._rankings.move_to_end(key)
+            self.stats["pagine"] += 1
+            return entry[1]
+    
+    def put(self, key: str, hits: List[Dict]):
+        with self._lock:
+            self._rankings[key] = (time.monotonic(), hits)
+            self._rankings.move_to_end(key)
+            self.stats["classifiche"] += 1
+            while len(self._rankings) > self.capacity:
+                self._rankings.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._rankings)
+
+
+class IndexMigration:
+    """Migrazione del modello di embedding: indice ombra, confronto sul traffico reale, scambio atomico"""
+    
+    def __init__(self):
+        self.state = "inattiva"  # inattiva | costruzione | pronta | errore
+        self.model = None
+        self.collection = None
+        self.source = None
+        self.source_model = None
+        self.client = None
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.shadow_stats = {}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ombra")
+    
+    def start(self, assistant: "SchoolUnionAssistant", model: str, rate: float = DOCUMENTI_AL_SECONDO_MIGRAZIONE):
+        """Avvia la costruzione dell'indice ombra in background (riprende da dove si era fermata)"""
+        if self.state == "costruzione":
+            return
+        if model == assistant.model_name:
+            raise ValueError("Il modello indicato è già quello attivo")
+        self.client = assistant.chroma_client
+        self.source, self.source_model = assistant.collection, assistant.model_name
+        self.model = model
+        self.collection = apri_collezione(self.client, nome_collezione(model))
+        self.done, self.total, self.error = 0, self.source.count(), None
+        self.shadow_stats = {"confronti": 0, "sovrapposizione": 0.0, "top1_uguale": 0,
+                             "ms_attivo": 0.0, "ms_ombra": 0.0}
+        self._stop.clear()
+        self.state = "costruzione"
+        threading.Thread(target=self._build, args=(rate,), daemon=True, name="migrazione").start()
+    
+    def _build(self, rate: float):
+        try:
+            self._copy_missing(self.source, self.collection, self.model, rate)
+            self.state = "annullata" if self._stop.is_set() else "pronta"
+        except Exception as e:
+            self.error, self.state = str(e), "errore"
+    
+    def _copy_missing(self, source, target, model_name: str, rate: Optional[float] = None, batch: int = 16) -> int:
+        """Embedding con `model_name` dei documenti di `source` assenti in `target`, a velocità limitata"""
+        model = get_embedding_model(model_name)
+        known = set(target.get(include=[])["ids"])
+        missing = [doc_id for doc_id in source.get(include=[])["ids"] if doc_id not in known]
+        self.done = len(known)
+        for start in range(0, len(missing), batch):
+            if self._stop.is_set():
+                break
+            began = time.perf_counter()
+            data = source.get(ids=missing[start:start + batch], include=["documents", "metadatas"])
+            texts = [testo_embedding(doc, meta) for doc, meta in zip(data["documents"], data["metadatas"])]
+            embeddings = model.encode(texts).tolist()
+            # I correlati (vicini e punteggi) dipendono dallo spazio del modello: si ricalcolano nell'ombra
+            metadatas = [{key: value for key, value in meta.items() if key != "correlati"} for meta in data["metadatas"]]
+            target.add(ids=data["ids"], documents=data["documents"], metadatas=metadatas, embeddings=embeddings)
+            collega_correlati(target, data["ids"], embeddings)
+            self.done += len(data["ids"])
+            if rate:
+                # Throttling: il traffico reale ha la precedenza sulla costruzione
+                time.sleep(max(0.0, len(data["ids"]) / rate - (time.perf_counter() - began)))
+        return len(missing)
+    
+    @staticmethod
+    def _copy_metadata(source, target, batch: int = 500):
+        """Allinea i metadati (es. validità chiusa da una nuova versione del contratto), tranne i correlati"""
+        ids = target.get(include=[])["ids"]
+        for start in range(0, len(ids), batch):
+            data = source.get(ids=ids[start:start + batch], include=["metadatas"])
+            if data["ids"]:
+                target.update(ids=data["ids"], metadatas=[
+                    {key: value for key, value in meta.items() if key != "correlati"} for meta in data["metadatas"]
+                ])
+    
+    def cancel(self):
+        self._stop.set()
+    
+    def observe(self, assistant: "SchoolUnionAssistant", query: str, n_results: int, data_riferimento: Optional[int]):
+        """Traffico ombra: una quota delle ricerche reali viene ripetuta su entrambi gli indici"""
+        if self.state != "pronta" or assistant.collection.name != self.source.name:
+            return
+        if random.random() < QUOTA_TRAFFICO_OMBRA:
+            self._executor.submit(self._compare, query, n_results, data_riferimento)
+    
+    def _timed_query(self, collection, model_name: str, query: str, n_results: int,
+                     data_riferimento: Optional[int]) -> Tuple[List[str], float]:
+        start = time.perf_counter()
+        embedding = get_embedding_model(model_name).encode([query]).tolist()
+        ids = collection.query(query_embeddings=embedding, n_results=n_results,
+                               where=filtro_validita(data_riferimento), include=[])["ids"][0]
+        return ids, time.perf_counter() - start
+    
+    def _compare(self, query: str, n_results: int, data_riferimento: Optional[int]):
+        live, live_time = self._timed_query(self.source, self.source_model, query, n_results, data_riferimento)
+        shadow, shadow_time = self._timed_query(self.collection, self.model, query, n_results, data_riferimento)
+        with self._lock:
+            stats = self.shadow_stats
+            stats["confronti"] += 1
+            stats["sovrapposizione"] += len(set(live) & set(shadow)) / max(len(live), 1)
+            stats["top1_uguale"] += int(live[:1] == shadow[:1])
+            stats["ms_attivo"] += live_time * 1000
+            stats["ms_ombra"] += shadow_time * 1000
+    
+    def shadow_report(self) -> Dict:
+        with self._lock:
+            n = self.shadow_stats.get("confronti", 0)
+            if not n:
+                return {"confronti": 0}
+            return {
+                "confronti": n,
+                "sovrapposizione_media": self.shadow_stats["sovrapposizione"] / n,
+                "top1_uguale": self.shadow_stats["top1_uguale"] / n,
+                "ms_attivo": self.shadow_stats["ms_attivo"] / n,
+                "ms_ombra": self.shadow_stats["ms_ombra"] / n,
+            }
+    
+    def evaluate(self, k: int = 4, sample: int = 100) -> Dict:
+        """Qualità senza etichette: recall@k ritrovando ogni documento dal suo argomento"""
+        data = self.source.get(include=["metadatas"])
+        pairs = [(doc_id, meta["argomento"]) for doc_id, meta in zip(data["ids"], data["metadatas"]) if meta.get("argomento")]
+        pairs = random.Random(0).sample(pairs, min(sample, len(pairs)))
+        report = {}
+        for label, collection, model_name in (("attivo", self.source, self.source_model),
+                                              ("ombra", self.collection, self.model)):
+            hits, elapsed = 0, 0.0
+            for doc_id, argomento in pairs:
+                ids, seconds = self._timed_query(collection, model_name, argomento, k, None)
+                hits += doc_id in ids
+                elapsed += seconds
+            report[label] = {"modello": model_name, "recall": hits / max(len(pairs), 1),
+                             "ms_medi": elapsed / max(len(pairs), 1) * 1000}
+        report["domande"] = len(pairs)
+        return report
+    
+    def swap(self) -> Dict:
+        """Rende attivo l'indice ombra: recupera i documenti arrivati nel frattempo e sposta il puntatore.
+
+        Il recupero si ripete dopo lo spostamento: i caricamenti arrivati tra il primo recupero e
+        lo scambio (o da processi che non hanno ancora seguito il puntatore) restano nel vecchio indice.
+        """
+        if self.state != "pronta":
+            raise ValueError(f"Indice ombra non pronto (stato: {self.state})")
+        self._copy_missing(self.source, self.collection, self.model)
+        self._copy_metadata(self.source, self.collection)
+        previous = {"modello": self.source_model, "collezione": self.source.name}
+        scrivi_indice_attivo(self.client, self.model, self.collection.name, previous)
+        self._copy_missing(self.source, self.collection, self.model)
+        self._copy_metadata(self.source, self.collection)
+        self.state = "inattiva"
+        return {"modello": self.model, "collezione": self.collection.name, "precedente": previous}
+    
+    def rollback(self, assistant: "SchoolUnionAssistant") -> Dict:
+        """Torna all'indice precedente, riallineandolo ai documenti aggiunti dopo lo scambio"""
+        active = leggi_indice_attivo(assistant.chroma_client)
+        if not active.get("precedente_collezione"):
+            raise ValueError("Nessun indice precedente a cui tornare")
+        current = apri_collezione(assistant.chroma_client, active["collezione"])
+        previous = apri_collezione(assistant.chroma_client, active["precedente_collezione"])
+        self._copy_missing(current, previous, active["precedente_modello"])
+        self._copy_metadata(current, previous)
+        scrivi_indice_attivo(assistant.chroma_client, active["precedente_modello"], previous.name,
+                             {"modello": active["modello"], "collezione": current.name})
+        # Come nello scambio: recupero finale dei caricamenti arrivati durante lo spostamento
+        self._copy_missing(current, previous, active["precedente_modello"])
+        self._copy_metadata(current, previous)
+        return {"modello": active["precedente_modello"], "collezione": previous.name}
+
+
+class CompactVectorIndex:
+    """Indice vettoriale compatto: codici int8 in memoria (proiezione PCA o troncamento), vettori float16 su disco.
+
+    Con l'indice attivo la ricerca vettoriale non passa da Chroma: né l'HNSW né i vettori float32
+    vengono letti per rispondere. La copia float16 per il rescoring è un file temporaneo mappato in
+    memoria: restano in RAM solo le pagine delle righe rilette, e il sistema può liberarle.
+    """
+    
+    def __init__(self, dim: int = DIMENSIONE_RIDOTTA, matryoshka: bool = False, rescoring_dir: str = DATA_DIR):
+        self.target_dim = dim
+        self.matryoshka = matryoshka
+        self.rescoring_dir = rescoring_dir
+        self.method = None
+        self.provisional = False
+        self.mean = None
+        self.components = None
+        self.version = None
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.codes = None
+        self.scales = None
+        self.valid_from = None
+        self.valid_to = None
+        self.full_dim = 0
+        self.source = None
+        self._full_file = None
+        self._full = None
+        self._lock = threading.Lock()
+    
+    def fit(self, vectors: np.ndarray):
+        """Sceglie la proiezione: PCA se ci sono abbastanza vettori, altrimenti provvisoria"""
+        self.full_dim = vectors.shape[1]
+        self.provisional = False
+        if not self.target_dim or self.target_dim >= self.full_dim:
+            self.method = "nessuna"
+        elif len(vectors) >= self.target_dim:
+            self.method = "pca"
+            self.mean = vectors.mean(axis=0)
+            _, _, vt = np.linalg.svd(vectors - self.mean, full_matrices=False)
+            self.components = vt[:self.target_dim].T.astype(np.float32)
+        else:
+            # Troppo pochi vettori per la PCA: troncamento solo per i modelli Matryoshka,
+            # altrimenti dimensione piena; sync ricalcola la proiezione quando il corpus cresce
+            self.method = "troncamento" if self.matryoshka else "nessuna"
+            self.provisional = True
+        dim = self.full_dim if self.method == "nessuna" else self.target_dim
+        self.ids, self.rows = [], {}
+        self.codes = np.zeros((0, dim), dtype=np.int8)
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.valid_from = np.zeros(0, dtype=np.int32)
+        self.valid_to = np.zeros(0, dtype=np.int32)
+        if self._full_file is not None:
+            self._full_file.close()
+        os.makedirs(self.rescoring_dir, exist_ok=True)
+        # Su disco e non in /tmp, che spesso è in RAM (tmpfs)
+        self._full_file = tempfile.TemporaryFile(dir=self.rescoring_dir, prefix="rescoring-")
+        self._full = None
+    
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.method == "pca":
+            vectors = (vectors - self.mean) @ self.components
+        elif self.method == "troncamento":
+            vectors = vectors[:, :self.target_dim]
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    
+    def add(self, ids: List[str], vectors: np.ndarray, metadatas: Optional[List[Dict]] = None):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        metadatas = metadatas or [{} for _ in ids]
+        with self._lock:
+            if self.method is None:
+                self.fit(vectors)
+            projected = self.project(vectors)
+            scales = np.maximum(np.abs(projected).max(axis=1), 1e-12) / 127.0
+            codes = np.round(projected / scales[:, None]).astype(np.int8)
+            self.rows.update((doc_id, len(self.ids) + i) for i, doc_id in enumerate(ids))
+            self.ids.extend(ids)
+            self.codes = np.vstack([self.codes, codes])
+            self.scales = np.concatenate([self.scales, scales.astype(np.float32)])
+            self.valid_from = np.concatenate([self.valid_from, np.array(
+                [meta.get("valido_dal", SEMPRE_VALIDO_DAL) for meta in metadatas], dtype=np.int32)])
+            self.valid_to = np.concatenate([self.valid_to, np.array(
+                [meta.get("valido_al", SEMPRE_VALIDO_AL) for meta in metadatas], dtype=np.int32)])
+            full = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            self._full_file.seek(0, os.SEEK_END)
+            self._full_file.write(full.astype(np.float16).tobytes())
+            self._full_file.flush()
+            self._full = np.memmap(self._full_file, dtype=np.float16, mode="r", shape=(len(self.ids), self.full_dim))
+    
+    def update_validity(self, doc_id: str, metadata: Dict):
+        with self._lock:
+            row = self.rows.get(doc_id)
+            if row is not None:
+                self.valid_from[row] = metadata.get("valido_dal", SEMPRE_VALIDO_DAL)
+                self.valid_to[row] = metadata.get("valido_al", SEMPRE_VALIDO_AL)
+    
+    def search(self, query_vector: np.ndarray, k: int, data_riferimento: Optional[int] = None,
+               rescoring: int = FATTORE_RESCORING, block: int = 65536) -> List[Tuple[str, float]]:
+        """Top-k in vigore alla data: prodotto scalare sui codici int8 a blocchi, poi coseno sui float16
+        dei `k * rescoring` migliori candidati (senza rescoring, i punteggi approssimati)"""
+        with self._lock:
+            if not self.ids:
+                return []
+            day = data_riferimento or data_int(date.today())
+            query = self.project(query_vector)[0]
+            scores = np.empty(len(self.ids), dtype=np.float32)
+            for start in range(0, len(self.ids), block):
+                chunk = self.codes[start:start + block].astype(np.float32)
+                scores[start:start + block] = (chunk @ query) * self.scales[start:start + block]
+            valid = (self.valid_from <= day) & (self.valid_to >= day)
+            scores[~valid] = -np.inf
+            n = min(k * max(rescoring, 1), int(valid.sum()))
+            if n == 0:
+                return []
+            top = np.argpartition(-scores, n - 1)[:n]
+            if rescoring:
+                top.sort()  # righe in ordine di file: letture sequenziali dalla mappa
+                full_query = np.asarray(query_vector, dtype=np.float32).ravel()
+                full_query = full_query / max(float(np.linalg.norm(full_query)), 1e-12)
+                scores = np.zeros(len(self.ids), dtype=np.float32)
+                scores[top] = self._full[top].astype(np.float32) @ full_query
+            top = top[np.argsort(-scores[top])][:k]
+            return [(self.ids[i], float(scores[i])) for i in top]
+    
+    def vectors(self, ids: List[str]) -> np.ndarray:
+        """Vettori (normalizzati) dalla copia float16, per chi li chiede con i risultati"""
+        with self._lock:
+            return self._full[[self.rows[doc_id] for doc_id in ids]].astype(np.float32)
+    
+    def sync(self, collection, corpus_version: str, model: Optional[str] = None, batch: int = 1000):
+        """Allinea l'indice alla collection, aggiungendo solo i vettori mancanti.
+        
+        I vettori float32 si leggono a lotti: in memoria non c'è mai la copia completa.
+        """
+        if self.version == corpus_version:
+            return
+        ids = collection.get(include=[])["ids"]
+        refit = self.provisional and len(ids) >= self.target_dim
+        if set(self.ids) - set(ids) or collection.name != self.source or refit:
+            # Documenti rimossi, nuovo modello di embedding o abbastanza vettori per la PCA:
+            # si ricostruisce (e si ricalcola la proiezione, stimata sul primo lotto)
+            with self._lock:
+                self.method, self.ids, self.rows = None, [], {}
+                if model is not None:
+                    self.matryoshka = model in MODELLI_MATRYOSHKA
+            self.source = collection.name
+        missing = [doc_id for doc_id in ids if doc_id not in self.rows]
+        for start in range(0, len(missing), batch):
+            data = collection.get(ids=missing[start:start + batch], include=["embeddings", "metadatas"])
+            self.add(data["ids"], np.asarray(data["embeddings"], dtype=np.float32), data["metadatas"])
+        self.version = corpus_version
+    
+    def memory_bytes(self) -> int:
+        """Memoria residente: codici, scale, validità e proiezione (la copia float16 è su disco)"""
+        if self.codes is None:
+            return 0
+        projection = self.components.nbytes + self.mean.nbytes if self.method == "pca" else 0
+        return self.codes.nbytes + self.scales.nbytes + self.valid_from.nbytes + self.valid_to.nbytes + projection
+    
+    def disk_bytes(self) -> int:
+        return len(self.ids) * self.full_dim * 2
+
+
+@st.cache_resource
+def get_audit_log() -> AuditLog:
+    """Registro di audit unico per processo (disattivo con SINDACATO_AUDIT vuota)"""
+    return AuditLog(REGISTRO_AUDIT)
+
+
+@st.cache_resource
+def get_chroma_client():
+    """Un client Chroma per processo (non per sessione)"""
+    return crea_chroma_client()
+
+
+@st.cache_resource
+def get_collection_cache() -> Dict:
+    """Collection già aperte e migrate, per nome"""
+    return {}
+
+
+@st.cache_resource
+def get_local_llm() -> LocalLLMClient:
+    """Un solo modello locale per processo: slot e cache del prefisso condivisi da tutte le sessioni"""
+    return LocalLLMClient(LLM_LOCALE, slots=SLOT_LLM_LOCALE, n_ctx=CONTESTO_LLM_LOCALE,
+                          chat_format=FORMATO_LLM_LOCALE, prefix=(PROMPT_SISTEMA, ISTRUZIONI_PROMPT))
+
+
+@st.cache_resource
+def get_embedding_model(nome: str) -> SentenceTransformer:
+    """Modelli di embedding caricati una volta per processo (attivo e, in migrazione, ombra)"""
+    return SentenceTransformer(nome)
+
+
+@st.cache_resource
+def get_index_migration() -> IndexMigration:
+    return IndexMigration()
+
+
+@st.cache_resource
+def get_compact_index() -> CompactVectorIndex:
+    """Indice compatto condiviso dalle sessioni del processo"""
+    return CompactVectorIndex(matryoshka=MODELLO_EMBEDDING in MODELLI_MATRYOSHKA)
+
+
+@st.cache_resource
+def get_shard_index() -> ShardedVectorIndex:
+    """Pool di processi degli shard, condiviso dalle sessioni del processo"""
+    return ShardedVectorIndex(PROCESSI_SHARD, MAX_DOCUMENTI_PER_SHARD)
+
+
+@st.cache_resource
+def get_traffic_recorder() -> TrafficRecorder:
+    """Registro del traffico condiviso dalle sessioni del processo"""
+    return TrafficRecorder(REGISTRO_TRAFFICO)
+
+
+@st.cache_resource
+def get_fact_index() -> FactIndex:
+    """Tabella dei valori contrattuali condivisa dalle sessioni del processo"""
+    return FactIndex()
+
+
+@st.cache_resource
+def get_query_expander() -> QueryExpander:
+    """Dizionario di sigle e sinonimi condiviso dalle sessioni del processo"""
+    return QueryExpander()
+
+
+@st.cache_resource
+def get_lexical_index() -> LexicalIndex:
+    """Indice lessicale condiviso dalle sessioni del processo"""
+    return LexicalIndex()
+
+
+@st.cache_resource
+def get_speculative_searcher() -> SpeculativeSearcher:
+    return SpeculativeSearcher()
+
+
+@st.cache_resource
+def get_search_cursors() -> SearchCursors:
+    return SearchCursors()
+
+
+class _Flight:
+    """Esecuzione in corso condivisa da più richiedenti"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SharedStream:
+    """Flusso di token letto una sola volta dall'upstream e riprodotto per ogni iscritto"""
+    
+    def __init__(self, tokens: Iterator[str], on_close):
+        self.tokens: List[str] = []
+        self.finished = False
+        self.error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._pump, args=(tokens, on_close), daemon=True)
+        self._thread.start()
+    
+    def _pump(self, tokens: Iterator[str], on_close):
+        try:
+            for token in tokens:
+                with self._cond:
+                    self.tokens.append(token)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            on_close()
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+    
+    def subscribe(self) -> Iterator[str]:
+        position = 0
+        while True:
+            with self._cond:
+                while position >= len(self.tokens) and not self.finished:
+                    self._cond.wait()
+                pending = self.tokens[position:]
+                finished = self.finished
+            for token in pending:
+                yield token
+            position += len(pending)
+            if finished and position >= len(self.tokens):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlight:
+    """Accorpa le richieste identiche in corso: una sola chiamata upstream, risultato condiviso"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[tuple, _Flight] = {}
+        self._streams: Dict[tuple, Tuple[_SharedStream, List[Dict]]] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+    
+    def _count(self, operation: str, shared: bool):
+        counters = self.stats.setdefault(operation, {"eseguite": 0, "accorpate": 0})
+        counters["accorpate" if shared else "eseguite"] += 1
+    
+    def do(self, key: tuple, fn):
+        """Esegue `fn` oppure attende il risultato della stessa chiamata già in corso"""
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _Flight()
+            self._count(key[0], shared=not leader)
         
-        if 'school_chroma_client' not in st.session_state:
-            st.session_state.school_chroma_client = chromadb.Client()
-            try:
-                st.session_state.school_collection = st.session_state.school_chroma_client.get_collection("school_docs")
-            except:
-                st.session_state.school_collection = st.session_state.school_chroma_client.create_collection(
-                    name="school_docs",
-                    metadata={"hnsw:space": "cosine"}
-                )
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
         
-        self.collection = st.session_state.school_collection
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight.done.set()
     
-    def preload_contracts(self):
-        """Precarica le normative scolastiche"""
-        if self.collection.count() > 0:
-            return False
+    def do_stream(self, key: tuple, fn) -> Tuple[Iterator[str], List[Dict]]:
+        """Come do(), ma condivide un flusso di token: chi arriva dopo lo riceve dall'inizio.
+
+        `fn` restituisce (token, dati): i dati (fonti, traccia…) sono condivisi così come sono.
+        """
+        with self._lock:
+            entry = self._streams.get(key)
+            if entry is not None:
+                self._count(key[0], shared=True)
+        if entry is not None:
+            stream, sources = entry
+            return stream.subscribe(), sources
         
-        all_docs = []
-        all_metadata = []
+        # La preparazione (retrieval e apertura del flusso) passa anch'essa da do()
+        def open_stream():
+            tokens, sources = fn()
+            
+            def close():
+                with self._lock:
+                    self._streams.pop(key, None)
+            
+            with self._lock:
+                stream = _SharedStream(tokens, close)
+                if not stream.finished:
+                    self._streams[key] = (stream, sources)
+            return stream, sources
         
-        for categoria, contenuti in NORMATIVE_SCUOLA.items():
-            for item in contenuti:
-                all_docs.append(f"{item['argomento']}: {item['contenuto']}")
-                all_metadata.append({
-                    "categoria": categoria,
-                    "argomento": item['argomento'],
-                    "data_caricamento": datetime.now().isoformat()
-                })
+        stream, sources = self.do(key + ("apertura",), open_stream)
+        return stream.subscribe(), sources
+    
+    def avoided(self) -> int:
+        """Chiamate upstream evitate grazie all'accorpamento"""
+        return sum(counters["accorpate"] for counters in self.stats.values())
+
+
+@st.cache_resource
+def get_singleflight() -> SingleFlight:
+    """Registro delle richieste in corso condiviso da tutte le sessioni del processo"""
+    return SingleFlight()
+
+
+class SovraccaricoError(RuntimeError):
+    """Richiesta scartata dal controllo di ammissione"""
+
+
+class _Ticket:
+    def __init__(self, session_id: str, priority: int, start: float, finish: float, seq: int):
+        self.session_id = session_id
+        self.priority = priority
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.granted = False
+        self.enqueued = time.monotonic()
+    
+    def sort_key(self, now: float, aging: float):
+        # La priorità effettiva migliora con l'attesa: le richieste batch prima o poi passano
+        priority = max(PRIORITA_INTERATTIVA, self.priority - int((now - self.enqueued) / aging)) if aging else self.priority
+        return (priority, self.finish, self.seq)
+
+
+class AdmissionController:
+    """Ammissione equa alla capacità LLM: token bucket per sessione, code pesate, priorità"""
+    
+    def __init__(self, capacity: int = CHIAMATE_LLM_CONTEMPORANEE,
+                 rate_per_minute: float = DOMANDE_AL_MINUTO_PER_SESSIONE,
+                 burst: int = RAFFICA_PER_SESSIONE, max_queue: int = 64, max_wait: float = ATTESA_MASSIMA_CODA,
+                 aging: float = INVECCHIAMENTO_CODA, prune_every: int = 256):
+        self.capacity = capacity
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.aging = aging
+        self.prune_every = prune_every
+        self._cond = threading.Condition()
+        self._buckets: Dict[str, List[float]] = {}
+        self._last_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._queue: List[_Ticket] = []
+        self._running = 0
+        self._seq = 0
+        self.stats = {"ammesse": 0, "limite_sessione": 0, "coda_piena": 0, "attesa_scaduta": 0}
+    
+    def _take_token(self, session_id: str) -> bool:
+        now = time.monotonic()
+        tokens, last = self._buckets.get(session_id, (float(self.burst), now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[session_id] = [tokens, now]
+            return False
+        self._buckets[session_id] = [tokens - 1.0, now]
+        return True
+    
+    def _prune(self):
+        """Dimentica le sessioni inattive: bucket di nuovo pieno e nessun tempo virtuale in sospeso"""
+        now = time.monotonic()
+        if self.rate > 0:
+            for session_id, (tokens, last) in list(self._buckets.items()):
+                if tokens + (now - last) * self.rate >= self.burst:
+                    del self._buckets[session_id]
+        # Il tempo virtuale serve solo a chi è in coda o ha chiesto di recente (bucket non ancora pieno)
+        queued = {ticket.session_id for ticket in self._queue}
+        for session_id, finish in list(self._last_finish.items()):
+            if session_id not in queued and (finish <= self._virtual_time or session_id not in self._buckets):
+                del self._last_finish[session_id]
+    
+    def submit(self, session_id: str, priority: int = PRIORITA_INTERATTIVA, weight: float = 1.0) -> Optional[_Ticket]:
+        """Mette in coda la richiesta; None se va scartata"""
+        with self._cond:
+            # Il token bucket limita le persone, non il lavoro di sistema (batch)
+            if priority == PRIORITA_INTERATTIVA and not self._take_token(session_id):
+                self.stats["limite_sessione"] += 1
+                return None
+            if len(self._queue) >= self.max_queue:
+                self.stats["coda_piena"] += 1
+                return None
+            # Start-time fair queuing: ogni sessione avanza il proprio tempo virtuale
+            start = max(self._virtual_time, self._last_finish.get(session_id, 0.0))
+            finish = start + 1.0 / weight
+            self._last_finish[session_id] = finish
+            self._seq += 1
+            if self._seq % self.prune_every == 0:
+                self._prune()
+            ticket = _Ticket(session_id, priority, start, finish, self._seq)
+            self._queue.append(ticket)
+            self._dispatch()
+            return ticket
+    
+    def _dispatch(self):
+        while self._running < self.capacity and self._queue:
+            now = time.monotonic()
+            ticket = min(self._queue, key=lambda other: other.sort_key(now, self.aging))
+            self._queue.remove(ticket)
+            self._virtual_time = max(self._virtual_time, ticket.start)
+            ticket.granted = True
+            self._running += 1
+            self.stats["ammesse"] += 1
+        self._cond.notify_all()
+    
+    def position(self, ticket: _Ticket) -> int:
+        """Posizione in coda (0 = già ammessa)"""
+        with self._cond:
+            if ticket.granted:
+                return 0
+            now = time.monotonic()
+            key = ticket.sort_key(now, self.aging)
+            return 1 + sum(other.sort_key(now, self.aging) < key for other in self._queue)
+    
+    def wait(self, ticket: _Ticket, timeout: float) -> bool:
+        with self._cond:
+            self._cond.wait_for(lambda: ticket.granted, timeout=timeout)
+            return ticket.granted
+    
+    def cancel(self, ticket: _Ticket):
+        with self._cond:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                self.stats["attesa_scaduta"] += 1
+    
+    def release(self, ticket: _Ticket):
+        with self._cond:
+            if ticket.granted:
+                ticket.granted = False
+                self._running -= 1
+                self._dispatch()
+    
+    def queue_length(self) -> int:
+        with self._cond:
+            return len(self._queue)
+    
+    def acquire(self, session_id: str, priority: int = PRIORITA_INTERATTIVA, weight: float = 1.0,
+                on_wait=None) -> Optional[_Ticket]:
+        """Attende il proprio turno; None se la richiesta è scartata o l'attesa scade"""
+        ticket = self.submit(session_id, priority, weight)
+        if ticket is None:
+            return None
+        deadline = time.monotonic() + self.max_wait
+        while not self.wait(ticket, 0.25):
+            if time.monotonic() >= deadline:
+                self.cancel(ticket)
+                if not ticket.granted:
+                    return None
+                break
+            if on_wait is not None:
+                on_wait(self.position(ticket))
+        return ticket
+    
+    def run(self, session_id: str, fn, fallback=None, priority: int = PRIORITA_INTERATTIVA,
+            weight: float = 1.0, on_wait=None):
+        """Esegue `fn` quando ammessa; altrimenti `fallback` (o SovraccaricoError)"""
+        ticket = self.acquire(session_id, priority, weight, on_wait)
+        if ticket is None:
+            if fallback is None:
+                raise SovraccaricoError("Sistema sovraccarico, riprova tra poco")
+            return fallback()
+        try:
+            return fn()
+        finally:
+            self.release(ticket)
+
+
+@st.cache_resource
+def get_admission_controller() -> AdmissionController:
+    """Unico controllo di ammissione: la quota Groq è condivisa da tutte le sessioni"""
+    return AdmissionController()
+
+
+class FAQStore:
+    """Archivio persistente delle risposte precalcolate alle domande frequenti"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_error = None
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+    
+    @property
+    def warming(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def get(self, faq: Dict, model: str, corpus_version: str) -> Optional[Dict]:
+        """Risposta precalcolata, solo se generata per questa domanda, modello e corpus"""
+        with self._lock:
+            entry = self._entries.get(faq["id"], {}).get(model)
+        if entry and entry["domanda"] == faq["domanda"] and entry["corpus_version"] == corpus_version:
+            return entry
+        return None
+    
+    def put(self, faq: Dict, model: str, corpus_version: str, response: str, sources: List[Dict]):
+        """Salva una risposta e riscrive l'archivio su disco"""
+        entry = {
+            "domanda": faq["domanda"],
+            "risposta": response,
+            "fonti": sources,
+            "corpus_version": corpus_version,
+            "generato_il": datetime.now().isoformat()
+        }
+        with self._lock:
+            self._entries.setdefault(faq["id"], {})[model] = entry
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+    
+    def find(self, question: str, model: str, corpus_version: str) -> Optional[Dict]:
+        """Risposta precalcolata per una domanda che coincide con una FAQ"""
+        normalized = " ".join(tokenizza(question))
+        with self._lock:
+            entries = [entry.get(model) for entry in self._entries.values()]
+        for entry in entries:
+            if entry and entry["corpus_version"] == corpus_version and " ".join(tokenizza(entry["domanda"])) == normalized:
+                return entry
+        return None
+    
+    def pending(self, faqs: List[Dict], model: str, corpus_version: str) -> List[Dict]:
+        return [faq for faq in faqs if self.get(faq, model, corpus_version) is None]
+    
+    def warmup(self, assistant: "SchoolUnionAssistant", faqs: List[Dict], model: str,
+               corpus_version: Optional[str] = None, force: bool = False) -> bool:
+        """Avvia in background la generazione delle risposte mancanti o superate"""
+        if self.warming:
+            return False
+        corpus_version = corpus_version or assistant.current_version()
+        todo = list(faqs) if force else self.pending(faqs, model, corpus_version)
+        if not todo:
+            return False
         
-        embeddings = self.embedding_model.encode(all_docs).tolist()
-        ids = [f"doc_{i}" for i in range(len(all_docs))]
+        admission = get_admission_controller()
         
-        self.collection.add(
-            embeddings=embeddings,
-            documents=all_docs,
-            ids=ids,
-            metadatas=all_metadata
-        )
+        def run():
+            for faq in todo:
+                try:
+                    response, sources = admission.run(
+                        "faq-warmup",
+                        lambda: assistant.answer_question(faq["domanda"], model=model, mode=MODALITA_LLM),
+                        priority=PRIORITA_BATCH
+                    )
+                    self.put(faq, model, corpus_version, response, sources)
+                except Exception as e:
+                    self.last_error = str(e)
         
+        self._thread = threading.Thread(target=run, name="faq-warmup", daemon=True)
+        self._thread.start()
         return True
+
+
+class ConversationStore:
+    """Archivio SQLite delle conversazioni, con limiti di dimensione per conversazione"""
     
-    def add_custom_content(self, text: str, categoria: str, argomento: str):
-        """Aggiungi contenuto personalizzato"""
-        embeddings = self.embedding_model.encode([text]).tolist()
-        doc_id = f"custom_{self.collection.count()}"
-        
-        self.collection.add(
-            embeddings=embeddings,
-            documents=[text],
-            ids=[doc_id],
-            metadatas=[{
-                "categoria": categoria,
-                "argomento": argomento,
-                "tipo": "personalizzato",
-                "data_caricamento": datetime.now().isoformat()
-            }]
-        )
+    def __init__(self, path: str, max_messages: int = MAX_MESSAGGI_CONVERSAZIONE,
+                 max_chars: int = MAX_CARATTERI_CONVERSAZIONE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS messaggi (
+                conversazione TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                ruolo TEXT NOT NULL,
+                contenuto BLOB NOT NULL,
+                caratteri INTEGER NOT NULL,
+                fonti TEXT,
+                creato TEXT NOT NULL,
+                PRIMARY KEY (conversazione, seq)
+            ) WITHOUT ROWID
+        """)
+        self._db.commit()
     
-    def search_content(self, query: str, n_results: int = 4):
-        """Cerca contenuti rilevanti"""
-        query_embedding = self.embedding_model.encode([query]).tolist()
-        
-        results = self.collection.query(
-            query_embeddings=query_embedding,
-            n_results=n_results
-        )
-        
-        return results
+    @staticmethod
+    def _pack(content: str):
+        # I testi lunghi vengono compressi, quelli brevi restano leggibili
+        if len(content) > 1024:
+            return zlib.compress(content.encode("utf-8"))
+        return content
     
-    def answer_question(self, question: str, model: str = "llama-3.3-70b-versatile"):
-        """Risponde alla domanda con RAG"""
-        results = self.search_content(question, n_results=4)
-        
-        if not results['documents'][0]:
-            context = "Nessun documento rilevante trovato."
-            sources = []
+    @staticmethod
+    def _unpack(content) -> str:
+        if isinstance(content, bytes):
+            return zlib.decompress(content).decode("utf-8")
+        return content
+    
+    def append(self, conversation_id: str, role: str, content: str, sources: Optional[List[Dict]] = None):
+        """Aggiunge un messaggio e applica i limiti della conversazione"""
+        fonti = json.dumps(sources, ensure_ascii=False, separators=(",", ":")) if sources else None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM messaggi WHERE conversazione = ?", (conversation_id,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT INTO messaggi VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (conversation_id, row[0] + 1, role, self._pack(content), len(content), fonti,
+                 datetime.now().isoformat())
+            )
+            self._enforce_caps(conversation_id)
+            self._db.commit()
+    
+    def _enforce_caps(self, conversation_id: str):
+        rows = self._db.execute(
+            "SELECT seq, caratteri FROM messaggi WHERE conversazione = ? ORDER BY seq DESC", (conversation_id,)
+        ).fetchall()
+        kept_chars = 0
+        for i, (seq, caratteri) in enumerate(rows):
+            kept_chars += caratteri
+            # Il messaggio più recente non viene mai scartato
+            if i > 0 and (i >= self.max_messages or kept_chars > self.max_chars):
+                self._db.execute(
+                    "DELETE FROM messaggi WHERE conversazione = ? AND seq <= ?", (conversation_id, seq)
+                )
+                break
+    
+    def count(self, conversation_id: str) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM messaggi WHERE conversazione = ?", (conversation_id,)
+            ).fetchone()[0]
+    
+    def last_messages(self, conversation_id: str, limit: int) -> List[Dict]:
+        """Ultimi `limit` messaggi in ordine cronologico"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ruolo, contenuto, fonti FROM messaggi WHERE conversazione = ? ORDER BY seq DESC LIMIT ?",
+                (conversation_id, limit)
+            ).fetchall()
+        return [
+            {"role": ruolo, "content": self._unpack(contenuto), "sources": json.loads(fonti) if fonti else []}
+            for ruolo, contenuto, fonti in reversed(rows)
+        ]
+    
+    def clear(self, conversation_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM messaggi WHERE conversazione = ?", (conversation_id,))
+            self._db.commit()
+
+
+def stima_byte(value) -> int:
+    """Ingombro stimato di un valore: dimensione serializzata (o sys.getsizeof se non serializzabile)"""
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class SessionBox:
+    """Stato pesante di una sessione (cronologia, risultati): in memoria oppure su disco"""
+    
+    def __init__(self, key: str):
+        self.key = key
+        self.values: Dict[str, object] = {}
+        self.sizes: Dict[str, int] = {}
+        self.state_bytes = 0
+        self.last_seen = time.time()
+        self.spilled = False
+        self.lock = threading.Lock()
+    
+    def memory_bytes(self) -> int:
+        return self.state_bytes + (0 if self.spilled else sum(self.sizes.values()))
+
+
+class SessionRegistry:
+    """Contabilità della memoria per sessione; le sessioni inattive o in eccesso vanno su disco"""
+    
+    def __init__(self, path: str, budget: int = BUDGET_MEMORIA_SESSIONI, idle_timeout: float = INATTIVITA_SESSIONE,
+                 sweep_interval: float = 60.0):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.budget = budget
+        self.idle_timeout = idle_timeout
+        self.stats = {"su_disco": 0, "ripristinate": 0, "byte_liberati": 0}
+        self._boxes: Dict[str, SessionBox] = {}
+        # Nel report le sessioni compaiono solo come pseudonimi
+        self._salt = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        threading.Thread(target=self._sweep, args=(sweep_interval,), daemon=True, name="sessioni").start()
+    
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.pkl.z")
+    
+    def _box(self, key: str) -> SessionBox:
+        with self._lock:
+            box = self._boxes.get(key)
+            if box is None:
+                box = self._boxes[key] = SessionBox(key)
+                # Sessione spostata su disco da un processo precedente
+                box.spilled = os.path.exists(self._file(key))
+            box.last_seen = time.time()
+            return box
+    
+    def touch(self, key: str, state: Dict):
+        """A ogni esecuzione dello script: stima di st.session_state e controllo del budget.
+
+        Lo stato pesante sta nel SessionBox (misurato una volta, a ogni put): in st.session_state
+        restano id, contatori e flag, per cui basta sys.getsizeof senza serializzare nulla.
+        """
+        box = self._box(key)
+        box.state_bytes = sum(sys.getsizeof(value) for value in state.values())
+        self.enforce(exclude=key)
+    
+    def get(self, key: str, name: str):
+        box = self._box(key)
+        with box.lock:
+            if box.spilled:
+                self._restore(box)
+            return box.values.get(name)
+    
+    def put(self, key: str, name: str, value):
+        box = self._box(key)
+        size = stima_byte(value)
+        with box.lock:
+            if box.spilled:
+                self._restore(box)
+            box.values[name] = value
+            box.sizes[name] = size
+        if self.memory_bytes() > self.budget:
+            self.enforce(exclude=key)
+    
+    def _spill(self, box: SessionBox) -> int:
+        with box.lock:
+            if box.spilled or not box.values:
+                return 0
+            tmp_path = self._file(box.key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(pickle.dumps({"valori": box.values, "dimensioni": box.sizes})))
+            os.replace(tmp_path, self._file(box.key))
+            freed = sum(box.sizes.values())
+            box.values = {}
+            box.spilled = True
+        self.stats["su_disco"] += 1
+        self.stats["byte_liberati"] += freed
+        return freed
+    
+    def _restore(self, box: SessionBox):
+        """Ripristino pigro: al primo accesso dopo lo spostamento su disco (chiamato con box.lock)"""
+        path = self._file(box.key)
+        try:
+            with open(path, "rb") as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+            box.values, box.sizes = data["valori"], data["dimensioni"]
+            os.remove(path)
+            self.stats["ripristinate"] += 1
+        except (OSError, ValueError, zlib.error, pickle.UnpicklingError, KeyError):
+            # File mancante o illeggibile: lo stato verrà ricalcolato
+            box.values, box.sizes = {}, {}
+        box.spilled = False
+    
+    def memory_bytes(self) -> int:
+        with self._lock:
+            boxes = list(self._boxes.values())
+        return sum(box.memory_bytes() for box in boxes)
+    
+    def enforce(self, exclude: Optional[str] = None, idle_timeout: Optional[float] = None) -> int:
+        """Su disco le sessioni inattive, poi le meno recenti finché si rientra nel budget"""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.time()
+        with self._lock:
+            boxes = sorted(self._boxes.values(), key=lambda box: box.last_seen)
+        freed = 0
+        for box in boxes:
+            if box.key != exclude and now - box.last_seen > idle_timeout:
+                freed += self._spill(box)
+        total = sum(box.memory_bytes() for box in boxes)
+        for box in boxes:
+            if total <= self.budget:
+                break
+            if box.key != exclude:
+                spilled = self._spill(box)
+                total -= spilled
+                freed += spilled
+        # Sessioni abbandonate da troppo tempo: si dimenticano anche su disco
+        with self._lock:
+            for box in boxes:
+                if now - box.last_seen > SCADENZA_SESSIONI_SU_DISCO and box.key != exclude:
+                    self._boxes.pop(box.key, None)
+                    if os.path.exists(self._file(box.key)):
+                        os.remove(self._file(box.key))
+            known = {os.path.basename(self._file(key)) for key in self._boxes}
+        # File di sessioni che nessun processo attivo conosce più (es. prima di un riavvio)
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if name not in known and now - os.path.getmtime(path) > SCADENZA_SESSIONI_SU_DISCO:
+                    os.remove(path)
+            except OSError:
+                pass
+        return freed
+    
+    def _sweep(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.enforce()
+            except Exception:
+                logging.getLogger("sindacato.sessioni").exception("Pulizia delle sessioni non riuscita")
+    
+    def report(self, limit: int = 20) -> List[Dict]:
+        """Sessioni più grandi, per l'amministratore"""
+        now = time.time()
+        with self._lock:
+            boxes = list(self._boxes.values())
+        rows = [
+            {
+                "sessione": hashlib.sha256((self._salt + box.key).encode("utf-8")).hexdigest()[:12],
+                "kb_memoria": round(box.memory_bytes() / 1024, 1),
+                "kb_stato": round(sum(box.sizes.values()) / 1024, 1),
+                "voci": ", ".join(sorted(box.sizes)),
+                "inattiva_s": int(now - box.last_seen),
+                "su_disco": box.spilled,
+            }
+            for box in boxes
+        ]
+        return sorted(rows, key=lambda row: (-row["kb_memoria"], -row["kb_stato"]))[:limit]
+    
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+
+@st.cache_resource
+def get_session_registry() -> SessionRegistry:
+    return SessionRegistry(os.path.join(DATA_DIR, "sessioni"))
+
+
+@st.cache_resource
+def get_conversation_store() -> ConversationStore:
+    """Archivio conversazioni condiviso da tutte le sessioni del processo"""
+    return ConversationStore(os.path.join(DATA_DIR, "conversazioni.db"))
+
+
+def get_tab_id() -> str:
+    """Sessione Streamlit (scheda del browser): lo stato in memoria non si condivide tra schede"""
+    if "tab_id" not in st.session_state:
+        st.session_state.tab_id = uuid.uuid4().hex
+    return st.session_state.tab_id
+
+
+def is_admin() -> bool:
+    """Accesso ai pannelli che agiscono su tutti gli utenti (indice, migrazione, sessioni)"""
+    return bool(CHIAVE_AMMINISTRAZIONE) and st.session_state.get("amministratore", False)
+
+
+def get_conversation_id() -> str:
+    """Identificativo segreto della conversazione: in un cookie del browser, mai nell'URL condivisibile"""
+    if "conversation_id" not in st.session_state:
+        cookie = st.context.cookies.get(COOKIE_CONVERSAZIONE, "")
+        if re.fullmatch(r"[0-9a-f]{32}", cookie):
+            st.session_state.conversation_id = st.session_state.conversation_cookie = cookie
         else:
-            docs = results['documents'][0]
-            metas = results['metadatas'][0]
-            
-            context_parts = []
-            sources = []
-            
-            for i, (doc, meta) in enumerate(zip(docs, metas)):
-                context_parts.append(f"[Fonte {i+1} - {meta['categoria']}, {meta['argomento']}]\n{doc}")
-                sources.append({
-                    "categoria": meta['categoria'],
-                    "argomento": meta['argomento']
-                })
-            
-            context = "\n\n".join(context_parts)
-        
-        prompt = f"""Sei un esperto consulente sindacale specializzato nel personale della scuola italiana (docenti, ATA, dirigenti). Conosci perfettamente CCNL Scuola, normative, contratti, graduatorie, concorsi.
+            st.session_state.conversation_id = uuid.uuid4().hex
+    if "conv" in st.query_params:
+        # Link delle versioni precedenti: l'id nell'URL non apre più la conversazione
+        del st.query_params["conv"]
+    conversation_id = st.session_state.conversation_id
+    if st.session_state.get("conversation_cookie") != conversation_id:
+        # Il cookie sopravvive al refresh; SameSite=Strict: non viene inviato da link di altri siti
+        st.html(
+            f"<script>document.cookie = '{COOKIE_CONVERSAZIONE}={conversation_id}; path=/; "
+            f"max-age={DURATA_COOKIE_CONVERSAZIONE}; SameSite=Strict';</script>",
+            unsafe_allow_javascript=True
+        )
+        st.session_state.conversation_cookie = conversation_id
+    return conversation_id
 
-CONTESTO (Estratti da CCNL e normative scolastiche):
-{context}
 
-DOMANDA: {question}
+def new_conversation_id() -> str:
+    """Nuova conversazione: nuovo identificativo (il cookie si aggiorna al prossimo rerun)"""
+    st.session_state.conversation_id = uuid.uuid4().hex
+    return st.session_state.conversation_id
 
-ISTRUZIONI:
-- Rispondi in modo chiaro, pratico e professionale
-- Cita SEMPRE le fonti quando usi informazioni dal contesto (es. "Secondo il CCNL Scuola...")
-- Se il contesto non è sufficiente, usa la tua conoscenza delle normative scolastiche italiane
-- Fornisci informazioni operative e pratiche (scadenze, procedure, modulistica)
-- Usa un tono professionale ma accessibile
-- Se la questione è complessa, suggerisci di rivolgersi al sindacato scolastico territoriale
-- Distingui chiaramente tra docenti e ATA quando necessario
-- Indica riferimenti normativi specifici quando possibile
 
-RISPOSTA:"""
+@st.cache_resource
+def get_faq_store() -> FAQStore:
+    """Archivio FAQ condiviso da tutte le sessioni del processo"""
+    return FAQStore(os.path.join(DATA_DIR, "faq_risposte.json"))
 
-        chat_completion = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Sei un esperto consulente sindacale del comparto scuola, specializzato in CCNL, graduatorie, concorsi, diritti e doveri del personale scolastico."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            model=model,
-            temperature=0.3,
-            max_tokens=2048
+
+def documenti_vigenti(assistant, metas: List[Dict], data_riferimento: Optional[int]) -> set:
+    """Destinazioni degli archi in vigore alla data, con una sola lettura per tutti i risultati"""
+    ids = sorted({
+        edge["id"] for meta in metas for edge in (
+            json.loads(meta["correlati"]) if isinstance(meta.get("correlati"), str) else meta.get("correlati", [])
         )
-        
-        return chat_completion.choices[0].message.content, sources
+    })
+    if not ids:
+        return set()
+    data = assistant.get_documents(ids)
+    return {doc_id for doc_id, meta in zip(data["ids"], data["metadatas"]) if in_vigore(meta, data_riferimento)}
+
+
+def correlati_vigenti(assistant, metas: List[Dict], data_riferimento: Optional[int],
+                      exclude_ids: Tuple = (), vigenti: Optional[set] = None) -> List[Dict]:
+    """Correlati in vigore alla data: la validità si legge ora, non quella salvata nell'arco"""
+    if vigenti is None:
+        vigenti = documenti_vigenti(assistant, metas, data_riferimento)
+    if not vigenti:
+        return []
+    return correlati_unici(metas, exclude_ids=exclude_ids, vigenti=vigenti)
+
+
+def render_sources(sources: List[Dict], assistant, data_riferimento: Optional[int], vigenti: Optional[set] = None):
+    with st.expander("📚 Fonti normative"):
+        for source in sources:
+            extra = f" (+{source['duplicati']} fonti identiche)" if source.get('duplicati') else ""
+            versione = f" · versione {source['versioni']}" if source.get('versioni') else ""
+            articolo = f" · {source['articolo']}" if source.get('articolo') else ""
+            st.write(f"• {source['categoria']} - {source['argomento']}{articolo}{versione}{extra}")
+        related = correlati_vigenti(assistant, sources, data_riferimento, vigenti=vigenti)
+        if related:
+            st.caption("🔗 Articoli correlati: " + " · ".join(titolo_correlato(edge) for edge in related))
+
+
+def titolo_correlato(edge: Dict) -> str:
+    articolo = f" ({edge['articolo']})" if edge.get("articolo") else ""
+    return f"{edge['argomento']}{articolo}"
+
+
+def render_related(assistant, doc_id: str, meta: Dict, data_riferimento: Optional[int], clickable: bool = True,
+                   key: str = "risultato"):
+    """Articoli correlati dal grafo precalcolato; il clic apre l'articolo senza una nuova ricerca"""
+    related = correlati_vigenti(assistant, [meta], data_riferimento, exclude_ids=(doc_id,))
+    if not related:
+        return
+    if not clickable:
+        st.caption("🔗 Correlati: " + " · ".join(titolo_correlato(edge) for edge in related))
+        return
+    st.caption("🔗 Articoli correlati")
+    for edge in related:
+        if st.button(f"{titolo_correlato(edge)} · {edge['categoria']}", key=f"{key}_{doc_id}_{edge['id']}"):
+            st.session_state.correlato_aperto = edge["id"]
+            st.rerun()
+
+
+def render_search_page(assistant, query: str, data_riferimento: Optional[int], corpus_version: str,
+                       first_page: Optional[Dict] = None):
+    """Risultati paginati: estratti subito, testo completo letto solo all'apertura di un risultato"""
+    sessions = get_session_registry()
+    key = (query, data_riferimento, corpus_version)
+    # Le pagine già caricate restano nella sessione finché la ricerca non cambia
+    loaded = sessions.get(get_tab_id(), "ricerca")
+    if loaded is None or loaded["chiave"] != key:
+        page = first_page or assistant.search_page(query, data_riferimento=data_riferimento)
+        loaded = {"chiave": key, "risultati": page["risultati"], "totale": page["totale"], "cursore": page["cursore"]}
+        sessions.put(get_tab_id(), "ricerca", loaded)
+    
+    st.subheader(f"Trovati {loaded['totale']} risultati:")
+    if loaded["totale"] > len(loaded["risultati"]):
+        st.caption(f"Mostrati i primi {len(loaded['risultati'])}")
+    
+    for hit in loaded["risultati"]:
+        articolo = f" · {hit['articolo']}" if hit.get('articolo') else ""
+        # Con on_change="rerun" l'expander sa se è aperto: il documento si legge solo allora
+        result = st.expander(f"📄 {hit['categoria']} - {hit['argomento']}{articolo}",
+                             key=f"esplora_{hit['id']}", on_change="rerun")
+        if result.open:
+            data = assistant.get_documents([hit["id"]])
+            with result:
+                if data["ids"]:
+                    st.markdown(data["documents"][0])
+                    st.caption(f"Tipo: {hit['tipo']}")
+                    render_related(assistant, hit["id"], data["metadatas"][0], data_riferimento)
+                else:
+                    st.warning("Documento non più presente nel database")
+        else:
+            st.caption(hit["estratto"])
+    
+    if loaded["cursore"] and st.button(f"⬇️ Mostra altri {min(RISULTATI_PER_PAGINA, loaded['totale'] - len(loaded['risultati']))}"):
+        page = assistant.search_page(query, cursor=loaded["cursore"], data_riferimento=data_riferimento)
+        if page["riavviata"]:
+            loaded["risultati"] = []
+        loaded["risultati"] = loaded["risultati"] + page["risultati"]
+        loaded.update(totale=page["totale"], cursore=page["cursore"])
+        sessions.put(get_tab_id(), "ricerca", loaded)
+        st.rerun()
+
+
+def render_provisional_page(page: Dict):
+    st.subheader(f"Trovati {page['totale']} risultati:")
+    st.caption("⏳ Risultati provvisori, ricerca semantica in corso...")
+    for hit in page["risultati"]:
+        articolo = f" · {hit['articolo']}" if hit.get('articolo') else ""
+        with st.expander(f"📄 {hit['categoria']} - {hit['argomento']}{articolo}"):
+            st.markdown(hit["estratto"])
+
+
+def render_lexical_results(hits: List[Dict]):
+    st.subheader(f"Trovati {len(hits)} risultati:")
+    st.caption("⏳ Risultati lessicali, ricerca semantica in corso...")
+    for hit in hits:
+        with st.expander(f"📄 {hit['categoria']} - {hit['argomento']}"):
+            st.markdown(hit["snippet"])
 
 
 def main():
+    # Configurazione pagina
+    st.set_page_config(
+        page_title="🎓 Assistente Sindacale Scuola",
+        page_icon="🎓",
+        layout="wide"
+    )
+    SESSIONE_CORRENTE.set(get_conversation_id())
+    sessions = get_session_registry()
+    sessions.touch(get_tab_id(), st.session_state.to_dict())
+    
     # Header
     st.title("🎓 Assistente Sindacale Scuola")
     st.markdown("*Consulenza per docenti, ATA e personale scolastico*")
@@ -313,13 +4152,20 @@ def main():
     with st.sidebar:
         st.header("⚙️ Configurazione")
         
-        api_key = st.text_input(
-            "🔑 API Key Groq",
-            type="password",
-            help="Ottieni la tua chiave gratis su https://console.groq.com"
-        )
+        if API_URL:
+            st.caption(f"🌐 Servizio remoto: {API_URL}")
+            api_key = None
+        elif LLM_LOCALE:
+            st.caption(f"🖥️ Modello locale: {os.path.basename(LLM_LOCALE)}")
+            api_key = "locale"
+        else:
+            api_key = st.text_input(
+                "🔑 API Key Groq",
+                type="password",
+                help="Ottieni la tua chiave gratis su https://console.groq.com"
+            )
         
-        if not api_key:
+        if not api_key and not API_URL:
             st.warning("⚠️ Inserisci l'API Key per iniziare")
             st.info("👉 Registrati gratis su https://console.groq.com")
             st.stop()
@@ -328,9 +4174,60 @@ def main():
         
         model = st.selectbox(
             "🤖 Modello",
-            ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "mixtral-8x7b-32768"],
-            help="llama-3.3-70b è il più accurato"
+            [MODELLO_AUTOMATICO, "llama-3.3-70b-versatile", "llama-3.1-8b-instant", "mixtral-8x7b-32768"],
+            help="Automatico sceglie per ogni domanda tra llama-3.1-8b (veloce) e llama-3.3-70b (il più accurato)"
+        )
+        
+        modes = {
+            MODALITA_AUTOMATICA: "🤖 LLM con risposta rapida di riserva",
+            MODALITA_LLM: "🧠 Sempre LLM",
+            MODALITA_ESTRATTIVA: "⚡ Rapida (estratti, senza LLM)",
+        }
+        answer_mode = st.radio(
+            "💬 Modalità risposta",
+            list(modes),
+            format_func=modes.get,
+            help="La risposta rapida riporta in pochi millisecondi le frasi più pertinenti delle normative"
         )
+        giorno_riferimento = st.date_input(
+            "📅 Normativa in vigore al",
+            value=date.today(),
+            format="DD/MM/YYYY",
+            help="Le risposte citano solo gli articoli in vigore alla data scelta"
+        )
+        # None = oggi: le risposte precalcolate e la ricerca istantanea valgono solo per la normativa vigente
+        data_riferimento = None if giorno_riferimento == date.today() else data_int(giorno_riferimento)
+        
+        if get_circuit_breaker().state != "chiuso" and answer_mode == MODALITA_AUTOMATICA:
+            st.warning("⚠️ Servizio LLM lento o non raggiungibile: risposte rapide attive")
+        
+        if LLM_LOCALE and get_local_llm().stats["richieste"]:
+            local = get_local_llm().report()
+            st.caption(
+                f"🖥️ {local['richieste']} risposte locali · prefisso in cache {local['quota_riusata']:.0%} del prompt · "
+                f"prefill {local['ms_prefill']:.0f} ms · {local['token_al_secondo']:.1f} token/s · "
+                f"in coda {local['in_coda']}"
+            )
+        
+        if model == MODELLO_AUTOMATICO:
+            router_stats = get_model_router().stats
+            if router_stats["richieste"]:
+                risparmio = router_stats["costo_solo_grande"] - router_stats["costo"]
+                st.caption(
+                    f"⚡ Veloce: {router_stats['veloce']} · 🧠 Grande: {router_stats['grande']} · "
+                    f"↩️ Fallback: {router_stats['fallback']} · "
+                    f"⏱️ {router_stats['latenza_totale'] / router_stats['richieste']:.1f}s medi · "
+                    f"💶 Risparmio ${risparmio:.4f}"
+                )
+        
+        if CHIAVE_AMMINISTRAZIONE and not is_admin():
+            with st.expander("🔐 Amministrazione"):
+                chiave = st.text_input("Chiave di amministrazione", type="password", key="chiave_admin")
+                if chiave and hmac.compare_digest(chiave.encode("utf-8"), CHIAVE_AMMINISTRAZIONE.encode("utf-8")):
+                    st.session_state.amministratore = True
+                    st.rerun()
+                elif chiave:
+                    st.error("❌ Chiave non valida")
         
         st.divider()
         
@@ -338,16 +4235,120 @@ def main():
         st.header("📚 Database Normative")
         
         try:
-            assistant = SchoolUnionAssistant(api_key)
+            assistant = RemoteAssistant(API_URL) if API_URL else SchoolUnionAssistant(api_key)
             
-            if assistant.collection.count() == 0:
+            if assistant.count() == 0:
                 with st.spinner("📥 Caricamento normative scuola..."):
                     assistant.preload_contracts()
                     st.success("✅ Database caricato!")
             
-            doc_count = assistant.collection.count()
+            doc_count = assistant.count()
             st.metric("📄 Articoli caricati", doc_count)
             
+            waiting = get_admission_controller().queue_length()
+            if waiting:
+                st.caption(f"🚦 Richieste in coda: {waiting}")
+            
+            avoided = get_singleflight().avoided()
+            if avoided:
+                st.caption(f"🔗 Richieste identiche accorpate: {avoided} chiamate evitate")
+            
+            if INDICE_SHARD and not API_URL and is_admin():
+                shard_index = get_shard_index()
+                with st.expander(f"🧩 Shard dell'indice ({len(shard_index.owner)} su {shard_index.n_processes} processi)"):
+                    st.dataframe(shard_index.shard_stats(), hide_index=True)
+                    moves = shard_index.rebalance_plan()
+                    if moves:
+                        st.caption("⚖️ Proposta: " + " · ".join(f"{shard} → processo {target}" for shard, _, target in moves))
+                        if st.button("⚖️ Ribilancia gli shard"):
+                            shard_index.rebalance()
+                            st.rerun()
+                    else:
+                        st.caption("⚖️ Carico bilanciato")
+
+            if not API_URL and is_admin():
+                migration = get_index_migration()
+                with st.expander(f"🔁 Migrazione modello ({migration.state})"):
+                    st.caption(f"Attivo: `{assistant.model_name}` · collection `{assistant.collection.name}`")
+                    if migration.state in ("inattiva", "annullata", "errore"):
+                        if migration.error:
+                            st.error(f"❌ {migration.error}")
+                        new_model = st.text_input("Nuovo modello di embedding", key="migration_model")
+                        rate = st.number_input("Documenti al secondo", min_value=1.0, value=DOCUMENTI_AL_SECONDO_MIGRAZIONE)
+                        if st.button("🏗️ Costruisci indice ombra") and new_model.strip():
+                            try:
+                                migration.start(assistant, new_model.strip(), rate)
+                                st.rerun()
+                            except ValueError as e:
+                                st.warning(str(e))
+                        if leggi_indice_attivo(assistant.chroma_client).get("precedente_collezione"):
+                            if st.button("↩️ Torna all'indice precedente"):
+                                st.success(f"✅ Attivo: {migration.rollback(assistant)['modello']}")
+                                st.rerun()
+                    else:
+                        st.progress(min(migration.done / max(migration.total, 1), 1.0),
+                                    text=f"`{migration.model}`: {migration.done}/{migration.total} documenti")
+                    if migration.state == "costruzione" and st.button("⏹️ Interrompi"):
+                        migration.cancel()
+                    if migration.state == "pronta":
+                        shadow = migration.shadow_report()
+                        if shadow["confronti"]:
+                            st.caption(
+                                f"👥 Traffico ombra: {shadow['confronti']} ricerche · "
+                                f"sovrapposizione {shadow['sovrapposizione_media']:.0%} · "
+                                f"stesso primo risultato {shadow['top1_uguale']:.0%} · "
+                                f"{shadow['ms_attivo']:.0f} ms → {shadow['ms_ombra']:.0f} ms"
+                            )
+                        if st.button("📏 Valuta (recall@4)"):
+                            sessions.put(get_tab_id(), "valutazione_migrazione", migration.evaluate())
+                        report = sessions.get(get_tab_id(), "valutazione_migrazione")
+                        if report:
+                            st.dataframe([{"indice": label, **report[label]} for label in ("attivo", "ombra")],
+                                         hide_index=True)
+                        if st.button("✅ Attiva il nuovo indice"):
+                            migration.swap()
+                            sessions.put(get_tab_id(), "valutazione_migrazione", None)
+                            st.rerun()
+
+            if not API_URL and is_admin():
+                with st.expander(f"🧠 Memoria sessioni ({len(sessions)} · "
+                                 f"{sessions.memory_bytes() / 1024 / 1024:.1f}/{sessions.budget / 1024 / 1024:.0f} MB)"):
+                    st.dataframe(sessions.report(), hide_index=True)
+                    st.caption(
+                        f"💾 Spostate su disco: {sessions.stats['su_disco']} · "
+                        f"ripristinate: {sessions.stats['ripristinate']} · "
+                        f"liberati {sessions.stats['byte_liberati'] / 1024:.0f} KB · "
+                        f"inattività massima {sessions.idle_timeout / 60:.0f} min"
+                    )
+                    if st.button("🧹 Sposta su disco le altre sessioni"):
+                        sessions.enforce(exclude=get_tab_id(), idle_timeout=0)
+                        st.rerun()
+            
+            audit = get_audit_log()
+            if audit.stats["scartati"] or audit.stats["errori_scrittura"]:
+                st.caption(
+                    f"🧾 Registro di audit: {audit.stats['scartati']} eventi persi · "
+                    f"{audit.stats['errori_scrittura']} errori di scrittura"
+                )
+            
+            if get_fact_index().answered:
+                st.caption(f"📌 Risposte immediate dalla tabella dei valori: {get_fact_index().answered}")
+            
+            expansion = get_query_expander().stats
+            if expansion["espanse"]:
+                st.caption(
+                    f"🔤 Query espanse con sigle e sinonimi: {expansion['espanse']}/{expansion['ricerche']} · "
+                    f"+{expansion['latenza_aggiunta'] / expansion['espanse'] * 1000:.0f} ms medi"
+                )
+            
+            # Risposte FAQ precalcolate: rigenerate quando cambia il corpus
+            faqs = carica_faq()
+            faq_store = get_faq_store()
+            corpus_version = assistant.current_version()
+            if not API_URL:
+                assistant.sync_indexes(corpus_version)
+            faq_store.warmup(assistant, faqs, model, corpus_version)
+            
             with st.expander("📋 Contenuti disponibili"):
                 for categoria in NORMATIVE_SCUOLA.keys():
                     st.write(f"✓ {categoria}")
@@ -363,72 +4364,135 @@ def main():
     with tab1:
         st.header("💬 Chiedi all'assistente")
         
-        # Domande frequenti per categoria
-        st.markdown("**🔍 Domande frequenti:**")
-        col1, col2, col3, col4 = st.columns(4)
-        
-        with col1:
-            if st.button("📅 Ferie e permessi"):
-                st.session_state.quick_q = "Quanti giorni di ferie ho come docente?"
-        with col2:
-            if st.button("💰 Stipendio e scatti"):
-                st.session_state.quick_q = "Come funzionano gli scatti di anzianità?"
-        with col3:
-            if st.button("📋 Supplenze"):
-                st.session_state.quick_q = "Differenza tra supplenza al 31/08 e 30/06?"
-        with col4:
-            if st.button("🔄 Mobilità"):
-                st.session_state.quick_q = "Come funziona la mobilità dei docenti?"
+        # Domande frequenti per categoria (faq.json può anche non definirne)
+        if faqs:
+            st.markdown("**🔍 Domande frequenti:**")
+            columns = st.columns(len(faqs))
+            
+            for col, faq in zip(columns, faqs):
+                with col:
+                    if st.button(faq["etichetta"], key=f"faq_{faq['id']}"):
+                        # La FAQ scelta passa alla prossima esecuzione nello stato della sessione (SessionBox)
+                        sessions.put(get_tab_id(), "faq_scelta", faq)
+            
+            pending = faq_store.pending(faqs, model, corpus_version)
+            if faq_store.warming:
+                st.caption(f"⏳ Preparazione risposte rapide in corso ({len(faqs) - len(pending)}/{len(faqs)} pronte)")
+            elif not pending:
+                st.caption("⚡ Risposte rapide pronte")
+            elif faq_store.last_error:
+                st.caption(f"⚠️ Risposte rapide non disponibili: {faq_store.last_error}")
+            
+            if st.button("🔄 Rigenera risposte rapide", disabled=faq_store.warming):
+                faq_store.warmup(assistant, faqs, model, corpus_version, force=True)
+                st.rerun()
         
         st.divider()
         
-        # Cronologia chat
-        if 'school_messages' not in st.session_state:
-            st.session_state.school_messages = []
+        admission = get_admission_controller()
         
-        for message in st.session_state.school_messages:
+        # Cronologia chat (salvata su disco, mostrata a pagine)
+        conversations = get_conversation_store()
+        conversation_id = get_conversation_id()
+        if st.session_state.get('history_conversation') != conversation_id:
+            st.session_state.history_conversation = conversation_id
+            st.session_state.history_pages = 1
+        
+        shown = MESSAGGI_PER_PAGINA * st.session_state.history_pages
+        total_messages = conversations.count(conversation_id)
+        if total_messages > shown:
+            if st.button("⬆️ Mostra messaggi precedenti"):
+                st.session_state.history_pages += 1
+                st.rerun()
+        
+        # Messaggi già letti e decompressi restano nella sessione (finché non va su disco)
+        history = sessions.get(get_tab_id(), "cronologia")
+        if history is None or history["chiave"] != (conversation_id, shown, total_messages):
+            history = {"chiave": (conversation_id, shown, total_messages),
+                       "messaggi": conversations.last_messages(conversation_id, shown)}
+            sessions.put(get_tab_id(), "cronologia", history)
+        # Validità dei correlati di tutta la pagina: una lettura sola, ripetuta solo se cambiano corpus o data
+        if history.get("chiave_vigenti") != (corpus_version, data_riferimento):
+            history["vigenti"] = documenti_vigenti(
+                assistant, [source for message in history["messaggi"] for source in message["sources"] or []],
+                data_riferimento
+            )
+            history["chiave_vigenti"] = (corpus_version, data_riferimento)
+            sessions.put(get_tab_id(), "cronologia", history)
+        
+        for message in history["messaggi"]:
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
-                if "sources" in message and message["sources"]:
-                    with st.expander("📚 Fonti normative"):
-                        for source in message["sources"]:
-                            st.write(f"• {source['categoria']} - {source['argomento']}")
+                if message["sources"]:
+                    render_sources(message["sources"], assistant, data_riferimento, history["vigenti"])
         
         # Input
-        default_q = st.session_state.get('quick_q', '')
-        if default_q:
-            prompt = default_q
-            st.session_state.quick_q = None
+        quick_faq = sessions.get(get_tab_id(), "faq_scelta")
+        if quick_faq:
+            prompt = quick_faq["domanda"]
+            sessions.put(get_tab_id(), "faq_scelta", None)
         else:
             prompt = st.chat_input("Scrivi la tua domanda... (es. 'Posso chiedere un'aspettativa?')")
         
         if prompt:
-            st.session_state.school_messages.append({"role": "user", "content": prompt})
+            conversations.append(conversation_id, "user", prompt)
             
             with st.chat_message("user"):
                 st.markdown(prompt)
             
             with st.chat_message("assistant"):
-                with st.spinner("🔍 Ricerca nelle normative..."):
-                    try:
-                        response, sources = assistant.answer_question(prompt, model=model)
-                        st.markdown(response)
-                        
-                        if sources:
-                            with st.expander("📚 Fonti normative"):
-                                for source in sources:
-                                    st.write(f"• {source['categoria']} - {source['argomento']}")
-                        
-                        st.session_state.school_messages.append({
-                            "role": "assistant",
-                            "content": response,
-                            "sources": sources
-                        })
-                    except Exception as e:
-                        st.error(f"Errore: {e}")
+                cached = faq_store.get(quick_faq, model, corpus_version) if quick_faq and not data_riferimento else None
+                if cached:
+                    response, sources = cached["risposta"], cached["fonti"]
+                    st.markdown(response)
+                    st.caption("⚡ Risposta precalcolata")
+                    get_traffic_recorder().record("faq", {"faq": quick_faq["id"], "model": model}, 0.0)
+                    get_audit_log().answer(prompt, model, "faq", data_riferimento, {"esito": "faq"},
+                                           response, sources, 0.0)
+                    if sources:
+                        render_sources(sources, assistant, data_riferimento)
+                    conversations.append(conversation_id, "assistant", response, sources)
+                else:
+                    queue_status = st.empty()
+                    
+                    def fallback():
+                        # Richiesta scartata: risposta precalcolata o estrattiva, mai un errore
+                        cached = faq_store.find(prompt, model, corpus_version) if not data_riferimento else None
+                        if cached:
+                            return cached["risposta"], cached["fonti"]
+                        return assistant.answer_question(prompt, model=model, mode=MODALITA_ESTRATTIVA,
+                                                         data_riferimento=data_riferimento)
+                    
+                    with st.spinner("🔍 Ricerca nelle normative..."):
+                        try:
+                            if answer_mode == MODALITA_ESTRATTIVA or assistant.has_instant_answer(
+                                    prompt, answer_mode, data_riferimento):
+                                response, sources = assistant.answer_question(
+                                    prompt, model=model, mode=answer_mode, data_riferimento=data_riferimento
+                                )
+                            else:
+                                response, sources = admission.run(
+                                    conversation_id,
+                                    lambda: assistant.answer_question(prompt, model=model, mode=answer_mode,
+                                                                      data_riferimento=data_riferimento),
+                                    fallback=fallback,
+                                    on_wait=lambda position: queue_status.info(f"⏳ In coda: posizione {position}")
+                                )
+                            queue_status.empty()
+                            st.markdown(response)
+                            
+                            if sources:
+                                render_sources(sources, assistant, data_riferimento)
+                            
+                            conversations.append(conversation_id, "assistant", response, sources)
+                            if quick_faq and not data_riferimento:
+                                faq_store.put(quick_faq, model, corpus_version, response, sources)
+                        except Exception as e:
+                            st.error(f"Errore: {e}")
         
         if st.button("🗑️ Nuova conversazione"):
-            st.session_state.school_messages = []
+            conversations.clear(conversation_id)
+            new_conversation_id()
             st.rerun()
     
     # TAB 2: Aggiungi documenti
@@ -456,41 +4520,140 @@ def main():
             height=250,
             placeholder="Inserisci il testo della circolare, delibera o normativa...\n\nPuoi includere: circolari ministeriali, note USR, delibere collegio docenti, contrattazione d'istituto, ecc."
         )
+        file_custom = st.file_uploader(
+            "📄 Oppure carica un file",
+            type=["pdf", "docx", "txt"],
+            help="I documenti lunghi vengono indicizzati per frasi; nelle risposte si cita l'articolo che le contiene"
+        )
         
         if st.button("➕ Aggiungi al Database", type="primary"):
-            if contenuto_custom.strip() and categoria_custom.strip() and argomento_custom.strip():
+            if (file_custom is not None or contenuto_custom.strip()) and categoria_custom.strip() and argomento_custom.strip():
                 with st.spinner("Elaborazione..."):
                     try:
-                        assistant.add_custom_content(
+                        if file_custom is not None:
+                            # PDF danneggiati o protetti: l'errore si mostra come quelli del caricamento
+                            contenuto_custom = estrai_testo(file_custom)
+                            if not contenuto_custom.strip():
+                                raise ValueError("nessun testo estratto dal file")
+                        doc_id, duplicate = assistant.add_custom_content(
                             contenuto_custom,
                             categoria_custom,
                             argomento_custom
                         )
-                        st.success(f"✅ Documento aggiunto con successo!")
-                        st.balloons()
+                        if duplicate and len(contenuto_custom) > SOGLIA_DOCUMENTO_LUNGO:
+                            st.info(f"♻️ Documento già presente ({doc_id})")
+                        elif duplicate:
+                            st.info(f"♻️ Contenuto quasi identico già presente ({doc_id}): aggiunto come fonte del documento esistente")
+                        else:
+                            st.success(f"✅ Documento aggiunto con successo!")
+                            st.balloons()
                     except Exception as e:
                         st.error(f"Errore: {e}")
             else:
                 st.warning("⚠️ Compila tutti i campi")
+        
+        with st.expander("🆕 Nuova versione di un contratto"):
+            st.caption("Gli articoli invariati non vengono ricalcolati; quelli modificati o abrogati restano consultabili per le date precedenti")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                contratto_nuovo = st.selectbox(
+                    "📜 Contratto",
+                    sorted({contratto for contratto, _, _ in VERSIONI_CONTRATTI.values()}) + ["Altro"]
+                )
+                if contratto_nuovo == "Altro":
+                    contratto_nuovo = st.text_input("Nome del contratto")
+            with col2:
+                versione_nuova = st.text_input("🏷️ Versione", placeholder="es. 2019-2021")
+            with col3:
+                in_vigore_dal = st.date_input("📅 In vigore dal", value=date.today(), format="DD/MM/YYYY")
+            
+            testo_contratto = st.text_area(
+                "📝 Articoli",
+                height=250,
+                placeholder="### Art. 13 - Ferie\nIl dipendente ha diritto...\n\n### Art. 15 - Permessi retribuiti\n..."
+            )
+            
+            if st.button("🔁 Carica nuova versione"):
+                articoli = parse_articoli(testo_contratto)
+                if contratto_nuovo and versione_nuova.strip() and articoli:
+                    with st.spinner("Confronto con la versione in vigore..."):
+                        try:
+                            report = assistant.ingest_contract_version(
+                                contratto_nuovo, versione_nuova.strip(), data_int(in_vigore_dal), articoli
+                            )
+                            st.success(
+                                f"✅ {len(report['nuovi'])} nuovi · {len(report['modificati'])} modificati · "
+                                f"{len(report['invariati'])} invariati · {len(report['abrogati'])} abrogati"
+                            )
+                            if report["modificati"] or report["abrogati"]:
+                                st.caption("✏️ " + " · ".join(report["modificati"] + report["abrogati"]))
+                        except Exception as e:
+                            st.error(f"Errore: {e}")
+                else:
+                    st.warning("⚠️ Indica contratto, versione e almeno un articolo (### Titolo)")
     
     # TAB 3: Esplora database
     with tab3:
         st.header("📖 Esplora il Database Normativo")
         
+        instant = st.toggle("⚡ Ricerca istantanea", value=True,
+                            help="Suggerimenti lessicali immediati e ricerca semantica in background")
+        
         search_query = st.text_input(
             "🔍 Cerca nel database", 
             placeholder="es. ferie, GPS, ore eccedenti, maternità..."
         )
         
-        if search_query:
-            results = assistant.search_content(search_query, n_results=6)
+        opened = st.session_state.get("correlato_aperto")
+        if opened:
+            data = assistant.get_documents([opened])
+            if data["ids"]:
+                meta = data["metadatas"][0]
+                articolo = f" · {meta['articolo']}" if meta.get('articolo') else ""
+                with st.expander(f"🔗 {meta['categoria']} - {meta['argomento']}{articolo}", expanded=True):
+                    st.markdown(data["documents"][0])
+                    render_related(assistant, opened, meta, data_riferimento, key="aperto")
+                    if st.button("✖️ Chiudi", key="chiudi_correlato"):
+                        del st.session_state.correlato_aperto
+                        st.rerun()
+        
+        if search_query and instant and not data_riferimento:
+            suggestions = assistant.suggest(search_query, limit=6)
+            if suggestions:
+                st.caption("💡 Suggerimenti: " + " · ".join(hit["argomento"] for hit in suggestions))
             
-            st.subheader(f"Trovati {len(results['documents'][0])} risultati:")
+            searcher = get_speculative_searcher()
+            # Per scheda: due schede della stessa conversazione non si annullano le ricerche
+            session_key = get_tab_id()
+            completed = assistant.complete_query(search_query)
+            if completed != " ".join(tokenizza(search_query)):
+                searcher.prefetch(assistant, completed, corpus_version, RISULTATI_PER_PAGINA)
             
-            for i, (doc, meta) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-                with st.expander(f"📄 {meta['categoria']} - {meta['argomento']}"):
-                    st.markdown(doc)
-                    st.caption(f"Tipo: {meta.get('tipo', 'precaricato')}")
+            results = searcher.cached(search_query, corpus_version, RISULTATI_PER_PAGINA)
+            if results is None:
+                future = searcher.submit(assistant, session_key, search_query, corpus_version, RISULTATI_PER_PAGINA)
+                
+                @st.fragment(run_every=0.5)
+                def semantic_results():
+                    if future.done():
+                        # Risultati pronti (e in cache): rerun completo senza polling
+                        if future.exception() is not None:
+                            st.error(f"Errore: {future.exception()}")
+                        else:
+                            st.rerun()
+                    else:
+                        partial = searcher.partial(search_query, corpus_version, RISULTATI_PER_PAGINA)
+                        if partial is not None:
+                            render_provisional_page(partial)
+                        else:
+                            render_lexical_results(suggestions)
+                
+                semantic_results()
+            else:
+                render_search_page(assistant, search_query, None, corpus_version, first_page=results)
+        elif search_query:
+            # Gli altri rerun della pagina (es. apertura di un risultato) non ripetono la ricerca
+            render_search_page(assistant, search_query, data_riferimento, corpus_version)
     
     # TAB 4: Info
     with tab4:
@@ -0,0 +1,553 @@
+"""
+Strumenti da riga di comando per l'Assistente Sindacale Scuola
+
+Esempi:
+  python cli_sindacato.py loadtest --url http://localhost:8000 --concurrency 32
+  python cli_sindacato.py loadtest --workers 1,2,4 --duration 20
+  python cli_sindacato.py snapshot build --out snapshot --dtype int8
+  python cli_sindacato.py snapshot verify --path snapshot
+  python cli_sindacato.py valuta-compressione --dims 0,384,256,128
+  SINDACATO_REGISTRO_TRAFFICO=dati/traffico.jsonl streamlit run app_sindacato.py   # registrazione
+  python cli_sindacato.py replay dati/traffico.jsonl --velocita 1,5,10,20
+  SINDACATO_LLM_LOCALE=modelli/modello.gguf python cli_sindacato.py benchmark-llm --backend locale,locale-senza-cache,groq
+  CHROMA_PATH=dati/chroma python cli_sindacato.py migrazione valuta --modello intfloat/multilingual-e5-base
+  CHROMA_PATH=dati/chroma python cli_sindacato.py migrazione attiva --modello intfloat/multilingual-e5-base
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+# Domande di esempio per il carico sintetico
+DOMANDE_CARICO = [
+    "ferie docenti",
+    "permessi legge 104",
+    "supplenza al 30 giugno",
+    "graduatorie provinciali supplenze",
+    "straordinario ATA",
+    "ricostruzione di carriera",
+    "congedo parentale retribuzione",
+    "trattenuta per sciopero",
+]
+
+
+def crea_assistente():
+    """Assistente locale fuori da Streamlit (la chiave Groq serve solo per le risposte)"""
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    from app_sindacato import SchoolUnionAssistant
+    return SchoolUnionAssistant(os.environ.get("GROQ_API_KEY", "non-configurata"))
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+def run_load(url: str, endpoint: str, concurrency: int, duration: float) -> Dict:
+    """Richieste a ciclo chiuso da `concurrency` client per `duration` secondi"""
+    deadline = time.monotonic() + duration
+
+    def client(worker: int):
+        latencies, errors, i = [], 0, worker
+        while time.monotonic() < deadline:
+            query = DOMANDE_CARICO[i % len(DOMANDE_CARICO)]
+            i += 1
+            if endpoint == "ask":
+                request = urllib.request.Request(
+                    f"{url}/ask",
+                    data=json.dumps({"question": query}).encode("utf-8"),
+                    headers={"Content-Type": "application/json"}
+                )
+            else:
+                request = urllib.request.Request(f"{url}/search?" + urllib.parse.urlencode({"q": query, "n": 4}))
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    response.read()
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+        return latencies, errors
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(client, range(concurrency)))
+    elapsed = time.monotonic() - start
+
+    latencies = [latency for worker_latencies, _ in outcomes for latency in worker_latencies]
+    return {
+        "richieste": len(latencies),
+        "errori": sum(errors for _, errors in outcomes),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "media_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def wait_ready(url: str, timeout: float = 300.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/stats", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except Exception:
+            time.sleep(1)
+    raise TimeoutError(f"Il servizio {url} non ha risposto entro {timeout:.0f}s")
+
+
+class GroqSimulato:
+    """Sostituto di Groq per i replay: latenza simulata in base ai token, nessuna chiamata esterna"""
+
+    def __init__(self, latency: float = 0.8, per_token: float = 0.004, completion_tokens: int = 250):
+        self.latency = latency
+        self.per_token = per_token
+        self.completion_tokens = completion_tokens
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, messages, model, stream=False, max_tokens=2048, **kwargs):
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        completion_tokens = min(max_tokens, self.completion_tokens)
+        # I modelli piccoli rispondono circa 4 volte più in fretta
+        speed = 0.25 if "8b" in model else 1.0
+        words = ["risposta", "simulata"] * (completion_tokens // 2)
+        usage = types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                      total_tokens=prompt_tokens + completion_tokens)
+        time.sleep(self.latency * speed)
+        if stream:
+            def chunks():
+                for word in words:
+                    time.sleep(self.per_token * speed)
+                    yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=word + " "))])
+            return chunks()
+        time.sleep(completion_tokens * self.per_token * speed)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=" ".join(words)))],
+            usage=usage
+        )
+
+
+def memoria_processo() -> int:
+    """Memoria residente del processo in byte"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def carica_registro(path: str, window: float) -> List[Dict]:
+    """Richieste registrate, con l'istante relativo all'inizio della registrazione"""
+    with open(path, encoding="utf-8") as f:
+        records = sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["t"])
+    if not records:
+        return []
+    start = records[0]["t"]
+    for record in records:
+        record["offset"] = record["t"] - start
+    return [r for r in records if not window or r["offset"] <= window]
+
+
+def esegui_replay(assistant, records: List[Dict], speed: float, workers: int) -> Dict:
+    """Riproduce le richieste a ciclo aperto, rispettando gli intervalli originali divisi per `speed`"""
+    from app_sindacato import carica_faq, get_faq_store, MODELLO_PREDEFINITO, MODALITA_LLM, RISULTATI_PER_PAGINA
+
+    faqs = {faq["id"]: faq for faq in carica_faq()}
+    faq_store = get_faq_store()
+    corpus_version = assistant.corpus_version()
+    vocabulary = " ".join(assistant.collection.get(include=["documents"])["documents"]).split()
+    lock = threading.Lock()
+    outcomes = []
+
+    def execute(record: Dict):
+        op = record["op"]
+        if op == "search":
+            assistant.search_content(record.get("testo", ""), n_results=record.get("n_results", 4),
+                                     diversify=record.get("diversify", True),
+                                     data_riferimento=record.get("data_riferimento"))
+        elif op == "search_page":
+            # Il cursore non viene riprodotto: le pagine successive leggono la classifica in cache
+            assistant.search_page(record.get("testo", ""), page_size=record.get("page_size", RISULTATI_PER_PAGINA),
+                                  data_riferimento=record.get("data_riferimento"))
+        elif op == "answer":
+            assistant.answer_question(record.get("testo", ""), model=record.get("model", MODELLO_PREDEFINITO),
+                                      mode=record.get("mode", MODALITA_LLM),
+                                      data_riferimento=record.get("data_riferimento"))
+        elif op == "ingest":
+            # Il testo non viene registrato: documento sintetico della stessa lunghezza
+            words, size = [], 0
+            while size < record.get("caratteri", 500):
+                words.append(random.choice(vocabulary))
+                size += len(words[-1]) + 1
+            assistant.add_custom_content(" ".join(words), record.get("categoria", "Altro"),
+                                         record.get("argomento", "Replay"))
+        elif op == "faq" and record.get("faq") in faqs:
+            # Stesso modello della sessione registrata: le risposte precalcolate sono per modello
+            faq, model = faqs[record["faq"]], record.get("model", MODELLO_PREDEFINITO)
+            if faq_store.get(faq, model, corpus_version) is None:
+                response, sources = assistant.answer_question(faq["domanda"], model=model, mode=MODALITA_LLM)
+                faq_store.put(faq, model, corpus_version, response, sources)
+
+    def run(record: Dict, due: float):
+        begin = time.monotonic()
+        ok = True
+        try:
+            execute(record)
+        except Exception:
+            ok = False
+        end = time.monotonic()
+        with lock:
+            outcomes.append((record["op"], record["sessione"], begin - due, end - due, ok))
+
+    # Crescita della memoria dell'intero processo (cache e indici compresi), non attribuibile alle sessioni
+    memory_before = peak = memoria_processo()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in records:
+            due = start + record["offset"] / speed
+            time.sleep(max(0.0, due - time.monotonic()))
+            pool.submit(run, record, due)
+            peak = max(peak, memoria_processo())
+    elapsed = time.monotonic() - start
+    peak = max(peak, memoria_processo())
+
+    span = max(records[-1]["offset"] / speed, 1e-3)
+    sessions = {session for _, session, _, _, _ in outcomes}
+    latencies = {}
+    for op, _, _, latency, _ in outcomes:
+        latencies.setdefault(op, []).append(latency)
+    all_latencies = [latency for _, _, _, latency, _ in outcomes]
+    return {
+        "velocita": speed,
+        "richieste": len(outcomes),
+        "errori": sum(not ok for *_, ok in outcomes),
+        "offerte_al_s": len(records) / span,
+        "servite_al_s": len(outcomes) / elapsed,
+        "p50_ms": percentile(all_latencies, 0.50) * 1000,
+        "p95_ms": percentile(all_latencies, 0.95) * 1000,
+        "p99_ms": percentile(all_latencies, 0.99) * 1000,
+        "attesa_p95_ms": percentile([wait for _, _, wait, _, _ in outcomes], 0.95) * 1000,
+        "per_operazione": {
+            op: {"n": len(values), "p50_ms": percentile(values, 0.50) * 1000,
+                 "p95_ms": percentile(values, 0.95) * 1000, "p99_ms": percentile(values, 0.99) * 1000}
+            for op, values in latencies.items()
+        },
+        "sessioni": len(sessions),
+        "crescita_memoria_mb": (peak - memory_before) / 1024 / 1024,
+    }
+
+
+def cmd_replay(args):
+    records = carica_registro(args.registro, args.finestra)
+    if not records:
+        print(f"Nessuna richiesta in {args.registro}")
+        return
+    assistant = crea_assistente()
+    assistant.client = GroqSimulato(args.latenza_llm)
+    assistant.preload_contracts()
+    assistant.sync_indexes()
+
+    counts = {}
+    for record in records:
+        counts[record["op"]] = counts.get(record["op"], 0) + 1
+    print(f"{len(records)} richieste in {records[-1]['offset']:.0f}s registrati: "
+          + ", ".join(f"{op} {n}" for op, n in sorted(counts.items())))
+    print(f"{'vel.':>5} {'offerte/s':>10} {'servite/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'attesa p95':>11} {'+RSS MB':>9} {'errori':>6}")
+
+    saturation = None
+    for speed in [float(v) for v in args.velocita.split(",")]:
+        result = esegui_replay(assistant, records, speed, args.workers)
+        print(f"{speed:>4g}x {result['offerte_al_s']:>10.1f} {result['servite_al_s']:>10.1f} "
+              f"{result['p50_ms']:>8.0f} {result['p95_ms']:>8.0f} {result['p99_ms']:>8.0f} "
+              f"{result['attesa_p95_ms']:>11.0f} {result['crescita_memoria_mb']:>9.1f} {result['errori']:>6}")
+        if args.dettaglio:
+            for op, stats in sorted(result["per_operazione"].items()):
+                print(f"       {op:<8} n={stats['n']:<5} p50 {stats['p50_ms']:.0f} ms · "
+                      f"p95 {stats['p95_ms']:.0f} ms · p99 {stats['p99_ms']:.0f} ms")
+        # Saturazione: il servizio non tiene il ritmo offerto o supera lo SLO di latenza
+        if saturation is None and (result["servite_al_s"] < 0.9 * result["offerte_al_s"]
+                                   or result["p95_ms"] > args.slo_ms):
+            saturation = result
+
+    if saturation:
+        print(f"Punto di saturazione: {saturation['velocita']:g}x "
+              f"(~{saturation['offerte_al_s']:.1f} richieste/s, p95 {saturation['p95_ms']:.0f} ms)")
+    else:
+        print(f"Nessuna saturazione fino a {args.velocita.split(',')[-1]}x")
+
+
+def cmd_loadtest(args):
+    if not args.workers:
+        result = run_load(args.url, args.endpoint, args.concurrency, args.duration)
+        print(json.dumps(result, indent=2))
+        return
+
+    # Avvia il servizio con un numero crescente di worker e confronta il throughput
+    print(f"{'worker':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errori':>6}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api_sindacato:app",
+             "--port", str(args.port), "--workers", str(workers), "--log-level", "warning"],
+            env=os.environ.copy()
+        )
+        url = f"http://127.0.0.1:{args.port}"
+        try:
+            wait_ready(url)
+            run_load(url, args.endpoint, args.concurrency, min(args.duration, 3))  # riscaldamento
+            result = run_load(url, args.endpoint, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{workers:>6} {result['throughput']:>8.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f} {result['errori']:>6}")
+
+
+def cmd_snapshot(args):
+    if args.action == "build":
+        # Lo snapshot si costruisce dal corpus, non da un altro snapshot
+        os.environ.pop("SINDACATO_SNAPSHOT", None)
+        assistant = crea_assistente()
+        start = time.perf_counter()
+        assistant.preload_contracts()
+        manifest = assistant.export_snapshot(args.path, dtype=args.dtype)
+        size = sum(os.path.getsize(os.path.join(args.path, name)) for name in os.listdir(args.path))
+        print(f"Snapshot {args.path}: {manifest['documenti']} documenti, {manifest['dtype']}, "
+              f"{size / 1024:.0f} KB, corpus {manifest['corpus_version']} "
+              f"({time.perf_counter() - start:.1f}s)")
+    else:
+        logging.getLogger("streamlit").setLevel(logging.ERROR)
+        from app_sindacato import load_snapshot
+        start = time.perf_counter()
+        manifest, vectors, _, documents, _ = load_snapshot(args.path, verify=True)
+        # Solo lettura e checksum: l'importazione in Chroma ricostruisce anche l'indice HNSW
+        print(f"Snapshot valido: {manifest['documenti']} documenti, vettori {vectors.shape} {vectors.dtype}, "
+              f"letto e verificato in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def cmd_valuta_compressione(args):
+    """Memoria e recall dell'indice compatto rispetto alla ricerca esatta float32
+
+    Riferimento: i vettori float32 e il grafo HNSW (stimato con M=16) che Chroma tiene in memoria per
+    rispondere. Con l'indice compatto attivo le ricerche non li caricano: restano in RAM i codici int8
+    e la validità, mentre la copia float16 per il rescoring è su disco (mappata, solo le righe rilette).
+    """
+    assistant = crea_assistente()
+    assistant.preload_contracts()
+    from app_sindacato import CompactVectorIndex, FAQ_RAPIDE, FATTORE_RESCORING, MODELLI_MATRYOSHKA
+    import numpy as np
+
+    data = assistant.collection.get(include=["embeddings", "documents", "metadatas"])
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = DOMANDE_CARICO + [faq["domanda"] for faq in FAQ_RAPIDE] + [meta["argomento"] for meta in data["metadatas"]]
+    query_vectors = np.asarray(assistant.embedding_model.encode(queries), dtype=np.float32)
+    k = args.k
+
+    exact = [set(np.argsort(-(normalized @ q))[:k]) for q in query_vectors]
+    baseline = vectors.nbytes + vectors.shape[0] * 16 * 2 * 4
+    print(f"{len(data['ids'])} documenti, {len(queries)} query, riferimento float32 + HNSW in RAM "
+          f"{baseline / 1024:.0f} KB")
+    print(f"{'dim':>5} {'metodo':>12} {'KB RAM':>8} {'risparmio':>10} {'KB disco':>9} {'recall@k int8':>14} "
+          f"{'+rescoring':>11} {'ms/query':>9}")
+
+    with tempfile.TemporaryDirectory() as rescoring_dir:
+        for dim in [int(d) for d in args.dims.split(",")]:
+            index = CompactVectorIndex(dim, matryoshka=assistant.model_name in MODELLI_MATRYOSHKA,
+                                       rescoring_dir=rescoring_dir)
+            index.add(data["ids"], vectors, data["metadatas"])
+            position = {doc_id: i for i, doc_id in enumerate(data["ids"])}
+            # Tutte le date: la recall si confronta con la ricerca esatta senza filtro di validità
+            index.valid_from[:], index.valid_to[:] = 0, 99991231
+            recall_raw = recall_rescored = elapsed = 0.0
+            for q, truth in zip(query_vectors, exact):
+                raw = [position[doc_id] for doc_id, _ in index.search(q, k, rescoring=0)]
+                recall_raw += len(set(raw) & truth) / k
+                start = time.perf_counter()
+                rescored = [position[doc_id] for doc_id, _ in index.search(q, k, rescoring=FATTORE_RESCORING)]
+                elapsed += time.perf_counter() - start
+                recall_rescored += len(set(rescored) & truth) / k
+            elapsed = elapsed / len(queries) * 1000
+            memory = index.memory_bytes()
+            print(f"{dim:>5} {index.method:>12} {memory / 1024:>8.0f} {1 - memory / baseline:>10.0%} "
+                  f"{index.disk_bytes() / 1024:>9.0f} {recall_raw / len(queries):>14.3f} "
+                  f"{recall_rescored / len(queries):>11.3f} {elapsed:>9.2f}")
+
+
+def misura_llm(client, model: str, prompts: List[List[Dict]], concurrency: int, max_tokens: int) -> Dict:
+    """Richieste in streaming con `concurrency` client: tempo al primo token, latenza totale, token/s"""
+    def one(messages):
+        start = time.perf_counter()
+        first, pieces = None, 0
+        for chunk in client.chat.completions.create(messages=messages, model=model, temperature=0.3,
+                                                     max_tokens=max_tokens, stream=True, timeout=300):
+            if chunk.choices[0].delta.content:
+                first = first or time.perf_counter()
+                pieces += 1
+        end = time.perf_counter()
+        return (first or end) - start, end - start, pieces
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, prompts))
+    elapsed = time.perf_counter() - start
+    ttft = [r[0] for r in results]
+    latency = [r[1] for r in results]
+    return {
+        "ttft_p50_ms": percentile(ttft, 0.5) * 1000,
+        "p50_ms": percentile(latency, 0.5) * 1000,
+        "p95_ms": percentile(latency, 0.95) * 1000,
+        "richieste_al_secondo": len(results) / elapsed,
+        "frammenti_al_secondo": sum(r[2] for r in results) / elapsed,
+    }
+
+
+def cmd_benchmark_llm(args):
+    """Backend locale (con e senza cache del prefisso) a confronto con Groq sugli stessi prompt RAG"""
+    assistant = crea_assistente()
+    assistant.preload_contracts()
+    from app_sindacato import LLM_LOCALE, get_local_llm
+
+    questions = [DOMANDE_CARICO[i % len(DOMANDE_CARICO)] for i in range(args.domande)]
+    prompts = [assistant.build_messages(question)[0] for question in questions]
+    print(f"{len(prompts)} prompt RAG, max {args.max_token} token in uscita")
+    print(f"{'backend':>20} {'conc.':>6} {'ttft p50':>9} {'p50 ms':>9} {'p95 ms':>9} {'req/s':>7} {'fram./s':>8} {'prefisso':>9}")
+
+    for backend in args.backend.split(","):
+        if backend.startswith("locale"):
+            if not LLM_LOCALE:
+                print(f"{backend:>20}  SINDACATO_LLM_LOCALE non impostata")
+                continue
+            client = get_local_llm()
+            client.prefix_cache = backend == "locale"
+            model = client.model_name
+        elif backend == "groq":
+            if not os.environ.get("GROQ_API_KEY"):
+                print(f"{backend:>20}  GROQ_API_KEY non impostata")
+                continue
+            from groq import Groq
+            client, model = Groq(api_key=os.environ["GROQ_API_KEY"]), args.modello
+        else:
+            sys.exit(f"Backend sconosciuto: {backend}")
+
+        for concurrency in [int(c) for c in args.concorrenza.split(",")]:
+            before = dict(client.stats) if backend.startswith("locale") else None
+            result = misura_llm(client, model, prompts, concurrency, args.max_token)
+            reused = "-"
+            if before is not None:
+                prompt_tokens = client.stats["token_prompt"] - before["token_prompt"]
+                reused = f"{(client.stats['token_riusati'] - before['token_riusati']) / max(prompt_tokens, 1):.0%}"
+            print(f"{backend:>20} {concurrency:>6} {result['ttft_p50_ms']:>9.0f} {result['p50_ms']:>9.0f} "
+                  f"{result['p95_ms']:>9.0f} {result['richieste_al_secondo']:>7.2f} "
+                  f"{result['frammenti_al_secondo']:>8.1f} {reused:>9}")
+
+
+def cmd_migrazione(args):
+    """Indice ombra per un nuovo modello (riprende la costruzione dove si era fermata), confronto e scambio"""
+    assistant = crea_assistente()
+    from app_sindacato import get_index_migration, leggi_indice_attivo
+    migration = get_index_migration()
+
+    if args.action == "stato":
+        print(json.dumps(leggi_indice_attivo(assistant.chroma_client), ensure_ascii=False, indent=2))
+        return
+    if args.action == "rollback":
+        active = migration.rollback(assistant)
+        print(f"Indice attivo: {active['modello']} ({active['collezione']})")
+        return
+    if not args.modello:
+        sys.exit("--modello è obbligatorio per costruisci, valuta e attiva")
+
+    migration.start(assistant, args.modello, args.velocita)
+    while migration.state == "costruzione":
+        print(f"\r{migration.done}/{migration.total} documenti", end="", flush=True)
+        time.sleep(0.5)
+    print(f"\r{migration.done}/{migration.total} documenti · {migration.state}")
+    if migration.state != "pronta":
+        sys.exit(f"Costruzione non riuscita: {migration.error}")
+
+    if args.action == "valuta":
+        report = migration.evaluate(k=args.k)
+        print(f"{report['domande']} domande (argomento → articolo), recall@{args.k}")
+        for label in ("attivo", "ombra"):
+            row = report[label]
+            print(f"{label:>7} {row['modello']:<50} {row['recall']:>6.3f} {row['ms_medi']:>8.1f} ms")
+    elif args.action == "attiva":
+        swapped = migration.swap()
+        print(f"Indice attivo: {swapped['modello']} ({swapped['collezione']}); "
+              f"precedente {swapped['precedente']['modello']} conservato per il rollback")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Strumenti dell'Assistente Sindacale Scuola")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    loadtest = commands.add_parser("loadtest", help="Test di carico del servizio HTTP")
+    loadtest.add_argument("--url", default="http://127.0.0.1:8000")
+    loadtest.add_argument("--endpoint", choices=["search", "ask"], default="search")
+    loadtest.add_argument("--concurrency", type=int, default=16)
+    loadtest.add_argument("--duration", type=float, default=15.0)
+    loadtest.add_argument("--workers", default="", help="Elenco di worker da confrontare, es. 1,2,4")
+    loadtest.add_argument("--port", type=int, default=8765)
+    loadtest.set_defaults(func=cmd_loadtest)
+
+    snapshot = commands.add_parser("snapshot", help="Crea o verifica uno snapshot dell'indice")
+    snapshot.add_argument("action", choices=["build", "verify"])
+    snapshot.add_argument("--path", "--out", dest="path", default="snapshot")
+    snapshot.add_argument("--dtype", choices=["float16", "int8"], default="float16")
+    snapshot.set_defaults(func=cmd_snapshot)
+
+    valuta = commands.add_parser("valuta-compressione", help="Memoria e recall dell'indice compatto int8")
+    valuta.add_argument("--dims", default="0,384,256", help="Dimensioni ridotte da confrontare (0 = nessuna)")
+    valuta.add_argument("--k", type=int, default=4)
+    valuta.set_defaults(func=cmd_valuta_compressione)
+
+    replay = commands.add_parser("replay", help="Riproduce il traffico registrato con un sostituto di Groq")
+    replay.add_argument("registro", help="File JSONL scritto con SINDACATO_REGISTRO_TRAFFICO")
+    replay.add_argument("--velocita", default="1,2,5,10,20", help="Fattori di accelerazione da provare")
+    replay.add_argument("--finestra", type=float, default=0.0, help="Secondi di registrazione da riprodurre (0 = tutti)")
+    replay.add_argument("--workers", type=int, default=32, help="Richieste servite in parallelo")
+    replay.add_argument("--latenza-llm", type=float, default=0.8, help="Latenza simulata del modello grande (s)")
+    replay.add_argument("--slo-ms", type=float, default=3000.0, help="Soglia di latenza p95 per la saturazione")
+    replay.add_argument("--dettaglio", action="store_true", help="Percentili per tipo di operazione")
+    replay.set_defaults(func=cmd_replay)
+
+    benchmark = commands.add_parser("benchmark-llm", help="Backend LLM locale a confronto con Groq")
+    benchmark.add_argument("--backend", default="locale,locale-senza-cache,groq",
+                           help="Elenco tra locale, locale-senza-cache, groq")
+    benchmark.add_argument("--concorrenza", default="1,4", help="Richieste in parallelo da provare")
+    benchmark.add_argument("--domande", type=int, default=8)
+    benchmark.add_argument("--max-token", type=int, default=128)
+    benchmark.add_argument("--modello", default="llama-3.1-8b-instant", help="Modello Groq di confronto")
+    benchmark.set_defaults(func=cmd_benchmark_llm)
+
+    migrazione = commands.add_parser("migrazione", help="Cambio del modello di embedding con indice ombra")
+    migrazione.add_argument("action", choices=["costruisci", "valuta", "attiva", "rollback", "stato"])
+    migrazione.add_argument("--modello", help="Nuovo modello di embedding")
+    migrazione.add_argument("--velocita", type=float, default=0.0, help="Documenti al secondo (0 = senza limite)")
+    migrazione.add_argument("--k", type=int, default=4)
+    migrazione.set_defaults(func=cmd_migrazione)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Backend LLM locale (CPU) dell'Assistente Sindacale Scuola
+Modello GGUF con llama.cpp, stessa interfaccia del client Groq (chat.completions.create)
+
+Il prompt inizia sempre con lo stesso prefisso statico (messaggio di sistema e istruzioni):
+il suo stato KV viene calcolato una volta e ricaricato in ogni slot, così per ogni
+richiesta il modello elabora solo contesto e domanda.
+Gli slot sono contesti llama.cpp indipendenti sullo stesso file (pesi condivisi via mmap):
+uno scheduler continuo assegna ogni richiesta al primo slot che si libera.
+
+Installa: pip install llama-cpp-python
+Esegui:   SINDACATO_LLM_LOCALE=modelli/llama-3.1-8b-instruct-q4_k_m.gguf streamlit run app_sindacato.py
+"""
+
+import os
+import codecs
+import queue
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Formati di chat dei modelli instruct (il prefisso statico deve essere reso identico a ogni richiesta)
+FORMATI_CHAT = {
+    "llama-3": {
+        "inizio": "<|begin_of_text|>",
+        "turno": "<|start_header_id|>{ruolo}<|end_header_id|>\n\n{testo}<|eot_id|>",
+        "risposta": "<|start_header_id|>assistant<|end_header_id|>\n\n",
+        "stop": "<|eot_id|>",
+    },
+    "chatml": {
+        "inizio": "",
+        "turno": "<|im_start|>{ruolo}\n{testo}<|im_end|>\n",
+        "risposta": "<|im_start|>assistant\n",
+        "stop": "<|im_end|>",
+    },
+}
+
+
+def _common_prefix(a, b) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class _Job:
+    def __init__(self, prompt: str, temperature: float, max_tokens: int):
+        self.prompt = prompt
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.created = time.perf_counter()
+        self.output: "queue.Queue" = queue.Queue()
+        self.cancelled = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.finish_reason = "stop"
+
+
+class LocalLLMClient:
+    """Client compatibile con Groq su un modello GGUF locale, con cache KV del prefisso statico"""
+
+    def __init__(self, model_path: str, slots: int = 2, n_ctx: int = 8192, threads: Optional[int] = None,
+                 chat_format: str = "llama-3", prefix: Optional[Tuple[str, str]] = None):
+        if chat_format not in FORMATI_CHAT:
+            raise ValueError(f"Formato di chat sconosciuto: {chat_format} (disponibili: {', '.join(FORMATI_CHAT)})")
+        self.model_path = model_path
+        self.model_name = os.path.basename(model_path)
+        self.n_slots = max(1, slots)
+        self.n_ctx = n_ctx
+        # I core vengono divisi tra gli slot: ognuno decodifica la sua richiesta in parallelo
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.n_slots)
+        self.format = FORMATI_CHAT[chat_format]
+        self.prefix = prefix
+        # Disattivabile per i benchmark: ogni richiesta rielabora tutto il prompt
+        self.prefix_cache = True
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.stats = {
+            "richieste": 0,
+            "token_prompt": 0,
+            "token_riusati": 0,
+            "token_generati": 0,
+            "secondi_attesa": 0.0,
+            "secondi_prefill": 0.0,
+            "secondi_generazione": 0.0,
+        }
+        self._jobs: "queue.Queue" = queue.Queue()
+        self._slots: List = []
+        self._prefix_tokens: List[int] = []
+        self._prefix_state = None
+        self._stop_tokens = set()
+        self._lock = threading.Lock()
+
+    def render(self, messages: List[Dict]) -> str:
+        """Prompt testuale nel formato di chat del modello"""
+        turns = "".join(self.format["turno"].format(ruolo=m["role"], testo=m["content"]) for m in messages)
+        return self.format["inizio"] + turns + self.format["risposta"]
+
+    def _render_prefix(self, system: str, user_prefix: str) -> str:
+        user_start = self.format["turno"].split("{testo}")[0].format(ruolo="user")
+        return (self.format["inizio"] + self.format["turno"].format(ruolo="system", testo=system)
+                + user_start + user_prefix)
+
+    def start(self):
+        """Carica il modello negli slot e precalcola lo stato KV del prefisso (una volta per processo)"""
+        with self._lock:
+            if self._slots:
+                return
+            try:
+                from llama_cpp import Llama
+            except ImportError as e:
+                raise RuntimeError("Backend locale non disponibile: pip install llama-cpp-python") from e
+            if not os.path.exists(self.model_path):
+                raise RuntimeError(f"Modello GGUF non trovato: {self.model_path}")
+
+            llms = [Llama(model_path=self.model_path, n_ctx=self.n_ctx, n_threads=self.threads,
+                          n_batch=512, verbose=False) for _ in range(self.n_slots)]
+            self._stop_tokens = {llms[0].token_eos()}
+            stop = llms[0].tokenize(self.format["stop"].encode("utf-8"), add_bos=False, special=True)
+            if len(stop) == 1:
+                self._stop_tokens.add(stop[0])
+
+            if self.prefix:
+                text = self._render_prefix(*self.prefix)
+                # L'ultimo token può fondersi con l'inizio del contesto: resta fuori dal prefisso
+                self._prefix_tokens = llms[0].tokenize(text.encode("utf-8"), add_bos=False, special=True)[:-1]
+                llms[0].reset()
+                llms[0].eval(self._prefix_tokens)
+                self._prefix_state = llms[0].save_state()
+                for llm in llms[1:]:
+                    llm.load_state(self._prefix_state)
+
+            for i, llm in enumerate(llms):
+                threading.Thread(target=self._serve, args=(llm,), daemon=True, name=f"llm-slot-{i}").start()
+            self._slots = llms
+
+    def _serve(self, llm):
+        """Slot: prende la prossima richiesta appena finisce la precedente"""
+        while True:
+            job = self._jobs.get()
+            if job.cancelled:
+                continue
+            try:
+                self._generate(llm, job)
+            except Exception as e:
+                job.output.put(e)
+            job.output.put(None)
+
+    def _generate(self, llm, job: _Job):
+        waited = time.perf_counter() - job.created
+        tokens = llm.tokenize(job.prompt.encode("utf-8"), add_bos=False, special=True)
+        max_tokens = min(job.max_tokens, self.n_ctx - len(tokens))
+        if max_tokens <= 0:
+            raise ValueError(f"Prompt di {len(tokens)} token oltre il contesto del modello locale ({self.n_ctx})")
+
+        if not self.prefix_cache:
+            llm.reset()
+        elif self._prefix_state is not None:
+            n = len(self._prefix_tokens)
+            # Lo slot ha in memoria un prompt diverso: si ricarica il prefisso invece di rielaborarlo
+            if tokens[:n] == self._prefix_tokens and _common_prefix(llm.input_ids[:llm.n_tokens], tokens) < n:
+                llm.load_state(self._prefix_state)
+        # generate() riusa da solo i token già valutati in comune con il nuovo prompt
+        reused = _common_prefix(llm.input_ids[:llm.n_tokens], tokens[:-1]) if self.prefix_cache else 0
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        start = time.perf_counter()
+        first = None
+        generated = 0
+        job.finish_reason = "length"
+        for token in llm.generate(tokens, temp=job.temperature, top_k=40, top_p=0.95, repeat_penalty=1.1):
+            if first is None:
+                first = time.perf_counter()
+            if job.cancelled:
+                break
+            if token in self._stop_tokens:
+                job.finish_reason = "stop"
+                break
+            generated += 1
+            text = decoder.decode(llm.detokenize([token]))
+            if text:
+                job.output.put(text)
+            if generated >= max_tokens:
+                break
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            job.output.put(tail)
+
+        end = time.perf_counter()
+        first = first or end
+        job.prompt_tokens, job.completion_tokens = len(tokens), generated
+        with self._lock:
+            self.stats["richieste"] += 1
+            self.stats["token_prompt"] += len(tokens)
+            self.stats["token_riusati"] += reused
+            self.stats["token_generati"] += generated
+            self.stats["secondi_attesa"] += waited
+            self.stats["secondi_prefill"] += first - start
+            self.stats["secondi_generazione"] += end - first
+
+    def _pieces(self, job: _Job, timeout: Optional[float]) -> Iterator[str]:
+        """Testo prodotto dallo slot; `timeout` è l'attesa massima tra due frammenti (come una lettura HTTP)"""
+        try:
+            while True:
+                try:
+                    piece = job.output.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"Modello locale: nessun token entro {timeout:.0f}s")
+                if piece is None:
+                    return
+                if isinstance(piece, Exception):
+                    raise piece
+                yield piece
+        finally:
+            # Richiesta abbandonata (timeout o client disconnesso): lo slot si libera al prossimo token
+            job.cancelled = True
+
+    def create(self, messages: List[Dict], model: Optional[str] = None, temperature: float = 0.3,
+               max_tokens: int = 2048, stream: bool = False, timeout: Optional[float] = None, **kwargs):
+        """Come Groq: risposta completa, oppure flusso di chunk con `choices[0].delta.content`"""
+        self.start()
+        job = _Job(self.render(messages), temperature, max_tokens)
+        self._jobs.put(job)
+        if stream:
+            chunks = (SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+                      for piece in self._pieces(job, timeout))
+            # Un flusso mai letto non entra mai in _pieces (niente finally): lo annulla la garbage collection
+            weakref.finalize(chunks, setattr, job, "cancelled", True)
+            return chunks
+        text = "".join(self._pieces(job, timeout))
+        usage = SimpleNamespace(prompt_tokens=job.prompt_tokens, completion_tokens=job.completion_tokens,
+                                total_tokens=job.prompt_tokens + job.completion_tokens)
+        return SimpleNamespace(
+            model=self.model_name,
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason=job.finish_reason)],
+            usage=usage
+        )
+
+    def queue_length(self) -> int:
+        return self._jobs.qsize()
+
+    def report(self) -> Dict:
+        """Medie per richiesta e quota di prompt servita dalla cache del prefisso"""
+        with self._lock:
+            stats = dict(self.stats)
+        n = max(stats["richieste"], 1)
+        return {
+            "richieste": stats["richieste"],
+            "slot": self.n_slots,
+            "in_coda": self.queue_length(),
+            "token_prefisso": len(self._prefix_tokens),
+            "quota_riusata": stats["token_riusati"] / max(stats["token_prompt"], 1),
+            "ms_attesa": stats["secondi_attesa"] / n * 1000,
+            "ms_prefill": stats["secondi_prefill"] / n * 1000,
+            "token_al_secondo": stats["token_generati"] / max(stats["secondi_generazione"], 1e-9),
+        }
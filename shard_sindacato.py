@@ -0,0 +1,376 @@
+"""
+Indice vettoriale partizionato dell'Assistente Sindacale Scuola
+
+Gli shard sono per categoria (o per hash del documento se la categoria è grande).
+Ogni processo del pool tiene in memoria i vettori normalizzati dei suoi shard e
+restituisce il top-k di ciascuno; il processo principale li unisce nel top-k globale.
+Modulo separato (solo numpy): i processi figli non devono importare Streamlit.
+I processi sono avviati con "spawn": lo script di avvio deve essere protetto da
+`if __name__ == "__main__"` (già così per Streamlit, uvicorn e cli_sindacato.py).
+
+Ogni processo che usa l'indice (ogni worker uvicorn, ogni server Streamlit) avvia il
+proprio pool, con una copia completa dei vettori: con N worker web si hanno N pool.
+Per questo il numero di processi per pool si divide tra i worker web (vedi app_sindacato.py).
+"""
+
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+import zlib
+import multiprocessing
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("sindacato.shard")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+# Attesa massima di una risposta da un processo del pool prima di considerarlo perso
+TIMEOUT_SHARD = 10.0
+
+
+class ShardNonDisponibile(ConnectionError):
+    """Processo del pool terminato o che non risponde: l'indice va ricostruito"""
+
+
+def _worker(conn):
+    """Processo del pool: una risposta (con l'id della richiesta) per ogni comando ricevuto"""
+    shards: Dict[str, list] = {}  # shard -> [ids, vettori, valido_dal, valido_al]
+    while True:
+        request_id, command, payload = conn.recv()
+        if command == "stop":
+            break
+        conn.send((request_id, _execute(shards, command, payload)))
+
+
+def _execute(shards: Dict[str, list], command: str, payload):
+    if command == "reset":
+        shards.clear()
+    elif command == "add":
+        for shard, ids, vectors, valid_from, valid_to in payload:
+            vectors = _normalize(vectors)
+            if shard in shards:
+                old = shards[shard]
+                shards[shard] = [old[0] + list(ids), np.vstack([old[1], vectors]),
+                                 np.concatenate([old[2], valid_from]), np.concatenate([old[3], valid_to])]
+            else:
+                shards[shard] = [list(ids), vectors, np.asarray(valid_from), np.asarray(valid_to)]
+    elif command == "validita":
+        shard, doc_id, valid_from, valid_to = payload
+        if shard in shards and doc_id in shards[shard][0]:
+            i = shards[shard][0].index(doc_id)
+            shards[shard][2][i], shards[shard][3][i] = valid_from, valid_to
+    elif command == "export":
+        # Lo shard lascia il processo (ribilanciamento)
+        ids, vectors, valid_from, valid_to = shards.pop(payload)
+        return payload, ids, vectors, valid_from, valid_to
+    elif command == "query":
+        query, k, date = payload
+        results = []
+        for shard, (ids, vectors, valid_from, valid_to) in shards.items():
+            start = time.perf_counter()
+            scores = np.where((valid_from <= date) & (valid_to >= date), vectors @ query, -np.inf)
+            top_k = min(k, len(ids))
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            hits = [(float(scores[i]), ids[i]) for i in top if np.isfinite(scores[i])]
+            results.append((shard, hits, time.perf_counter() - start))
+        return results
+
+
+class _Worker:
+    """Processo del pool; le risposte sono instradate per id, quindi più richieste possono essere in volo"""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        # Senza chiudere il lato figlio la lettura non vedrebbe mai EOF alla morte del processo
+        child_conn.close()
+        self.alive = True
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, daemon=True, name="shard-risposte")
+        self._reader.start()
+
+    def submit(self, command: str, payload=None) -> Future:
+        future = Future()
+        with self._send_lock:
+            if not self.alive:
+                raise ShardNonDisponibile("processo dello shard terminato")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            try:
+                self.conn.send((request_id, command, payload))
+            except (OSError, ValueError) as e:
+                del self._pending[request_id]
+                raise ShardNonDisponibile(str(e)) from e
+        return future
+
+    def call(self, command: str, payload=None, timeout: Optional[float] = None):
+        try:
+            return self.submit(command, payload).result(timeout)
+        except FutureTimeoutError as e:
+            raise ShardNonDisponibile(f"nessuna risposta in {timeout}s") from e
+
+    def _read(self):
+        while True:
+            try:
+                request_id, result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._pending.pop(request_id, None)
+            if future is not None:
+                future.set_result(result)
+        with self._send_lock:
+            self.alive = False
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ShardNonDisponibile("processo dello shard terminato"))
+        # Chiusa qui e non da close(): chiuderla durante recv() in un altro thread non è sicuro
+        self.conn.close()
+
+    def close(self, graceful: bool = True):
+        if graceful:
+            try:
+                with self._send_lock:
+                    self.conn.send((None, "stop", None))
+            except (OSError, ValueError):
+                pass
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+        # Processo terminato: la lettura riceve EOF, fallisce le richieste in volo e chiude la pipe
+        self._reader.join(timeout=5)
+
+
+class ShardedVectorIndex:
+    """Pool di processi che servono gli shard; latenza per shard e proposta di ribilanciamento"""
+
+    def __init__(self, processes: int, max_documents: int):
+        self.n_processes = max(1, processes)
+        self.max_documents = max_documents
+        self.version = None
+        self.source = None
+        self.workers: List[_Worker] = []
+        self.owner: Dict[str, int] = {}
+        self.doc_shard: Dict[str, str] = {}
+        self.partitions: Dict[str, int] = {}
+        self.sizes: Dict[str, int] = {}
+        self.stats: Dict[str, Dict] = {}
+        # Rientrante: un processo perso durante build/add viene riavviato con il lock già preso
+        self._lock = threading.RLock()
+        self._context = multiprocessing.get_context("spawn")
+
+    def start(self):
+        if self.workers:
+            return
+        self.workers = [_Worker(self._context) for _ in range(self.n_processes)]
+
+    def _call(self, worker: int, command: str, payload=None):
+        handle = self.workers[worker]
+        try:
+            return handle.call(command, payload)
+        except ShardNonDisponibile:
+            self._restart(handle)
+            raise
+
+    def _restart(self, handle: _Worker):
+        """Sostituisce un processo perso; gli shard che serviva sono andati, quindi serve una ricostruzione"""
+        with self._lock:
+            if handle not in self.workers:
+                return  # già sostituito da un'altra richiesta
+            logger.warning("Processo dello shard perso (pid %s): riavvio, indice da ricostruire", handle.process.pid)
+            handle.close(graceful=False)
+            self.workers[self.workers.index(handle)] = _Worker(self._context)
+            # Fino al prossimo sync le ricerche tornano su Chroma
+            self.version = None
+
+    def shard_of(self, doc_id: str, categoria: str) -> str:
+        parts = self.partitions.get(categoria, 1)
+        if parts == 1:
+            return categoria
+        return f"{categoria}#{zlib.crc32(doc_id.encode('utf-8')) % parts}"
+
+    def _least_loaded(self) -> int:
+        loads = [0] * self.n_processes
+        for shard, worker in self.owner.items():
+            loads[worker] += self.sizes.get(shard, 0)
+        return loads.index(min(loads))
+
+    def _send(self, ids: List[str], vectors: np.ndarray, metadatas: List[Dict]):
+        """Raggruppa per shard e invia ogni gruppo al processo che lo serve"""
+        groups: Dict[str, List[int]] = {}
+        for i, (doc_id, meta) in enumerate(zip(ids, metadatas)):
+            shard = self.shard_of(doc_id, meta.get("categoria", ""))
+            groups.setdefault(shard, []).append(i)
+        batches: Dict[int, list] = {}
+        for shard, rows in sorted(groups.items(), key=lambda item: -len(item[1])):
+            if shard not in self.owner:
+                self.owner[shard] = self._least_loaded()
+            self.sizes[shard] = self.sizes.get(shard, 0) + len(rows)
+            for i in rows:
+                self.doc_shard[ids[i]] = shard
+            batches.setdefault(self.owner[shard], []).append((
+                shard,
+                [ids[i] for i in rows],
+                vectors[rows],
+                np.array([metadatas[i].get("valido_dal", 0) for i in rows], dtype=np.int64),
+                np.array([metadatas[i].get("valido_al", 99991231) for i in rows], dtype=np.int64),
+            ))
+        for worker, batch in batches.items():
+            self._call(worker, "add", batch)
+
+    def build(self, ids: List[str], vectors: np.ndarray, metadatas: List[Dict]):
+        """Ricostruzione completa: le categorie grandi vengono divise per hash"""
+        self.start()
+        with self._lock:
+            for worker in range(self.n_processes):
+                self._call(worker, "reset")
+            self.owner, self.doc_shard, self.sizes, self.partitions = {}, {}, {}, {}
+            counts: Dict[str, int] = {}
+            for meta in metadatas:
+                counts[meta.get("categoria", "")] = counts.get(meta.get("categoria", ""), 0) + 1
+            self.partitions = {categoria: max(1, math.ceil(n / self.max_documents)) for categoria, n in counts.items()}
+            self._send(ids, np.asarray(vectors, dtype=np.float32), metadatas)
+
+    def add(self, ids: List[str], vectors: np.ndarray, metadatas: List[Dict]):
+        self.start()
+        with self._lock:
+            try:
+                self._send(ids, np.asarray(vectors, dtype=np.float32), metadatas)
+            except ShardNonDisponibile:
+                pass  # processo riavviato: la ricostruzione al prossimo sync include questi documenti
+
+    def update_validity(self, doc_id: str, metadata: Dict):
+        shard = self.doc_shard.get(doc_id)
+        if shard is not None:
+            try:
+                self._call(self.owner[shard], "validita",
+                           (shard, doc_id, metadata.get("valido_dal", 0), metadata.get("valido_al", 99991231)))
+            except ShardNonDisponibile:
+                pass
+
+    def sync(self, collection, corpus_version: str):
+        """Allinea gli shard alla collection; ricostruisce se mancano documenti o uno shard è troppo grande"""
+        if self.version == corpus_version:
+            return
+        ids = collection.get(include=[])["ids"]
+        oversized = any(size > 2 * self.max_documents for size in self.sizes.values())
+        if self.version is None or oversized or set(self.doc_shard) - set(ids) or collection.name != self.source:
+            # Anche con un nuovo modello di embedding (collection diversa) si riparte da zero
+            self.source = collection.name
+            data = collection.get(include=["embeddings", "metadatas"])
+            if data["ids"]:
+                try:
+                    self.build(data["ids"], data["embeddings"], data["metadatas"])
+                except ShardNonDisponibile:
+                    return  # resta senza versione: ricerche su Chroma, nuovo tentativo al prossimo sync
+        else:
+            missing = [doc_id for doc_id in ids if doc_id not in self.doc_shard]
+            if missing:
+                data = collection.get(ids=missing, include=["embeddings", "metadatas"])
+                self.add(data["ids"], data["embeddings"], data["metadatas"])
+                if self.version is None:
+                    return  # un processo è stato riavviato durante l'aggiunta
+        self.version = corpus_version
+
+    def search(self, query_vector: np.ndarray, k: int, date: int) -> List[Tuple[str, float]]:
+        """Fan-out a tutti i processi, top-k per shard, unione nel top-k globale.
+
+        Nessun lock durante l'attesa: ogni richiesta ha il suo id e più ricerche possono essere
+        in volo sullo stesso processo. Con un processo perso (o muto) restituisce [] e il
+        chiamante ripiega su Chroma; il processo viene riavviato e l'indice ricostruito al sync.
+        """
+        query = _normalize(query_vector)[0]
+        handles = [self.workers[worker] for worker in sorted(set(self.owner.values()))]
+        futures, replies = [], []
+        for handle in handles:
+            try:
+                futures.append((handle, handle.submit("query", (query, k, date))))
+            except ShardNonDisponibile:
+                self._restart(handle)
+                return []
+        for handle, future in futures:
+            try:
+                replies.append(future.result(TIMEOUT_SHARD))
+            except (ShardNonDisponibile, FutureTimeoutError):
+                self._restart(handle)
+                return []
+
+        hits = []
+        with self._lock:
+            for reply in replies:
+                for shard, shard_hits, elapsed in reply:
+                    stats = self.stats.setdefault(shard, {"chiamate": 0, "ms_medi": 0.0})
+                    stats["chiamate"] += 1
+                    # Media mobile esponenziale della latenza dello shard
+                    ms = elapsed * 1000
+                    stats["ms_medi"] = ms if stats["chiamate"] == 1 else 0.8 * stats["ms_medi"] + 0.2 * ms
+                    hits.extend(shard_hits)
+        return [(doc_id, score) for score, doc_id in heapq.nlargest(k, hits)]
+
+    def _load(self, shard: str) -> float:
+        stats = self.stats.get(shard)
+        # Senza statistiche il carico stimato è la dimensione dello shard
+        return stats["chiamate"] * stats["ms_medi"] if stats else self.sizes.get(shard, 0) * 1e-6
+
+    def shard_stats(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "shard": shard,
+                    "processo": self.owner[shard],
+                    "documenti": self.sizes.get(shard, 0),
+                    "chiamate": self.stats.get(shard, {}).get("chiamate", 0),
+                    "ms_medi": round(self.stats.get(shard, {}).get("ms_medi", 0.0), 3),
+                    "carico": round(self._load(shard), 1),
+                }
+                for shard in sorted(self.owner)
+            ]
+
+    def rebalance_plan(self) -> List[Tuple[str, int, int]]:
+        """Spostamenti (shard, da, a) che distribuiscono meglio il carico tra i processi (LPT)"""
+        with self._lock:
+            loads = {shard: self._load(shard) for shard in self.owner}
+            current = [0.0] * self.n_processes
+            for shard, worker in self.owner.items():
+                current[worker] += loads[shard]
+            planned = [0.0] * self.n_processes
+            assignment = {}
+            for shard in sorted(loads, key=loads.get, reverse=True):
+                worker = planned.index(min(planned))
+                assignment[shard] = worker
+                planned[worker] += loads[shard]
+            # Conviene solo se il processo più carico migliora almeno del 10%
+            if max(planned) > 0.9 * max(current):
+                return []
+            return [(shard, self.owner[shard], worker) for shard, worker in assignment.items()
+                    if worker != self.owner[shard]]
+
+    def rebalance(self) -> List[Tuple[str, int, int]]:
+        moves = self.rebalance_plan()
+        with self._lock:
+            for i, (shard, source, target) in enumerate(moves):
+                try:
+                    exported = self._call(source, "export", shard)
+                    self._call(target, "add", [exported])
+                except ShardNonDisponibile:
+                    return moves[:i]  # indice da ricostruire: gli spostamenti restanti non servono
+                self.owner[shard] = target
+        return moves
+
+    def close(self):
+        for handle in self.workers:
+            handle.close()
+        self.workers = []
@@ -0,0 +1,42 @@
+"""
+Test dei componenti puri dell'Assistente Sindacale Scuola (nessun modello, Chroma o rete)
+
+Esegui: pip install pytest && python -m pytest -q
+"""
+
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Fuori da `streamlit run` Streamlit segnala ogni uso di st.cache_resource
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import app_sindacato  # noqa: E402
+
+
+def metadati_precaricati(categoria: str, argomento: str) -> dict:
+    """Metadati come quelli di preload_contracts (senza versione del contratto)"""
+    return {"categoria": categoria, "argomento": argomento,
+            "valido_dal": app_sindacato.SEMPRE_VALIDO_DAL, "valido_al": app_sindacato.SEMPRE_VALIDO_AL}
+
+
+@pytest.fixture
+def corpus():
+    """(id, testo, metadati) delle normative precaricate, nello stesso formato della collection"""
+    return [
+        (f"doc_{i}", f"{item['argomento']}: {item['contenuto']}", metadati_precaricati(categoria, item["argomento"]))
+        for i, (categoria, item) in enumerate(
+            (categoria, item) for categoria, items in app_sindacato.NORMATIVE_SCUOLA.items() for item in items
+        )
+    ]
+
+
+@pytest.fixture
+def fact_index(corpus):
+    index = app_sindacato.FactIndex()
+    for doc_id, text, meta in corpus:
+        index.add(doc_id, text, meta)
+    return index
@@ -0,0 +1,313 @@
+import gc
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app_sindacato
+from app_sindacato import (
+    MODALITA_AUTOMATICA, PRIORITA_BATCH, PRIORITA_INTERATTIVA, AdmissionController, CircuitBreaker,
+    SchoolUnionAssistant, SingleFlight, SovraccaricoError
+)
+from llm_sindacato import LocalLLMClient
+
+
+# Interruttore sull'LLM
+
+def test_interruttore_si_apre_con_troppi_errori():
+    breaker = CircuitBreaker(window=4, min_calls=4, max_failure_rate=0.5, cooldown=60)
+    for success in (True, False, True):
+        breaker.record(success, 0.1)
+    assert breaker.state == "chiuso"
+    breaker.record(False, 0.1)
+    assert breaker.state == "aperto"
+    assert not breaker.allow()
+
+
+def test_risposta_lenta_conta_come_fallimento():
+    breaker = CircuitBreaker(window=2, min_calls=2, max_failure_rate=1.0, max_latency=1.0)
+    breaker.record(True, 5.0)
+    breaker.record(True, 5.0)
+    assert breaker.state == "aperto"
+
+
+def test_semiaperto_una_sola_prova_poi_si_richiude():
+    breaker = CircuitBreaker(min_calls=1, max_failure_rate=0.5, cooldown=0)
+    breaker.record(False, 0.1)
+    assert breaker.allow()
+    assert breaker.state == "semiaperto"
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == "chiuso"
+    assert breaker.allow()
+
+
+def test_semiaperto_prova_fallita_riapre():
+    breaker = CircuitBreaker(min_calls=1, max_failure_rate=0.5, cooldown=0)
+    breaker.record(False, 0.1)
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == "aperto"
+
+
+def test_semiaperto_prova_mai_conclusa_scade():
+    breaker = CircuitBreaker(min_calls=1, max_failure_rate=0.5, cooldown=0, trial_timeout=0.05)
+    breaker.record(False, 0.1)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def assistente_in_prova(chunks, delay=0.0):
+    """Assistente con interruttore semiaperto e un LLM finto che produce `chunks`"""
+    def create(**_):
+        for text in chunks:
+            time.sleep(delay)
+            if isinstance(text, Exception):
+                raise text
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    assistant = object.__new__(SchoolUnionAssistant)
+    assistant.breaker = CircuitBreaker(min_calls=1, max_failure_rate=0.5, cooldown=0, max_latency=0.5)
+    assistant.breaker.record(False, 0.1)
+    assistant.fact_index = SimpleNamespace(answer=lambda *_: None)
+    assistant._retrieve_for_answer = lambda *_: ([], [], {})
+    assistant.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return assistant
+
+
+def flusso(assistant):
+    tokens, _ = assistant._answer_question_stream("domanda", "modello", MODALITA_AUTOMATICA, None, {})
+    return tokens
+
+
+def test_flusso_mai_letto_rilascia_la_prova():
+    assistant = assistente_in_prova(["a"])
+    tokens = flusso(assistant)
+    assert assistant.breaker.state == "semiaperto" and not assistant.breaker.allow()
+    del tokens
+    gc.collect()
+    assert assistant.breaker.allow()
+
+
+def test_flusso_interrotto_dopo_il_primo_token_richiude():
+    assistant = assistente_in_prova(["a", "b", "c"])
+    tokens = flusso(assistant)
+    assert next(tokens) == "a"
+    tokens.close()
+    assert assistant.breaker.state == "chiuso"
+
+
+def test_flusso_lungo_conta_il_tempo_al_primo_token():
+    assistant = assistente_in_prova(["a"] * 8, delay=0.1)
+    assert "".join(flusso(assistant)) == "a" * 8
+    assert assistant.breaker.state == "chiuso"
+
+
+def test_flusso_con_errore_riapre():
+    assistant = assistente_in_prova(["a", RuntimeError("rete")])
+    with pytest.raises(RuntimeError):
+        list(flusso(assistant))
+    assert assistant.breaker.state == "aperto"
+
+
+# Controllo di ammissione
+
+def test_oltre_la_capacita_si_attende_in_coda():
+    admission = AdmissionController(capacity=1, burst=10)
+    first = admission.submit("a")
+    second = admission.submit("b")
+    assert first.granted and not second.granted
+    assert admission.position(second) == 1
+    admission.release(first)
+    assert second.granted
+    assert admission.queue_length() == 0
+
+
+def test_token_bucket_limita_la_singola_sessione():
+    admission = AdmissionController(capacity=10, rate_per_minute=0.0, burst=2)
+    assert admission.submit("a") and admission.submit("a")
+    assert admission.submit("a") is None
+    assert admission.stats["limite_sessione"] == 1
+    # Le altre sessioni e il lavoro di sistema non ne risentono
+    assert admission.submit("b") is not None
+    assert admission.submit("a", priority=PRIORITA_BATCH) is not None
+
+
+def test_code_eque_tra_sessioni():
+    admission = AdmissionController(capacity=1, burst=10)
+    running = admission.submit("occupa")
+    queued = [admission.submit("a"), admission.submit("a"), admission.submit("a"), admission.submit("b")]
+    order = []
+    ticket = running
+    for _ in queued:
+        admission.release(ticket)
+        ticket = next(t for t in queued if t.granted)
+        order.append(ticket.session_id)
+    # "b" non aspetta tutte le richieste di "a" arrivate prima
+    assert order.index("b") < 3
+
+
+def test_priorita_interattiva_prima_del_batch():
+    admission = AdmissionController(capacity=1, burst=10)
+    running = admission.submit("occupa")
+    batch = admission.submit("faq-warmup", priority=PRIORITA_BATCH)
+    interactive = admission.submit("a", priority=PRIORITA_INTERATTIVA)
+    admission.release(running)
+    assert interactive.granted and not batch.granted
+
+
+def test_batch_non_resta_affamato():
+    admission = AdmissionController(capacity=1, burst=100, aging=0.05)
+    running = admission.submit("occupa")
+    batch = admission.submit("faq-warmup", priority=PRIORITA_BATCH)
+    time.sleep(0.06)
+    interactive = admission.submit("a", priority=PRIORITA_INTERATTIVA)
+    admission.release(running)
+    # Dopo l'attesa il batch vale quanto un'interattiva ed era in coda prima
+    assert batch.granted and not interactive.granted
+
+
+def test_tempo_virtuale_avanza_dall_inizio_del_biglietto():
+    admission = AdmissionController(capacity=1, burst=10)
+    # Peso 1/2: il biglietto occupa due unità di tempo virtuale, ma inizia da zero
+    heavy = admission.submit("a", weight=0.5)
+    assert heavy.start == 0.0 and heavy.finish == 2.0
+    assert admission._virtual_time == 0.0
+    light = admission.submit("b", weight=4.0)
+    admission.release(heavy)
+    assert light.granted and admission._virtual_time == light.start == 0.0
+    admission.release(light)
+    again = admission.submit("b", weight=4.0)
+    assert again.start == 0.25 and admission._virtual_time == 0.25
+
+
+def test_sessioni_inattive_dimenticate():
+    admission = AdmissionController(capacity=100, rate_per_minute=6000, burst=1, prune_every=1)
+    for i in range(50):
+        admission.release(admission.submit(f"s{i}"))
+    time.sleep(0.02)
+    admission.release(admission.submit("ultima"))
+    assert set(admission._buckets) <= {"ultima"}
+    assert len(admission._last_finish) <= 1
+
+
+def test_coda_piena_e_attesa_scaduta():
+    admission = AdmissionController(capacity=1, burst=10, max_queue=1, max_wait=0.3)
+    admission.submit("occupa")
+    assert admission.acquire("a") is None
+    assert admission.stats["attesa_scaduta"] == 1
+    admission.submit("b")
+    assert admission.submit("c") is None
+    assert admission.stats["coda_piena"] == 1
+
+
+def test_run_usa_il_ripiego_se_scartata():
+    admission = AdmissionController(capacity=1, rate_per_minute=0.0, burst=0)
+    assert admission.run("a", lambda: "llm", fallback=lambda: "estrattiva") == "estrattiva"
+    with pytest.raises(SovraccaricoError):
+        admission.run("a", lambda: "llm")
+
+
+def test_run_libera_lo_slot_anche_in_caso_di_errore():
+    admission = AdmissionController(capacity=1, burst=10)
+    with pytest.raises(ValueError):
+        admission.run("a", lambda: (_ for _ in ()).throw(ValueError("errore")))
+    assert admission.run("a", lambda: "ok") == "ok"
+
+
+# Accorpamento delle richieste identiche
+
+def test_singleflight_una_sola_esecuzione_per_chiamate_identiche():
+    flights = SingleFlight()
+    calls, started, release = [], threading.Event(), threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "risposta"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do(("answer", "ferie"), slow)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flights.do(("answer", "ferie"), slow)))
+                 for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == ["risposta"] * 4
+    assert len(calls) == 1
+    assert flights.stats["answer"] == {"eseguite": 1, "accorpate": 3}
+    assert flights.avoided() == 3
+
+
+def test_singleflight_propaga_l_errore_e_non_lo_memorizza():
+    flights = SingleFlight()
+    with pytest.raises(RuntimeError):
+        flights.do(("search", "x"), lambda: (_ for _ in ()).throw(RuntimeError("giù")))
+    assert flights.do(("search", "x"), lambda: 42) == 42
+
+
+def test_singleflight_flusso_condiviso_dall_inizio():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def tokens():
+        yield "a"
+        release.wait(5)
+        yield "b"
+
+    first, sources = flights.do_stream(("stream", "q"), lambda: (tokens(), ["fonte"]))
+    second, same_sources = flights.do_stream(("stream", "q"), lambda: pytest.fail("flusso riaperto"))
+    release.set()
+    assert "".join(first) == "ab" and "".join(second) == "ab"
+    assert sources == same_sources == ["fonte"]
+
+
+def test_richiesta_accorpata_registra_la_traccia_di_chi_ha_risposto(monkeypatch):
+    traces = []
+    monkeypatch.setattr(app_sindacato, "get_audit_log",
+                        lambda: SimpleNamespace(answer=lambda *args, **_: traces.append(args[4])))
+    started, release = threading.Event(), threading.Event()
+
+    def answer(question, model, mode, data_riferimento, trace):
+        started.set()
+        release.wait(5)
+        trace.update(esito="llm", llm_ms=12.0)
+        return "risposta", []
+
+    assistant = object.__new__(SchoolUnionAssistant)
+    assistant.singleflight = SingleFlight()
+    assistant._flight_key = lambda *args: args
+    assistant._answer_question = answer
+    leader = threading.Thread(target=assistant.answer_question, args=("ferie?",))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=assistant.answer_question, args=("ferie?",))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert sorted((trace["esito"], trace.get("accorpata", False)) for trace in traces) == [("llm", False), ("llm", True)]
+
+
+# Backend locale
+
+def test_flusso_locale_mai_letto_annullato():
+    client = LocalLLMClient("modello.gguf")
+    client._slots = [None]  # niente llama.cpp: la richiesta resta in coda
+    stream = client.chat.completions.create(messages=[{"role": "user", "content": "ferie?"}], stream=True)
+    job = client._jobs.queue[0]
+    assert not job.cancelled
+    del stream
+    gc.collect()
+    # Lo slot la scarta invece di generare per un client che non legge
+    assert job.cancelled
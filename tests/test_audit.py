@@ -0,0 +1,105 @@
+import gzip
+import json
+import os
+import subprocess
+import sys
+
+from app_sindacato import SESSIONE_CORRENTE, AuditLog, TrafficRecorder
+
+
+def leggi(path):
+    events = []
+    for name in sorted(os.listdir(path)):
+        with gzip.open(os.path.join(path, name), "rt", encoding="utf-8") as f:
+            events.extend(json.loads(line) for line in f)
+    return events
+
+
+def test_eventi_scritti_a_lotti_gzip(tmp_path):
+    audit = AuditLog(str(tmp_path), batch=2, interval=60)
+    for i in range(5):
+        assert audit.log("recupero", {"i": i})
+    audit.close()
+    events = leggi(tmp_path)
+    assert [event["i"] for event in events] == list(range(5))
+    assert all(event["evento"] == "recupero" and event["pid"] == os.getpid() for event in events)
+    assert audit.stats["scritti"] == 5 and audit.stats["lotti"] == 3
+
+
+def test_risposta_registra_fonti_e_traccia(tmp_path):
+    audit = AuditLog(str(tmp_path), interval=60)
+    trace = {"esito": "llm", "modello": "m", "recuperati": [{"id": "doc_1", "score": 0.8}], "llm_ms": 12.0}
+    audit.answer("Quanti giorni di ferie?", "auto", "auto", None, trace, "Risposta",
+                 [{"categoria": "CCNL", "argomento": "Ferie", "articolo": ""}], 0.5)
+    audit.close()
+    (event,) = leggi(tmp_path)
+    assert event["evento"] == "risposta" and event["esito"] == "llm" and event["modello"] == "m"
+    assert event["recuperati"] == [{"id": "doc_1", "score": 0.8}]
+    assert event["fonti"] == [{"categoria": "CCNL", "argomento": "Ferie"}]
+    assert "Quanti" not in json.dumps(event) and event["risposta_caratteri"] == len("Risposta")
+
+
+def test_buffer_pieno_scarta_prima_i_non_critici(tmp_path):
+    audit = AuditLog(str(tmp_path), capacity=10, batch=100, interval=60)
+    audit.SOGLIA_PRESSIONE = 0.5
+    # Il thread di scrittura resta fermo: lo scarto lo sveglia
+    with audit._flush_lock:
+        for i in range(5):
+            assert audit.log("recupero", {"i": i}, critical=False)
+        assert not audit.log("recupero", {"i": 5}, critical=False)
+        for i in range(5):
+            assert audit.log("risposta", {"i": i})
+        assert not audit.log("risposta", {"i": 5})
+    assert audit.stats["scartati_non_critici"] == 1 and audit.stats["scartati"] == 1
+    audit.close()
+    assert len(leggi(tmp_path)) == 10
+
+
+def test_rotazione_cancella_solo_i_file_del_processo(tmp_path):
+    # Il processo padre (il runner dei test) è vivo: il suo file potrebbe essere ancora aperto
+    foreign = tmp_path / f"audit-20000101-000000-{os.getppid()}.jsonl.gz"
+    own_old = tmp_path / f"audit-20000101-000000-{os.getpid()}.jsonl.gz"
+    foreign.write_bytes(gzip.compress(b""))
+    own_old.write_bytes(gzip.compress(b""))
+    audit = AuditLog(str(tmp_path), interval=60, max_files=1)
+    audit.log("recupero", {"i": 0})
+    audit.close()
+    # Il file di un altro worker resta, anche se più vecchio
+    assert foreign.exists() and not own_old.exists()
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_rotazione_cancella_i_file_dei_processi_terminati(tmp_path):
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    dead = [tmp_path / f"audit-2000010{day}-000000-{child.pid}.jsonl.gz" for day in range(1, 4)]
+    for path in dead:
+        path.write_bytes(gzip.compress(b""))
+    audit = AuditLog(str(tmp_path), interval=60, max_files=2)
+    audit.log("recupero", {"i": 0})
+    audit.close()
+    # Restano i file più recenti entro il limite: quello corrente e l'ultimo del processo terminato
+    assert sorted(os.listdir(tmp_path))[0] == dead[-1].name
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_disattivato_senza_percorso():
+    audit = AuditLog("")
+    assert not audit.log("risposta", {})
+    assert audit.pending() == 0
+
+
+def test_traffico_accodato_e_scritto_dal_thread(tmp_path):
+    path = tmp_path / "traffico.jsonl"
+    recorder = TrafficRecorder(str(path), interval=60)
+    token = SESSIONE_CORRENTE.set("sessione-1")
+    try:
+        with recorder._flush_lock:
+            recorder.record("faq", {"faq": "ferie", "model": "modello-x"}, 0.0)
+            # Nessuna scrittura nel thread della richiesta
+            assert recorder.pending() == 1 and not path.exists()
+    finally:
+        SESSIONE_CORRENTE.reset(token)
+    recorder.close()
+    (entry,) = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert entry["op"] == "faq" and entry["model"] == "modello-x" and entry["sessione"] != "sessione-1"
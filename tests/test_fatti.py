@@ -0,0 +1,83 @@
+import pytest
+
+from app_sindacato import MODALITA_AUTOMATICA, MODALITA_LLM, FactIndex, SchoolUnionAssistant, data_int
+from datetime import date
+
+
+@pytest.mark.parametrize("question, diritto, valore", [
+    ("Quanti giorni di ferie ha un docente?", "Ferie", "32"),
+    ("Quante ore insegna una maestra della primaria?", "Orario di insegnamento", "22"),
+    ("Quanti giorni di permesso per matrimonio?", "Permesso per matrimonio", "15"),
+    ("Quanti giorni di preavviso per lo sciopero?", "Preavviso di sciopero", "10"),
+    ("Quanti mesi di congedo parentale?", "Congedo parentale", "10"),
+    ("Quante ore di straordinario al massimo per gli ATA?", "Limite di lavoro straordinario", "200"),
+])
+def test_risposta_immediata(fact_index, question, diritto, valore):
+    facts = fact_index.lookup(question)
+    assert facts and {fact["diritto"] for fact in facts} == {diritto}
+    assert valore in {fact["valore"] for fact in facts}
+
+
+def test_il_ruolo_sceglie_il_valore(fact_index):
+    facts = fact_index.lookup("Quante ore settimanali insegna un docente della secondaria?")
+    assert [fact["valore"] for fact in facts] == ["18"]
+
+
+def test_domande_di_ragionamento_vanno_all_llm(fact_index):
+    assert fact_index.lookup("Perché i docenti hanno 32 giorni di ferie?") == []
+    assert fact_index.lookup("Se mi ammalo durante le ferie cosa succede?") == []
+
+
+@pytest.mark.parametrize("question", [
+    "Quanti giorni di ferie ha un supplente breve?",
+    "Quanto dura la maternità facoltativa?",
+    "Quanti mesi di aspettativa per dottorato?",
+    "Quanti giorni di malattia sono soggetti a decurtazione?",
+    "Quanti giorni di malattia sono pagati al 100%?",
+    "Quanti giorni di preavviso per i permessi 104?",
+])
+def test_parole_non_coperte_dalla_regola_vanno_al_recupero(fact_index, question):
+    # Una parola della domanda che la regola non prevede può cambiare il valore: niente risposta immediata
+    assert fact_index.lookup(question) == []
+    assert fact_index.answer(question) is None
+
+
+@pytest.mark.parametrize("question, diritto", [
+    ("Quanto dura il periodo di prova?", "Durata dell'anno di prova"),
+    ("Quanti mesi di aspettativa per motivi personali?", "Aspettativa per motivi personali"),
+    ("Quante ore lavora il personale ATA?", "Orario di lavoro"),
+    ("Quanto si perde di stipendio per un giorno di sciopero?", "Trattenuta per sciopero"),
+])
+def test_contesto_della_regola_ammesso(fact_index, question, diritto):
+    assert {fact["diritto"] for fact in fact_index.lookup(question)} == {diritto}
+
+
+def test_risposta_cita_la_fonte(fact_index):
+    response, sources = fact_index.answer("Quanti giorni di permesso per lutto?")
+    assert "**3 giorni per evento**" in response
+    assert "Fonte: CCNL Scuola 2016-2018, Permessi retribuiti" in response
+    assert sources == [{"categoria": "CCNL Scuola 2016-2018", "argomento": "Permessi retribuiti",
+                        "versioni": "", "duplicati": 0}]
+    assert fact_index.answered == 1
+
+
+def test_valori_fuori_vigenza_esclusi(fact_index, corpus):
+    doc_id, _, meta = next(row for row in corpus if row[2]["argomento"] == "Permessi retribuiti")
+    fact_index.update_metadata(doc_id, dict(meta, valido_al=20200831))
+    assert fact_index.lookup("Quanti giorni di permesso per matrimonio?") == []
+    assert fact_index.lookup("Quanti giorni di permesso per matrimonio?", data_int(date(2019, 9, 1)))
+
+
+def test_indice_vuoto():
+    assert FactIndex().answer("Quanti giorni di ferie ha un docente?") is None
+
+
+def test_risposta_immediata_fuori_dall_ammissione(fact_index):
+    assistant = object.__new__(SchoolUnionAssistant)
+    assistant.fact_index = fact_index
+    question = "Quanti giorni di permesso per lutto?"
+    assert assistant.has_instant_answer(question, MODALITA_AUTOMATICA)
+    assert not assistant.has_instant_answer(question, MODALITA_LLM)
+    assert not assistant.has_instant_answer("Perché i docenti hanno 32 giorni di ferie?")
+    # Il controllo non conta come risposta data
+    assert fact_index.answered == 0
@@ -0,0 +1,161 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app_sindacato import CODA_MASSIMA_ESPANSIONE, CompactVectorIndex, QueryExpander, SearchCursors, SpeculativeSearcher
+from shard_sindacato import ShardedVectorIndex
+
+
+def test_chiave_deterministica_e_normalizzata():
+    assert SearchCursors.key("Ferie  Docenti", None, "v1") == SearchCursors.key("ferie docenti", None, "v1")
+    assert SearchCursors.key("ferie docenti", None, "v1") != SearchCursors.key("ferie docenti", None, "v2")
+    assert SearchCursors.key("ferie docenti", None, "v1") != SearchCursors.key("ferie docenti", 20200101, "v1")
+
+
+def test_classifica_condivisa_tra_le_pagine():
+    cursors = SearchCursors()
+    cursors.put("k", [{"id": "a"}, {"id": "b"}])
+    assert cursors.get("k") == [{"id": "a"}, {"id": "b"}]
+    assert cursors.get("altra") is None
+    assert cursors.stats == {"classifiche": 1, "pagine": 1, "scadute": 0}
+
+
+def test_classifiche_scadute():
+    cursors = SearchCursors(ttl=0.05)
+    cursors.put("k", [])
+    time.sleep(0.1)
+    assert cursors.get("k") is None
+    assert cursors.stats["scadute"] == 1
+    assert len(cursors) == 0
+
+
+def test_capacita_limitata_lru():
+    cursors = SearchCursors(capacity=2)
+    cursors.put("a", [])
+    cursors.put("b", [])
+    cursors.get("a")
+    cursors.put("c", [])
+    assert cursors.get("b") is None
+    assert cursors.get("a") == [] and cursors.get("c") == []
+
+
+class CollezioneFinta:
+    """Il minimo di una collection Chroma usato da CompactVectorIndex.sync e ShardedVectorIndex.sync"""
+
+    def __init__(self, vectors):
+        self.name = "finta"
+        self.vectors = {f"doc_{i}": v for i, v in enumerate(vectors)}
+
+    def get(self, ids=None, include=()):
+        ids = list(self.vectors) if ids is None else ids
+        return {"ids": ids, "embeddings": [self.vectors[doc_id] for doc_id in ids], "metadatas": [{} for _ in ids]}
+
+
+def test_indice_compatto_niente_troncamento_senza_matryoshka(tmp_path):
+    rng = np.random.default_rng(0)
+    index = CompactVectorIndex(dim=8, rescoring_dir=str(tmp_path))
+    index.sync(CollezioneFinta(rng.normal(size=(4, 16))), "v1", "sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
+    assert index.method == "nessuna" and index.codes.shape == (4, 16)
+
+
+def test_indice_compatto_ricalcola_la_proiezione_quando_il_corpus_cresce(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(20, 16))
+    index = CompactVectorIndex(dim=8, rescoring_dir=str(tmp_path))
+    index.sync(CollezioneFinta(vectors[:4]), "v1")
+    assert index.provisional
+    index.sync(CollezioneFinta(vectors), "v2")
+    assert index.method == "pca" and not index.provisional
+    assert index.codes.shape == (20, 8)
+    assert [doc_id for doc_id, _ in index.search(vectors[7], 1)] == ["doc_7"]
+
+
+def test_indice_compatto_filtra_la_validita_e_non_tiene_i_float32(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 32)).astype(np.float32)
+    index = CompactVectorIndex(dim=8, rescoring_dir=str(tmp_path))
+    index.sync(CollezioneFinta(vectors), "v1")
+    (doc_id, score), = index.search(vectors[3], 1)
+    assert doc_id == "doc_3" and score == pytest.approx(1.0, abs=1e-3)
+    index.update_validity("doc_3", {"valido_dal": 20190101, "valido_al": 20211231})
+    assert "doc_3" not in [doc_id for doc_id, _ in index.search(vectors[3], 5, 20240101)]
+    assert index.search(vectors[3], 1, 20200101)[0][0] == "doc_3"
+    # In memoria solo codici int8 e validità: meno dei float32 di partenza (il float16 è su disco)
+    assert index.memory_bytes() < vectors.nbytes / 3
+    assert index.disk_bytes() == vectors.nbytes // 2
+    assert np.allclose(index.vectors(["doc_5"])[0], vectors[5] / np.linalg.norm(vectors[5]), atol=1e-3)
+
+
+class AssistenteFinto:
+    def search_page(self, query, page_size):
+        return {"risultati": [query], "totale": 1, "cursore": None}
+
+
+def test_ricerca_speculativa_per_scheda_e_dimenticata_a_fine_ricerca():
+    searcher = SpeculativeSearcher(debounce=0.05)
+    superseded = searcher.submit(AssistenteFinto(), "scheda-1", "fer", "v1", 10)
+    latest = searcher.submit(AssistenteFinto(), "scheda-1", "ferie", "v1", 10)
+    # Un'altra scheda non annulla la ricerca della prima
+    other = searcher.submit(AssistenteFinto(), "scheda-2", "permessi", "v1", 10)
+    assert superseded.result(5) is None
+    assert latest.result(5)["risultati"] == ["ferie"] and other.result(5)["risultati"] == ["permessi"]
+    assert searcher._latest == {}
+
+
+def test_coda_delle_riscritture_limitata():
+    expander = QueryExpander()
+    gate = threading.Event()
+    futures = [expander.submit(gate.wait) for _ in range(CODA_MASSIMA_ESPANSIONE)]
+    assert all(futures) and expander.submit(gate.wait) is None
+    # Quelle non ancora partite si annullano e liberano subito il posto
+    assert any(future.cancel() for future in futures)
+    assert expander.submit(lambda: None) is not None
+    gate.set()
+    expander.executor.shutdown(wait=True)
+
+
+def indice_shard(n=40, dim=8):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    ids = [f"doc_{i}" for i in range(n)]
+    metadatas = [{"categoria": "ferie" if i % 2 else "permessi"} for i in range(n)]
+    index = ShardedVectorIndex(2, 1000)
+    index.build(ids, vectors, metadatas)
+    index.version = "v1"
+    return index, vectors
+
+
+def test_ricerche_shard_concorrenti_senza_serializzazione():
+    index, vectors = indice_shard()
+    try:
+        results = [None] * 8
+
+        def cerca(i):
+            results[i] = index.search(vectors[i], 3, 20240101)
+
+        threads = [threading.Thread(target=cerca, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Ogni ricerca riceve la propria risposta, non quella di un'altra richiesta in volo
+        assert [hits[0][0] for hits in results] == [f"doc_{i}" for i in range(8)]
+    finally:
+        index.close()
+
+
+def test_shard_perso_ripiega_e_riavvia():
+    index, vectors = indice_shard()
+    try:
+        lost = index.workers[0]
+        lost.process.kill()
+        lost.process.join()
+        assert index.search(vectors[0], 3, 20240101) == []
+        assert index.version is None
+        assert index.workers[0] is not lost and index.workers[0].process.is_alive()
+        index.sync(CollezioneFinta(vectors), "v2")
+        assert index.search(vectors[0], 3, 20240101)[0][0] == "doc_0"
+    finally:
+        index.close()
@@ -0,0 +1,34 @@
+import pytest
+
+from app_sindacato import ModelRouter, tokenizza
+
+
+@pytest.mark.parametrize("question", [
+    "Quanti giorni di permesso al mese?",
+    "Quanto costano le spese di viaggio?",
+    "Qual è lo stipendio base?",
+    "Quando si chiese la mobilità?",
+])
+def test_parole_che_contengono_se_non_sono_indizi(question):
+    router = ModelRouter()
+    assert not router._has_cue(tokenizza(question), "se")
+    assert router.choose(question, [0.3, 0.5]) == router.fast_model
+
+
+@pytest.mark.parametrize("question, cue", [
+    ("Se mi ammalo durante le ferie?", "se"),
+    ("Perché mi hanno trattenuto lo stipendio?", "perché"),
+    ("Mi conviene confrontare le due offerte?", "confront"),
+    ("Nel caso di sciopero cosa succede?", "nel caso"),
+    ("Qual è la durata del comporto?", "qual è"),
+])
+def test_indizi_come_parole_e_radici(question, cue):
+    assert ModelRouter._has_cue(tokenizza(question), cue)
+
+
+def test_domanda_complessa_al_modello_grande():
+    router = ModelRouter()
+    question = ("Se ho già usato i permessi 104 e mi ammalo durante le ferie, mi conviene chiedere "
+                "l'aspettativa oppure il congedo? Perché la scuola contesta la mia richiesta?")
+    assert router.choose(question, [0.4, 0.45]) == router.large_model
+
@@ -0,0 +1,11 @@
+from app_sindacato import SessionRegistry
+
+
+def test_report_senza_identificativi_delle_conversazioni(tmp_path):
+    sessions = SessionRegistry(str(tmp_path), sweep_interval=3600)
+    secret = "0123456789abcdef0123456789abcdef"
+    sessions.put(secret, "cronologia", {"messaggi": ["ferie?"]})
+    (row,) = sessions.report()
+    # Il report è per l'amministratore, ma l'id della conversazione è il cookie segreto dell'utente
+    assert secret not in str(row) and len(row["sessione"]) == 12
+
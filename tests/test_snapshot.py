@@ -0,0 +1,68 @@
+"""Pubblicazione e lettura degli snapshot su disco"""
+
+import json
+import os
+
+import numpy as np
+
+from app_sindacato import (
+    FORMATO_SNAPSHOT, MODELLO_EMBEDDING, SEMPRE_VALIDO_AL, SEMPRE_VALIDO_DAL, file_sha256, load_snapshot, pubblica_snapshot
+)
+
+
+def scrivi_versione(parent, nome, vettori, scale=None, formato=FORMATO_SNAPSHOT, metadati=None, lessicale=None):
+    """Una versione di snapshot scritta a mano, come farebbe export_snapshot"""
+    path = os.path.join(parent, nome)
+    os.makedirs(path)
+    np.save(os.path.join(path, "vettori.npy"), vettori)
+    if scale is not None:
+        np.save(os.path.join(path, "scale.npy"), scale)
+    with open(os.path.join(path, "documenti.json"), "w", encoding="utf-8") as f:
+        json.dump({"ids": [f"doc_{i}" for i in range(len(vettori))], "documents": [], "metadatas": metadati or []}, f)
+    with open(os.path.join(path, "lessicale.json"), "w", encoding="utf-8") as f:
+        json.dump(lessicale or {}, f)
+    manifest = {
+        "formato": formato, "modello": MODELLO_EMBEDDING, "documenti": len(vettori),
+        "dtype": str(vettori.dtype), "corpus_version": nome,
+        "checksum": {name: file_sha256(os.path.join(path, name)) for name in sorted(os.listdir(path))},
+    }
+    with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return path
+
+
+def test_pubblicazione_sposta_il_link_e_tiene_una_versione_precedente(tmp_path):
+    target = str(tmp_path / "snap")
+    vettori = np.ones((2, 4), dtype=np.float16)
+    for i in range(4):
+        pubblica_snapshot(target, scrivi_versione(tmp_path, f"snap.v-{i}", vettori))
+        assert os.path.islink(target)
+        assert load_snapshot(target)[0]["corpus_version"] == f"snap.v-{i}"
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith("snap.v-")) == ["snap.v-2", "snap.v-3"]
+
+
+def test_pubblicazione_migra_una_cartella_reale(tmp_path):
+    target = str(tmp_path / "snap")
+    os.rename(scrivi_versione(tmp_path, "vecchio", np.ones((1, 4), dtype=np.float16)), target)
+    pubblica_snapshot(target, scrivi_versione(tmp_path, "snap.v-1", np.ones((1, 4), dtype=np.float16)))
+    assert os.path.islink(target)
+    assert load_snapshot(target)[0]["corpus_version"] == "snap.v-1"
+
+
+def test_int8_resta_mappato_con_le_scale_separate(tmp_path):
+    codici = np.array([[127, -64], [10, 0]], dtype=np.int8)
+    scale = np.array([[0.01], [0.5]], dtype=np.float32)
+    path = scrivi_versione(tmp_path, "snap.v-1", codici, scale)
+    manifest, vettori, scales, _, _ = load_snapshot(path)
+    assert isinstance(vettori, np.memmap) and vettori.dtype == np.int8
+    np.testing.assert_allclose(vettori[:1] * scales[:1], [[1.27, -0.64]], rtol=1e-6)
+
+
+def test_snapshot_formato_1_migrato_come_sempre_valido(tmp_path):
+    path = scrivi_versione(tmp_path, "snap.v-1", np.ones((1, 4), dtype=np.float16), formato=1,
+                           metadati=[{"categoria": "CCNL", "argomento": "Ferie"}],
+                           lessicale={"postings": {}, "docs": {"doc_0": {"id": "doc_0", "argomento": "Ferie"}}})
+    _, _, _, documents, lexical = load_snapshot(path)
+    assert documents["metadatas"][0]["valido_dal"] == SEMPRE_VALIDO_DAL
+    assert documents["metadatas"][0]["valido_al"] == SEMPRE_VALIDO_AL
+    assert lexical["docs"]["doc_0"]["valido_al"] == SEMPRE_VALIDO_AL
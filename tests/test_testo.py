@@ -0,0 +1,87 @@
+import numpy as np
+
+from app_sindacato import (
+    dividi_frasi, espandi_finestre, finestre_di_frasi, hamming, mmr_select, rrf_fuse, simhash
+)
+
+FRASI = "".join(f"{nome} frase qui. " for nome in
+                ("Prima", "Seconda", "Terza", "Quarta", "Quinta", "Sesta", "Settima", "Ottava")).strip()
+
+
+def test_dividi_frasi_non_spezza_le_abbreviazioni():
+    text = "Art. 12 - Ferie. Il docente ha diritto a 32 giorni. Lo prevede il D.Lgs. n. 165 del 2001. Fine!"
+    assert [text[a:b] for a, b in dividi_frasi(text)] == [
+        "Art. 12 - Ferie.",
+        "Il docente ha diritto a 32 giorni.",
+        "Lo prevede il D.Lgs. n. 165 del 2001.",
+        "Fine!",
+    ]
+
+
+def test_dividi_frasi_su_commi_numerati():
+    text = "Art. 3 - Permessi\n1. Spettano tre giorni\n2. Sono retribuiti"
+    assert [text[a:b] for a, b in dividi_frasi(text)] == ["Art. 3 - Permessi", "1. Spettano tre giorni",
+                                                         "2. Sono retribuiti"]
+
+
+def test_finestre_sovrapposte_coprono_tutte_le_frasi():
+    windows = [FRASI[a:b] for a, b in finestre_di_frasi(FRASI)]
+    assert windows[0] == "Prima frase qui. Seconda frase qui. Terza frase qui."
+    assert windows[-1] == "Sesta frase qui. Settima frase qui. Ottava frase qui."
+    assert all(window.count("frase") == 3 for window in windows)
+
+
+def test_espandi_finestre_aggiunge_il_margine():
+    sentences = dividi_frasi(FRASI)
+    assert espandi_finestre(FRASI, [sentences[0]]) == "Prima frase qui. Seconda frase qui."
+    assert espandi_finestre(FRASI, [sentences[7]]) == "Settima frase qui. Ottava frase qui."
+
+
+def test_espandi_finestre_unisce_le_sovrapposte_e_separa_le_lontane():
+    sentences = dividi_frasi(FRASI)
+    merged = espandi_finestre(FRASI, [sentences[0], sentences[1]])
+    assert merged == "Prima frase qui. Seconda frase qui. Terza frase qui."
+    apart = espandi_finestre(FRASI, [sentences[0], sentences[7]])
+    assert apart == "Prima frase qui. Seconda frase qui. […] Settima frase qui. Ottava frase qui."
+
+
+def test_espandi_finestre_restituisce_il_padre_se_coperto_quasi_tutto():
+    sentences = dividi_frasi(FRASI)
+    assert espandi_finestre(FRASI, [(sentences[1][0], sentences[5][1])]) == FRASI
+
+
+def test_simhash_vicino_per_testi_quasi_identici():
+    text = "I docenti hanno diritto a 32 giorni di ferie durante i periodi di sospensione delle attività didattiche"
+    assert hamming(simhash(text), simhash(text + ".")) == 0
+    assert hamming(simhash(text), simhash(text.replace("32", "30"))) <= 20
+    other = "Il periodo di comporto per malattia è di diciotto mesi con retribuzione decrescente"
+    assert hamming(simhash(text), simhash(other)) > 10
+
+
+def test_mmr_select_evita_i_candidati_ridondanti():
+    query = np.array([1.0, 0.0, 0.0])
+    candidates = np.array([
+        [0.9, 0.43, 0.0],
+        [0.9, 0.43, 0.0],   # identico al primo
+        [0.9, -0.43, 0.0],  # altrettanto pertinente, ma diverso
+    ])
+    assert mmr_select(query, candidates, 2) == [0, 2]
+    assert mmr_select(query, candidates, 3) == [0, 2, 1]
+
+
+def _risultati(ids, distances):
+    return {"ids": [ids], "documents": [[f"testo {i}" for i in ids]],
+            "metadatas": [[{"id": i} for i in ids]], "distances": [distances]}
+
+
+def test_rrf_fuse_premia_i_documenti_presenti_in_piu_liste():
+    fused = rrf_fuse([_risultati(["a", "b", "c"], [0.1, 0.2, 0.3]),
+                      _risultati(["c", "d", "b"], [0.05, 0.4, 0.25])], 3)
+    assert fused["ids"][0] == ["c", "b", "a"]
+    # Per ogni documento restano i campi della riga più vicina
+    assert fused["distances"][0] == [0.05, 0.2, 0.1]
+    assert fused["documents"][0] == ["testo c", "testo b", "testo a"]
+
+
+def test_rrf_fuse_senza_risultati():
+    assert rrf_fuse([_risultati([], [])], 4)["ids"] == [[]]
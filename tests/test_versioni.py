@@ -0,0 +1,226 @@
+"""Versioni dei contratti su una collection Chroma in memoria (embedding finti, niente modello)"""
+
+import json
+import threading
+import time
+import uuid
+
+import chromadb
+import numpy as np
+import pytest
+
+import app_sindacato
+from app_sindacato import (CompactVectorIndex, FactIndex, IndexMigration, LexicalIndex, SchoolUnionAssistant, SEMPRE_VALIDO_AL,
+                           correlati_vigenti, documenti_vigenti, scrivi_indice_attivo)
+
+
+class EmbeddingFinto:
+    """Vettori deterministici dal testo: bastano per confronti e grafo dei correlati"""
+
+    def encode(self, texts):
+        return np.array([np.random.default_rng(abs(hash(text)) % 2**32).normal(size=8) for text in texts])
+
+
+@pytest.fixture
+def assistant():
+    client = chromadb.EphemeralClient()
+    assistant = object.__new__(SchoolUnionAssistant)
+    assistant.chroma_client = client
+    assistant.collection = client.create_collection(f"test_{uuid.uuid4().hex[:8]}")
+    scrivi_indice_attivo(client, "finto", assistant.collection.name)
+    assistant.embedding_model = EmbeddingFinto()
+    assistant.lexical_index = LexicalIndex()
+    assistant.fact_index = FactIndex()
+    assistant.compact_index = assistant.shard_index = None
+    assistant._version_memo = (0.0, None)
+    return assistant
+
+
+ARTICOLI = {"Art. 13 - Ferie": "Il dipendente ha diritto a 32 giorni di ferie.",
+            "Art. 15 - Permessi": "Tre giorni di permesso per motivi personali."}
+
+
+def test_ricaricare_la_stessa_versione_non_duplica(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    report = assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    assert sorted(report["invariati"]) == sorted(ARTICOLI) and not report["nuovi"]
+    assert assistant.collection.count() == 2
+
+
+def test_ricaricare_con_un_testo_corretto_lo_sostituisce(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    corretti = dict(ARTICOLI, **{"Art. 15 - Permessi": "Tre giorni di permesso retribuito per motivi personali."})
+    report = assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, corretti)
+    assert report["modificati"] == ["Art. 15 - Permessi"]
+    assert assistant.collection.count() == 2
+    assert "retribuito" in " ".join(assistant.collection.get()["documents"])
+
+
+def test_ricaricare_la_stessa_versione_abroga_gli_articoli_tolti(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    ferie = {"Art. 13 - Ferie": ARTICOLI["Art. 13 - Ferie"]}
+    report = assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ferie)
+    assert report["abrogati"] == ["Art. 15 - Permessi"]
+    in_force = assistant.collection.get(where={"valido_al": {"$gte": 20200101}}, include=["metadatas"])
+    assert [meta["argomento"] for meta in in_force["metadatas"]] == ["Art. 13 - Ferie"]
+    # Di nuovo nel testo: l'articolo torna in vigore senza ricalcolare l'embedding
+    report = assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    assert sorted(report["invariati"]) == sorted(ARTICOLI) and not report["abrogati"]
+    assert len(assistant.collection.get(where={"valido_al": SEMPRE_VALIDO_AL})["ids"]) == 2
+
+
+def test_duplicati_cercati_solo_tra_i_chunk_in_vigore(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    assistant.ingest_contract_version("CCNL Scuola", "2022-2024", 20240101,
+                                      {"Art. 13 - Ferie": ARTICOLI["Art. 13 - Ferie"]})
+    permessi = "Art. 15 - Permessi: " + ARTICOLI["Art. 15 - Permessi"]
+    assert assistant.find_duplicate(permessi, assistant.embedding_model.encode([permessi])[0].tolist()) is None
+    ferie = "Art. 13 - Ferie: " + ARTICOLI["Art. 13 - Ferie"]
+    assert assistant.find_duplicate(ferie, assistant.embedding_model.encode([ferie])[0].tolist())
+
+
+def test_chiusura_di_un_articolo_cambia_la_versione_del_corpus(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    before = assistant.corpus_version()
+    # Solo l'abrogazione: nessun documento nuovo, cambiano solo i metadati
+    report = assistant.ingest_contract_version("CCNL Scuola", "2022-2024", 20240101,
+                                               {"Art. 13 - Ferie": ARTICOLI["Art. 13 - Ferie"]})
+    assert report["abrogati"] == ["Art. 15 - Permessi"] and assistant.collection.count() == 2
+    assert assistant.corpus_version() != before
+
+
+def test_un_altro_processo_vede_la_validita_aggiornata(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    other = object.__new__(SchoolUnionAssistant)
+    other.__dict__.update(assistant.__dict__, lexical_index=LexicalIndex(), fact_index=FactIndex())
+
+    def sync():
+        # Come sync_indexes, senza registro dell'indice attivo e modello di embedding
+        other._sync_metadata()
+        other.lexical_index.sync(other.collection, other.corpus_version())
+
+    sync()
+    assistant.ingest_contract_version("CCNL Scuola", "2022-2024", 20240101,
+                                      {"Art. 13 - Ferie": ARTICOLI["Art. 13 - Ferie"]})
+    sync()
+    closed = [doc for doc in other.lexical_index.docs.values() if doc["argomento"] == "Art. 15 - Permessi"]
+    assert closed and closed[0]["valido_al"] != SEMPRE_VALIDO_AL
+
+
+def test_indice_compatto_segue_la_chiusura_degli_articoli(assistant, tmp_path):
+    assistant.compact_index = CompactVectorIndex(dim=4, rescoring_dir=str(tmp_path))
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    assistant.compact_index.sync(assistant.collection, assistant.corpus_version())
+    assistant.ingest_contract_version("CCNL Scuola", "2022-2024", 20240101,
+                                      {"Art. 13 - Ferie": "Il dipendente ha diritto a 30 giorni di ferie."})
+    query = assistant.embedding_model.encode([ARTICOLI["Art. 15 - Permessi"]]).tolist()
+    results = assistant._vector_query(query, 3, with_embeddings=True, data_riferimento=20250101)
+    # Permessi abrogati e Ferie 2019 chiusa: resta solo la nuova versione, senza leggere i float32 da Chroma
+    assert [meta["versione"] for meta in results["metadatas"][0]] == ["2022-2024"]
+    assert len(results["embeddings"][0][0]) == 8
+
+
+def test_finestra_aperta_con_l_articolo_intero(assistant):
+    assistant.parents = assistant.chroma_client.create_collection(f"padri_{uuid.uuid4().hex[:8]}")
+    frasi = " ".join(f"Frase numero {i} sulle ferie del personale." for i in range(12))
+    assistant._add_long_document(f"Art. 13 - Ferie\n{frasi}", "Regolamento", "Ferie")
+    data = assistant.collection.get(include=["documents"])
+    window = next(doc_id for doc_id, doc in zip(data["ids"], data["documents"]) if "numero 11" not in doc)
+    (document,) = assistant.get_documents([window])["documents"]
+    assert "Frase numero 0" in document and "Frase numero 11" in document
+
+
+def test_caricamenti_concorrenti_non_si_sovrascrivono(assistant):
+    barrier = threading.Barrier(2)
+
+    def nessun_duplicato(text, embedding):
+        # Entrambi i caricamenti superano il controllo dei duplicati prima che l'altro scriva
+        barrier.wait(5)
+        return None
+
+    assistant.find_duplicate = nessun_duplicato
+
+    class CollezioneLenta:
+        """Il conteggio arriva in ritardo: l'altro caricamento legge lo stesso valore"""
+
+        def __init__(self, collection):
+            self.collection = collection
+
+        def __getattr__(self, name):
+            return getattr(self.collection, name)
+
+        def count(self):
+            n = self.collection.count()
+            time.sleep(0.05)
+            return n
+
+    assistant.collection = CollezioneLenta(assistant.collection)
+    results = []
+    texts = ["Circolare sulle ferie estive del personale ATA.", "Delibera sul piano annuale delle attività."]
+    threads = [threading.Thread(target=lambda text=text: results.append(assistant.add_custom_content(text, "Circolari", text[:8])))
+               for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert len({doc_id for doc_id, _ in results}) == 2 and not any(duplicate for _, duplicate in results)
+    assert sorted(assistant.collection.get()["documents"]) == sorted(texts)
+
+
+def test_correlati_filtrati_per_data(assistant):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    assistant.ingest_contract_version("CCNL Scuola", "2022-2024", 20240101,
+                                      {"Art. 13 - Ferie": ARTICOLI["Art. 13 - Ferie"]})
+    data = assistant.collection.get(include=["metadatas"])
+    ferie = next(meta for meta in data["metadatas"] if meta["argomento"] == "Art. 13 - Ferie")
+    # L'arco verso i Permessi è stato calcolato quando erano in vigore
+    assert [edge["argomento"] for edge in correlati_vigenti(assistant, [ferie], 20200101)] == ["Art. 15 - Permessi"]
+    assert correlati_vigenti(assistant, [ferie], None) == []
+
+
+def test_correlati_di_una_pagina_con_una_lettura(assistant, monkeypatch):
+    assistant.ingest_contract_version("CCNL Scuola", "2019-2021", 20190101, ARTICOLI)
+    metas = assistant.collection.get(include=["metadatas"])["metadatas"]
+    reads = []
+    get_documents = assistant.get_documents
+    monkeypatch.setattr(assistant, "get_documents", lambda ids: reads.append(ids) or get_documents(ids))
+    vigenti = documenti_vigenti(assistant, metas, None)
+    related = [correlati_vigenti(assistant, [meta], None, vigenti=vigenti) for meta in metas]
+    assert len(reads) == 1 and any(related)
+
+
+class EmbeddingRegistrato(EmbeddingFinto):
+    def __init__(self):
+        self.texts = []
+
+    def encode(self, texts):
+        self.texts.extend(texts)
+        return super().encode(texts)
+
+
+def test_scambio_recupera_i_caricamenti_arrivati_durante_lo_spostamento(monkeypatch):
+    client = chromadb.EphemeralClient()
+    source = client.create_collection(f"test_{uuid.uuid4().hex[:8]}")
+    source.add(ids=["f0"], documents=["Trenta giorni."], embeddings=[[0.0] * 8],
+               metadatas=[{"tipo": "finestra", "articolo": "Art. 13 - Ferie",
+                           "correlati": '[{"id": "vecchio", "categoria": "", "argomento": "", "score": 0.99}]'}])
+    model = EmbeddingRegistrato()
+    monkeypatch.setattr(app_sindacato, "get_embedding_model", lambda name: model)
+
+    def scambio_con_caricamento(*args, **kwargs):
+        scrivi_indice_attivo(*args, **kwargs)
+        source.add(ids=["tardivo"], documents=["Arrivato durante lo scambio"], embeddings=[[0.0] * 8],
+                   metadatas=[{"categoria": "x"}])
+
+    monkeypatch.setattr(app_sindacato, "scrivi_indice_attivo", scambio_con_caricamento)
+    migration = IndexMigration()
+    migration.client, migration.source, migration.source_model = client, source, "vecchio"
+    migration.model, migration.collection = "nuovo", client.create_collection(f"ombra_{uuid.uuid4().hex[:8]}")
+    migration.state = "pronta"
+    migration.swap()
+    assert sorted(migration.collection.get(include=[])["ids"]) == ["f0", "tardivo"]
+    # La finestra è ricalcolata con il titolo dell'articolo, come al caricamento
+    assert "Art. 13 - Ferie: Trenta giorni." in model.texts
+    # Archi e punteggi ricalcolati nello spazio del nuovo modello, non copiati dal vecchio indice
+    edges = json.loads(migration.collection.get(ids=["f0"], include=["metadatas"])["metadatas"][0]["correlati"])
+    assert [edge["id"] for edge in edges] == ["tardivo"]